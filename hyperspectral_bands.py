@@ -0,0 +1,157 @@
+"""Selects and bins the spectral bands written to the calibrated file
+
+A band profile is a window of wavelengths, optionally split into bins of a given width whose bands are averaged. It's
+written as "START:END[:WIDTH]" in nanometers, where START and END can be left out to not limit that end of the window.
+For example "400:900" keeps the bands from 400nm up to (not including) 900nm, "::10" averages all the bands into 10nm
+bins, and ":" only drops the bands the camera has no calibration for
+"""
+
+import logging
+from typing import Optional
+import numpy as np
+
+# The number of meters in a nanometer, since the wavelength coordinate is in meters
+METERS_PER_NANOMETER = 1.0e-9
+
+# The attribute of the wavelength coordinate recording the band profile it was resampled with
+PROFILE_ATTRIBUTE = 'band_profile'
+
+
+class BandProfile():
+    """A window of wavelengths and an optional bin width, as given on the command line
+    """
+
+    def __init__(self, start: Optional[float] = None, end: Optional[float] = None, width: Optional[float] = None):
+        """Initializes class instance
+        Arguments:
+            start: the lowest wavelength kept, in nanometers; None to keep the bands from the first one
+            end: the wavelength, in nanometers, above the last one kept; None to keep the bands to the last one
+            width: the width of the bins in nanometers; None to keep the bands without binning
+        Exceptions:
+            Raises RuntimeError if the window is empty or the width isn't positive
+        """
+        if start is not None and end is not None and not end > start:
+            raise RuntimeError("Band profile window %s to %s nm is empty" % (str(start), str(end)))
+        if width is not None and not width > 0:
+            raise RuntimeError("Band profile bin width %s nm is not positive" % str(width))
+        self.start = start
+        self.end = end
+        self.width = width
+
+    def __str__(self) -> str:
+        return ':'.join(['' if value is None else '%g' % value for value in (self.start, self.end)] +
+                        ([] if self.width is None else ['%g' % self.width]))
+
+    @staticmethod
+    def parse(spec: str) -> 'BandProfile':
+        """Parses a band profile
+        Arguments:
+            spec: the profile as "START:END[:WIDTH]" in nanometers, with START and END optional
+        Return:
+            Returns the band profile
+        Exceptions:
+            Raises ValueError if the profile can't be parsed, so it can be used as an argparse type
+        """
+        parts = spec.split(':')
+        if len(parts) not in (2, 3):
+            raise ValueError("Band profile '%s' is not in the form START:END[:WIDTH]" % spec)
+        try:
+            values = [float(part) if part.strip() else None for part in parts]
+            if len(values) == 3 and values[2] is None:
+                raise ValueError("Band profile '%s' is missing its bin width" % spec)
+            return BandProfile(*values)
+        except RuntimeError as ex:
+            raise ValueError(str(ex)) from ex
+
+    def get_bins(self, wavelengths: np.ndarray, num_bands: Optional[int] = None) -> 'BandBins':
+        """Finds the bands of each output band
+        Arguments:
+            wavelengths: the wavelengths of the bands in meters, in increasing order
+            num_bands: the number of bands that have calibrated values; None if all the bands are calibrated
+        Return:
+            Returns the bins of bands
+        Exceptions:
+            Raises RuntimeError if the window doesn't hold any calibrated bands
+        """
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        nanometers = wavelengths / METERS_PER_NANOMETER
+        if num_bands is not None:
+            nanometers = nanometers[:num_bands]
+
+        selected = np.ones(nanometers.shape, dtype=bool)
+        if self.start is not None:
+            selected &= nanometers >= self.start
+        if self.end is not None:
+            selected &= nanometers < self.end
+        band_indices = np.flatnonzero(selected)
+        if band_indices.size == 0:
+            raise RuntimeError("Band profile %s doesn't have any calibrated bands between %g and %g nm" %
+                               (str(self), float(nanometers.min()), float(nanometers.max())))
+        first, stop = int(band_indices[0]), int(band_indices[-1]) + 1
+
+        if self.width is None:
+            starts = np.arange(stop - first)
+        else:
+            # The bins are counted from the start of the window, or from the first band when it's not limited
+            origin = self.start if self.start is not None else nanometers[first]
+            bin_numbers = np.floor((nanometers[first:stop] - origin) / self.width).astype(np.int64)
+            starts = np.flatnonzero(np.diff(bin_numbers, prepend=bin_numbers[0] - 1))
+
+        bins = BandBins(first, stop, starts, wavelengths[first:stop], self)
+        logging.debug("Band profile %s: %s bands from band %s to %s bands", str(self), str(stop - first), str(first),
+                      str(bins.num_bins))
+        return bins
+
+
+class BandBins():
+    """The bands of a file averaged into each output band, as found by BandProfile.get_bins()
+    """
+
+    def __init__(self, first: int, stop: int, starts: np.ndarray, wavelengths: np.ndarray, profile: BandProfile):
+        """Initializes class instance
+        Arguments:
+            first: the index of the first band used
+            stop: the index after the last band used
+            starts: the index, counted from first, of the first band of each bin; bins run to the start of the next
+            wavelengths: the wavelengths of the bands used, in meters
+            profile: the band profile the bins are for
+        """
+        self.first = first
+        self.stop = stop
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.counts = np.diff(np.append(self.starts, stop - first))
+        self.profile = profile
+        # Binning is skipped when every bin has a single band
+        self.binned = bool(np.any(self.counts > 1))
+        self.wavelengths = np.add.reduceat(wavelengths, self.starts) / self.counts
+
+    @property
+    def num_bins(self) -> int:
+        """Returns the number of output bands
+        """
+        return int(self.starts.size)
+
+    def apply(self, values: np.ndarray, axis: int = 0, first_band: int = 0) -> np.ndarray:
+        """Selects and averages the bands of values
+        Arguments:
+            values: the values to resample
+            axis: the band axis of values
+            first_band: the index of the band at the start of the axis; values need to include the bands from first to
+                        stop
+        Return:
+            Returns the values with the output bands along the axis and the same data type. Without binning this is a
+            view of values. Integer values are rounded to the nearest integer
+        """
+        index = [slice(None)] * values.ndim
+        index[axis] = slice(self.first - first_band, self.stop - first_band)
+        values = values[tuple(index)]
+        if not self.binned:
+            return values
+
+        shape = [1] * values.ndim
+        shape[axis] = self.num_bins
+        # Summing in double precision keeps the rounding of the means to that of their type
+        means = np.add.reduceat(values, self.starts, axis=axis, dtype=np.float64) / self.counts.reshape(shape)
+        if values.dtype.kind in ('i', 'u'):
+            means = np.rint(means)
+        return means.astype(values.dtype)
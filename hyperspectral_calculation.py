@@ -3,6 +3,8 @@
 import numpy as np
 import sys
 import json
+import time
+import argparse
 from math import *
 from datetime import date, datetime, timedelta
 from decimal import *
@@ -23,6 +25,17 @@ LATITUDE_TO_METER  = 1/ (25.906 * 3600) #varies, but has been corrected based on
 
 GOOGLE_MAP_TEMPLATE = "https://maps.googleapis.com/maps/api/staticmap?size=1280x720&zoom=17&path=color:0x0000005|weight:5|fillcolor:0xFFFF0033|{pointA}|{pointB}|{pointC}|{pointD}"
 
+_UNIX_BASETIME = np.datetime64('1970-01-01T00:00:00', 'us')
+
+_UNIX_BASETIME_JULIAN_DATE = 2440587.5 # the Julian Date of 1970-01-01 00:00:00
+
+_MICROSECONDS_PER_DAY = 86400 * 10**6
+
+# The number of frames, one per second, and the first day (2017-05-03 12:00 UTC) of the benchmarked scan
+DEFAULT_BENCHMARK_FRAMES = 40000
+
+DEFAULT_BENCHMARK_DAY = 17289.5
+
 
 def _julian_date(time_date):
     '''
@@ -93,6 +106,61 @@ def solar_zenith_angle(time_date):
     return float(Decimal(acos(cos_solar_zen_ang)/pi)*Decimal(180))
 
 
+def _frame_datetimes(frame_times):
+    '''
+    Convert an array of days since 1970-01-01 into datetime64 values,
+    rounded to the microsecond like timedelta(days=...)
+
+    Private in this module
+    '''
+    frame_times  = np.asarray(frame_times, dtype=np.float64)
+    whole_days   = np.floor(frame_times)
+    microseconds = whole_days.astype(np.int64) * _MICROSECONDS_PER_DAY +\
+                   np.rint((frame_times - whole_days) * _MICROSECONDS_PER_DAY).astype(np.int64)
+    return _UNIX_BASETIME + microseconds.astype('timedelta64[us]')
+
+
+def julian_dates(frame_times):
+    '''
+    Calculate the Julian Dates of an array of days since 1970-01-01,
+    the array form of _julian_date() using whole seconds like it does.
+
+    _julian_date() rounds the fraction of the day to 8 digits, so the
+    two agree to within 1e-7 days.
+    '''
+    microseconds = (_frame_datetimes(frame_times) - _UNIX_BASETIME).astype(np.int64)
+    return _UNIX_BASETIME_JULIAN_DATE + (microseconds // 10**6) / 86400.0
+
+
+def solar_zenith_angles(frame_times):
+    '''
+    Calculate the solar zenith angles of an array of days since 1970-01-01,
+    the array form of solar_zenith_angle() with the same steps in float64.
+    '''
+    latitude = 33 + 4.47 / 60
+
+    time_dates        = _frame_datetimes(frame_times)
+    year_starts       = time_dates.astype('datetime64[Y]').astype(time_dates.dtype)
+    days_offset       = (time_dates - year_starts).astype(np.int64) + _MICROSECONDS_PER_DAY
+    numerical_cal_day = days_offset // _MICROSECONDS_PER_DAY +\
+                        (days_offset % _MICROSECONDS_PER_DAY // 10**6) / 86340.0
+
+    theta = 2 * pi * numerical_cal_day / 365
+
+    solar_decline    = 0.006918 - 0.399912 * np.cos(theta) +\
+                                  0.070257 * np.sin(theta) -\
+                                  0.006758 * np.cos(2 * theta) +\
+                                  0.000907 * np.sin(2 * theta) -\
+                                  0.002697 * np.cos(3 * theta) +\
+                                  0.001480 * np.sin(3 * theta)
+
+    cphase = np.cos(2 * pi * numerical_cal_day)
+    cos_solar_zen_ang = sin(radians(latitude)) * np.sin(solar_decline) -\
+                        cos(radians(latitude)) * np.cos(solar_decline) * cphase
+
+    return np.arccos(cos_solar_zen_ang) / pi * 180
+
+
 def pixel2Geographic(jsonFileLocation, headerFileLocation, cameraOption, downsampled=False):
 
     ######################### Load necessary data #########################
@@ -168,4 +236,41 @@ def pixel2Geographic(jsonFileLocation, headerFileLocation, cameraOption, downsam
                 "latitudes"    : lat_final_result,
                 "longitudes"   : lon_final_result,
                 "bounding_box" : bounding_box,
-                "Google_Map"   : bounding_box_mapview}
\ No newline at end of file
+                "Google_Map"   : bounding_box_mapview}
+
+def benchmark_solar_zenith_angles(num_frames=DEFAULT_BENCHMARK_FRAMES, first_day=DEFAULT_BENCHMARK_DAY):
+    '''
+    Time solar_zenith_angle() frame by frame against solar_zenith_angles()
+    on a scan of one frame per second, the way writeToNetCDF fills the
+    solar_zenith_angle variable.
+
+    Returns the seconds taken by each and the largest difference in degrees
+    '''
+    frame_times = first_day + np.arange(num_frames) / 86400.0
+
+    # The scalar version's Decimal arithmetic depends on the precision of the context
+    with localcontext(DefaultContext):
+        start = time.time()
+        scalar = np.array([solar_zenith_angle(datetime(year=1970, month=1, day=1) + timedelta(days=time_member))
+                           for time_member in frame_times])
+        scalar_seconds = time.time() - start
+
+    start = time.time()
+    vector = solar_zenith_angles(frame_times)
+    vector_seconds = time.time() - start
+
+    return scalar_seconds, vector_seconds, float(np.max(np.abs(scalar - vector)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks calculating solar zenith angles frame by frame and '
+                                                 'over a whole scan')
+    parser.add_argument('-n', '--frames', type=int, default=DEFAULT_BENCHMARK_FRAMES,
+                        help='number of frames in the scan (default %s)' % str(DEFAULT_BENCHMARK_FRAMES))
+    parser.add_argument('-d', '--day', type=float, default=DEFAULT_BENCHMARK_DAY,
+                        help='days since 1970-01-01 of the first frame (default %s)' % str(DEFAULT_BENCHMARK_DAY))
+    args = parser.parse_args()
+
+    scalar_seconds, vector_seconds, difference = benchmark_solar_zenith_angles(args.frames, args.day)
+    print("%d frames: %.4fs frame by frame, %.4fs over the scan (%.0fx), largest difference %.3g degrees" %
+          (args.frames, scalar_seconds, vector_seconds, scalar_seconds / max(vector_seconds, 1e-9), difference))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+from datetime import datetime, timedelta
+from decimal import localcontext, DefaultContext
+import numpy as np
+
+import hyperspectral_calculation
+
+'''
+Test for hyperspectral_calculation
+
+Checks that the array versions of the solar geometry calculations match the versions that take one datetime.
+
+==============================================================================
+To run the test from the commandline, do:
+python hyperspectral_calculation_test.py
+'''
+
+# Frame times, in days since 1970-01-01, from whole seconds across several years including leap years
+WHOLE_SECOND_FRAME_TIMES = (np.arange(-400, 20000, 37) * 86400.0 + np.arange(552) * 7919 % 86400) / 86400.0
+
+# Frame times that aren't whole seconds, and frames at the edges of days and years
+OTHER_FRAME_TIMES = np.array([0.0, -1.0e-9, 1.0 - 1.0e-12, 10957.0, 11016.99999, 17167.5, 17289.123456789])
+
+# The largest difference allowed between the zenith angles, in degrees
+ZENITH_TOLERANCE = 1.0e-9
+
+# The largest difference allowed between the Julian Dates; _julian_date() rounds the fraction of the day to 8 digits
+JULIAN_DATE_TOLERANCE = 1.0e-7
+
+
+class HyperspectralCalculationTest(unittest.TestCase):
+
+    @staticmethod
+    def to_datetime(frame_time):
+        '''Converts a frame time to a datetime the way writeToNetCDF used to'''
+        return datetime(year=1970, month=1, day=1) + timedelta(days=float(frame_time))
+
+    def testSolarZenithAnglesMatchOneFrameAtATime(self):
+        for frame_times in (WHOLE_SECOND_FRAME_TIMES, OTHER_FRAME_TIMES):
+            # The scalar version's Decimal arithmetic depends on the precision of the context
+            with localcontext(DefaultContext):
+                expected = [hyperspectral_calculation.solar_zenith_angle(self.to_datetime(one_time))
+                            for one_time in frame_times]
+            np.testing.assert_allclose(hyperspectral_calculation.solar_zenith_angles(frame_times), expected,
+                                       rtol=0, atol=ZENITH_TOLERANCE)
+
+    def testJulianDatesMatchOneFrameAtATime(self):
+        for frame_times in (WHOLE_SECOND_FRAME_TIMES, OTHER_FRAME_TIMES):
+            with localcontext(DefaultContext):
+                expected = [hyperspectral_calculation._julian_date(self.to_datetime(one_time))
+                            for one_time in frame_times]
+            np.testing.assert_allclose(hyperspectral_calculation.julian_dates(frame_times), expected,
+                                       rtol=0, atol=JULIAN_DATE_TOLERANCE)
+
+    def testJulianDateOfUnixBaseTime(self):
+        self.assertEqual(hyperspectral_calculation.julian_dates(np.array([0.0]))[0], 2440587.5)
+
+    def testBenchmarkAgrees(self):
+        _, _, difference = hyperspectral_calculation.benchmark_solar_zenith_angles(500)
+        self.assertLessEqual(difference, ZENITH_TOLERANCE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""Compresses netCDF variables by deflating their chunks on a pool of threads
+
+Run this file to compress a netCDF file in the same way as the workflow's "ncks -L dfl_lvl"
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import logging
+import os
+import zlib
+import h5py
+import numpy as np
+from netCDF4 import Dataset
+
+# The default number of threads compressing chunks
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+# The number of compressed chunks waiting to be written per thread before more chunks are queued
+QUEUED_CHUNKS_PER_WORKER = 4
+
+# Variables smaller than this number of bytes are compressed by the netCDF library instead of the threads
+MIN_PARALLEL_BYTES = 4 * 1024 * 1024
+
+# The default maximum number of bytes of a variable read at one time when compressing a file
+DEFAULT_READ_BYTES = 64 * 1024 * 1024
+
+
+def shuffle_bytes(chunk: np.ndarray) -> np.ndarray:
+    """Applies the shuffle filter to a chunk
+    Arguments:
+        chunk: the C contiguous values of a complete chunk
+    Return:
+        Returns the shuffled bytes: the first byte of every value, then the second byte, and so on
+    """
+    return np.ascontiguousarray(chunk.view(np.uint8).reshape(-1, chunk.dtype.itemsize).T)
+
+
+def encode_chunk(chunk: np.ndarray, level: int, shuffle: bool) -> bytes:
+    """Applies the HDF5 shuffle and deflate filters to a chunk
+    Arguments:
+        chunk: the C contiguous values of a complete chunk
+        level: the deflate level
+        shuffle: whether the bytes of the values are shuffled before deflating
+    Return:
+        Returns the filtered bytes, as stored in the file
+    """
+    if shuffle and chunk.dtype.itemsize > 1:
+        data = shuffle_bytes(chunk)
+    else:
+        data = chunk.view(np.uint8).reshape(-1)
+    # Copying arrays and deflating release the interpreter lock, letting the threads run at the same time
+    return zlib.compress(data, level)
+
+
+class ChunkWriter():
+    """Compresses chunks of an HDF5 dataset on a pool of threads and writes them in order
+    """
+
+    def __init__(self, dataset: h5py.Dataset, workers: int = DEFAULT_WORKERS):
+        """Initializes class instance
+        Arguments:
+            dataset: the chunked dataset to write; its filters must be deflate, optionally preceded by shuffle
+            workers: the number of threads compressing chunks
+        Exceptions:
+            Raises RuntimeError if the dataset has other filters
+        """
+        if dataset.compression != 'gzip' or dataset.fletcher32 or dataset.scaleoffset is not None:
+            raise RuntimeError("Unable to compress chunks of %s, its filters are not supported" % dataset.name)
+        self.dataset = dataset
+        self.level = dataset.compression_opts
+        self.shuffle = dataset.shuffle
+        self.chunks = dataset.chunks
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers))
+        self.max_queued = max(1, workers) * QUEUED_CHUNKS_PER_WORKER
+        self.queued = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(exc_type is None)
+
+    def write_slab(self, start: tuple, values: np.ndarray) -> None:
+        """Queues the chunks covering a region of the dataset for writing
+        Arguments:
+            start: the index of the first value of the region in each dimension; must be a multiple of the chunk size
+            values: the values of the region; each dimension must be a multiple of the chunk size unless the region
+                    reaches the end of the dataset in that dimension
+        Notes:
+            The values are copied before this returns so the caller can reuse the array
+        """
+        ranges = [range(0, size, chunk) for size, chunk in zip(values.shape, self.chunks)]
+        for offset in itertools.product(*ranges):
+            region = values[tuple(slice(first, first + chunk) for first, chunk in zip(offset, self.chunks))]
+            if region.shape == tuple(self.chunks):
+                chunk = np.array(region, dtype=self.dataset.dtype, order='C')
+            else:
+                # Edge chunks are stored whole, only the part inside the dataset is ever read
+                chunk = np.zeros(self.chunks, dtype=self.dataset.dtype)
+                chunk[tuple(slice(0, size) for size in region.shape)] = region
+            position = tuple(first + one_start for first, one_start in zip(offset, start))
+            self.queued.append((position, self.executor.submit(encode_chunk, chunk, self.level, self.shuffle)))
+            while len(self.queued) > self.max_queued:
+                self._write_next()
+
+    def _write_next(self) -> None:
+        """Writes the oldest queued chunk to the dataset, waiting for it to be compressed
+        """
+        position, future = self.queued.popleft()
+        self.dataset.id.write_direct_chunk(position, future.result())
+
+    def close(self, flush: bool = True) -> None:
+        """Writes the remaining chunks and stops the threads
+        Arguments:
+            flush: whether the queued chunks are written; False to discard them
+        """
+        while flush and self.queued:
+            self._write_next()
+        self.queued.clear()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def get_slab_axis(shape: tuple, chunks: tuple, itemsize: int, read_bytes: int) -> int:
+    """Returns the number of leading dimensions to read one chunk at a time so that a slab fits the read limit
+    Arguments:
+        shape: the shape of the variable
+        chunks: the chunk sizes of the variable
+        itemsize: the number of bytes of each value
+        read_bytes: the maximum number of bytes to read at one time
+    Return:
+        Returns the number of leading dimensions; the slab covers one chunk of each of them and all of the others
+    """
+    for axis in range(len(shape) + 1):
+        slab_shape = tuple(chunks[:axis]) + tuple(shape[axis:])
+        if int(np.prod(slab_shape)) * itemsize <= read_bytes:
+            return axis
+    return len(shape)
+
+
+def compress_variable(src_variable, dataset: h5py.Dataset, workers: int, read_bytes: int) -> None:
+    """Compresses the values of a netCDF variable into an HDF5 dataset, a slab at a time
+    Arguments:
+        src_variable: the netCDF variable to read
+        dataset: the dataset to write, with the filters set up
+        workers: the number of threads compressing chunks
+        read_bytes: the maximum number of bytes to read at one time
+    """
+    shape = src_variable.shape
+    chunks = dataset.chunks
+    axis = get_slab_axis(shape, chunks, dataset.dtype.itemsize, read_bytes)
+    with ChunkWriter(dataset, workers) as writer:
+        for offset in itertools.product(*[range(0, size, chunk) for size, chunk in zip(shape[:axis], chunks[:axis])]):
+            slab = tuple(slice(first, first + chunk) for first, chunk in zip(offset, chunks)) + \
+                   tuple(slice(None) for _ in shape[axis:])
+            writer.write_slab(tuple(offset) + (0,) * (len(shape) - axis), src_variable[slab])
+
+
+def copy_variable(src_variable, dst_variable, read_bytes: int) -> None:
+    """Copies the values of a netCDF variable through the netCDF library, a slab at a time
+    Arguments:
+        src_variable: the netCDF variable to read
+        dst_variable: the netCDF variable to write
+        read_bytes: the maximum number of bytes to read at one time
+    Notes:
+        Slabs cover whole chunks of the variable being written, so each of its chunks is only compressed once. Variable
+        length values are copied all at once
+    """
+    shape = src_variable.shape
+    if not shape:
+        # Scalar variable length values can only be assigned by index
+        dst_variable[0] = src_variable[0]
+        return
+    chunking = dst_variable.chunking()
+    if not isinstance(src_variable.datatype, np.dtype) or not isinstance(chunking, list) or not all(shape):
+        dst_variable[:] = src_variable[:]
+        return
+
+    axis = get_slab_axis(shape, chunking, src_variable.datatype.itemsize, read_bytes)
+    for offset in itertools.product(*[range(0, size, chunk) for size, chunk in zip(shape[:axis], chunking[:axis])]):
+        slab = tuple(slice(first, first + chunk) for first, chunk in zip(offset, chunking)) + \
+               tuple(slice(None) for _ in shape[axis:])
+        dst_variable[slab] = src_variable[slab]
+
+
+def can_compress(variable) -> bool:
+    """Returns whether the deflate filter can be applied to a netCDF variable
+    Arguments:
+        variable: the netCDF variable
+    Return:
+        Returns True for variables with dimensions and fixed size values
+    """
+    return len(variable.dimensions) > 0 and isinstance(variable.datatype, np.dtype)
+
+
+def copy_group(src_group, dst_group, level: int, workers: int, shuffle: bool,
+               read_bytes: int = DEFAULT_READ_BYTES) -> list:
+    """Copies a netCDF group, its variables and its subgroups, compressing the variables that can be compressed
+    Arguments:
+        src_group: the netCDF group or dataset to copy
+        dst_group: the empty netCDF group or dataset to copy to
+        level: the deflate level [1..9]
+        workers: the number of threads compressing chunks
+        shuffle: whether to apply the shuffle filter before deflating
+        read_bytes: the maximum number of bytes of a variable to read at one time
+    Return:
+        Returns the paths of the variables created without their values, to be compressed on the threads
+    """
+    parallel_paths = []
+    dst_group.setncatts(src_group.__dict__)
+    for name, dimension in src_group.dimensions.items():
+        dst_group.createDimension(name, (len(dimension) if not dimension.isunlimited() else None))
+
+    for name, variable in src_group.variables.items():
+        attributes = variable.__dict__
+        fill_value = attributes.pop('_FillValue', None)
+        options = {}
+        if can_compress(variable):
+            chunking = variable.chunking()
+            options = {'zlib': True, 'complevel': level, 'shuffle': shuffle,
+                       'chunksizes': chunking if isinstance(chunking, list) else None}
+        dst_variable = dst_group.createVariable(name, variable.datatype, variable.dimensions, fill_value=fill_value,
+                                                **options)
+        dst_variable.setncatts(attributes)
+
+        parallel = bool(options) and workers > 1 and variable.size * variable.datatype.itemsize >= MIN_PARALLEL_BYTES \
+            and not any(one_dim.isunlimited() for one_dim in variable.get_dims())
+        if parallel:
+            parallel_paths.append(src_group.path.rstrip('/') + '/' + name)
+            continue
+        variable.set_auto_maskandscale(False)
+        dst_variable.set_auto_maskandscale(False)
+        logging.debug("Compressing %s", name)
+        copy_variable(variable, dst_variable, read_bytes)
+
+    for name, subgroup in src_group.groups.items():
+        parallel_paths.extend(copy_group(subgroup, dst_group.createGroup(name), level, workers, shuffle, read_bytes))
+    return parallel_paths
+
+
+def compress_file(in_filename: str, out_filename: str, level: int, workers: int = DEFAULT_WORKERS,
+                  shuffle: bool = True, read_bytes: int = DEFAULT_READ_BYTES) -> str:
+    """Writes a copy of a netCDF file with its variables deflated
+    Arguments:
+        in_filename: the path of the file to compress
+        out_filename: the path of the compressed file to create
+        level: the deflate level [1..9], the same as the workflow's dfl_lvl
+        workers: the number of threads compressing chunks
+        shuffle: whether to apply the shuffle filter before deflating, as the NCO tools do by default
+        read_bytes: the maximum number of bytes of a variable to read at one time
+    Return:
+        Returns the path of the compressed file
+    Notes:
+        The file structure and small variables are written by the netCDF library, group by group. Large variables are
+        then written one compressed chunk at a time, so the file remains a netCDF file. Variables along an unlimited
+        dimension, and all variables when there's one thread, are written by the netCDF library in slabs of whole
+        chunks; either way no more than read_bytes of a variable is read at one time. Scalar and variable length
+        variables aren't compressed, and existing chunk sizes are kept
+    Exceptions:
+        Raises RuntimeError if the level is out of range
+    """
+    if not 1 <= level <= 9:
+        raise RuntimeError("Deflate level %s is not in the range 1 to 9" % str(level))
+
+    with Dataset(in_filename) as src, Dataset(out_filename, 'w', format='NETCDF4') as dst:
+        parallel_paths = copy_group(src, dst, level, workers, shuffle, read_bytes)
+
+    if parallel_paths:
+        with Dataset(in_filename) as src, h5py.File(out_filename, 'r+') as dst:
+            for path in parallel_paths:
+                logging.debug("Compressing %s on %s threads", path, str(workers))
+                src[path].set_auto_maskandscale(False)
+                compress_variable(src[path], dst[path], workers, read_bytes)
+
+    return out_filename
+
+
+def compress_in_place(filename: str, level: int, workers: int = DEFAULT_WORKERS,
+                      read_bytes: int = DEFAULT_READ_BYTES) -> str:
+    """Compresses a netCDF file, replacing it with the compressed file
+    Arguments:
+        filename: the path of the file to compress
+        level: the deflate level [1..9], the same as the workflow's dfl_lvl
+        workers: the number of threads compressing chunks
+        read_bytes: the maximum number of bytes of a variable to read at one time
+    Return:
+        Returns the path of the file
+    """
+    temp_filename = filename + '.cmp.tmp'
+    try:
+        compress_file(filename, temp_filename, level, workers, read_bytes=read_bytes)
+    except Exception:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+    os.replace(temp_filename, filename)
+    return filename
+
+
+def main() -> None:
+    """Compresses a netCDF file
+    """
+    parser = argparse.ArgumentParser(description='Compresses a netCDF file with the deflate filter on several threads')
+    parser.add_argument('-L', '--level', type=int, required=True, choices=range(1, 10), help='deflate level')
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help='number of compressing threads (default %s)' % str(DEFAULT_WORKERS))
+    parser.add_argument('--no_shuffle', action='store_true', help='do not shuffle the bytes of values before deflating')
+    parser.add_argument('in_file', help='the netCDF file to compress')
+    parser.add_argument('out_file', help='the compressed netCDF file to create')
+    args = parser.parse_args()
+
+    compress_file(args.in_file, args.out_file, args.level, args.workers, not args.no_shuffle)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from netCDF4 import Dataset
+
+import hyperspectral_compress
+
+'''
+Test for hyperspectral_compress
+
+Builds a small netCDF file with nested groups, compresses it in place and checks that the groups, dimensions,
+variables, attributes and values are the same afterwards.
+
+==============================================================================
+To run the test from the commandline, do:
+python hyperspectral_compress_test.py
+'''
+
+
+class HyperspectralCompressTest(unittest.TestCase):
+
+    def setUp(self):
+        '''
+        Create the file to compress
+        '''
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'groups.nc')
+        with Dataset(self.filename, 'w', format='NETCDF4') as dataset:
+            dataset.setncatts({'title': 'compression test', 'history': 'created by the test'})
+            dataset.createDimension('wavelength', 4)
+            dataset.createDimension('time', None)
+            wavelength = dataset.createVariable('wavelength', 'f8', ('wavelength',))
+            wavelength.units = 'meter'
+            wavelength[:] = np.arange(4) * 1.0e-7
+            frametime = dataset.createVariable('frametime', 'f8', ('time',))
+            frametime[:] = np.arange(3) / 86400.0
+
+            gantry = dataset.createGroup('gantry_system_variable_metadata')
+            gantry.setncatts({'long_name': 'Gantry System Variable Metadata'})
+            speed = gantry.createVariable('scanSpeedInMPerS', 'f8')
+            speed.units = 'meter second-1'
+            speed[...] = 0.04
+
+            sensor = dataset.createGroup('sensor_variable_metadata')
+            sensor.createDimension('x', 300)
+            sensor.createDimension('y', 1200)
+            # Large enough to be compressed on the threads
+            cube = sensor.createVariable('rfl_img', 'f4', ('wavelength', 'y', 'x'), fill_value=np.float32(1e36),
+                                         chunksizes=(1, 100, 300))
+            cube.long_name = 'Reflectance'
+            cube[:] = np.arange(4 * 1200 * 300, dtype=np.float32).reshape((4, 1200, 300)) / 1000.0
+            # Variables along an unlimited dimension are always compressed by the netCDF library
+            sensor.createDimension('frame', None)
+            frames = sensor.createVariable('frame_exposure', 'f4', ('frame', 'x'), chunksizes=(100, 300))
+            frames[:] = np.arange(2000 * 300, dtype=np.float32).reshape((2000, 300))
+            nested = sensor.createGroup('exposure')
+            nested.setncatts({'notes': 'a nested group'})
+            exposure = nested.createVariable('exposure', 'i4', ('wavelength',))
+            exposure[:] = [10, 20, 30, 40]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def describe(group):
+        '''Returns the groups, dimensions, variables and attributes of a group and its subgroups'''
+        return {'attributes': {key: np.asarray(value).tolist() for key, value in group.__dict__.items()},
+                'dimensions': {name: (len(one_dim), one_dim.isunlimited()) for name, one_dim in group.dimensions.items()},
+                'variables': {name: (str(variable.dtype), variable.dimensions,
+                                     {key: np.asarray(value).tolist() for key, value in variable.__dict__.items()})
+                              for name, variable in group.variables.items()},
+                'groups': {name: HyperspectralCompressTest.describe(subgroup)
+                           for name, subgroup in group.groups.items()}}
+
+    @staticmethod
+    def read_values(group, values=None, path=''):
+        '''Returns the values of the variables of a group and its subgroups by their path'''
+        values = {} if values is None else values
+        for name, variable in group.variables.items():
+            values[path + '/' + name] = variable[...]
+        for name, subgroup in group.groups.items():
+            HyperspectralCompressTest.read_values(subgroup, values, path + '/' + name)
+        return values
+
+    def testGroupsAndAttributesAreKept(self):
+        with Dataset(self.filename) as dataset:
+            expected = self.describe(dataset)
+        hyperspectral_compress.compress_in_place(self.filename, 1, 4)
+        with Dataset(self.filename) as dataset:
+            self.assertEqual(self.describe(dataset), expected)
+
+    def testValuesAreKept(self):
+        with Dataset(self.filename) as dataset:
+            expected = self.read_values(dataset)
+        hyperspectral_compress.compress_in_place(self.filename, 4, 2)
+        with Dataset(self.filename) as dataset:
+            values = self.read_values(dataset)
+            self.assertEqual(dataset['sensor_variable_metadata/rfl_img'].filters()['complevel'], 4)
+        self.assertEqual(sorted(values), sorted(expected))
+        for path, value in expected.items():
+            np.testing.assert_array_equal(values[path], value, err_msg=path)
+
+    def testOneWorkerReadsInSlabs(self):
+        with Dataset(self.filename) as dataset:
+            expected = self.read_values(dataset)
+            shapes = [dataset['sensor_variable_metadata/' + name].shape for name in ('rfl_img', 'frame_exposure')]
+        read_bytes = 256 * 1024
+        slabs = []
+        original = hyperspectral_compress.get_slab_axis
+
+        def get_slab_axis(shape, chunks, itemsize, max_bytes):
+            '''Records the shape of each variable and the number of bytes of its slabs'''
+            axis = original(shape, chunks, itemsize, max_bytes)
+            slabs.append((tuple(shape), int(np.prod(tuple(chunks[:axis]) + tuple(shape[axis:]))) * itemsize))
+            return axis
+
+        with mock.patch.object(hyperspectral_compress, 'get_slab_axis', side_effect=get_slab_axis):
+            hyperspectral_compress.compress_in_place(self.filename, 1, 1, read_bytes)
+
+        # Both variables are larger than the read limit and are read a slab at a time
+        for shape in shapes:
+            self.assertGreater(int(np.prod(shape)) * 4, read_bytes)
+            self.assertIn(shape, [one_shape for one_shape, _ in slabs])
+        for _, slab_bytes in slabs:
+            self.assertLessEqual(slab_bytes, read_bytes)
+        with Dataset(self.filename) as dataset:
+            values = self.read_values(dataset)
+        for path, value in expected.items():
+            np.testing.assert_array_equal(values[path], value, err_msg=path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+"""Converts ENVI RAW files to the netCDF xps_img variable, in place of the translation step of the workflow script
+"""
+
+import logging
+from typing import Optional
+import numpy as np
+from netCDF4 import Dataset
+import h5py
+import spectral.io.envi as envi
+import hyperspectral_compress
+import hyperspectral_storage
+
+# The name of the variable holding the raw image values and its (wavelength, y, x) dimensions
+XPS_IMG_NAME = 'xps_img'
+XPS_IMG_DIMENSIONS = ('wavelength', 'y', 'x')
+
+# The numpy data types of the netCDF output types accepted by the workflow script
+OUTPUT_TYPES = {
+    'NC_USHORT': np.uint16,
+    'NC_SHORT': np.int16,
+    'NC_UINT': np.uint32,
+    'NC_INT': np.int32,
+    'NC_FLOAT': np.float32
+}
+
+# The output type used by the workflow script when one isn't specified
+DEFAULT_OUTPUT_TYPE = 'NC_USHORT'
+
+# The default size, in megabytes, of the buffer used to move scan lines from the RAW file to the netCDF file
+DEFAULT_BUFFER_MB = 64
+
+# The maximum number of bands in a chunk of xps_img
+CHUNK_BANDS = 32
+
+MEGABYTE = 1024 * 1024
+
+
+def get_buffer_lines(num_lines: int, num_samples: int, num_bands: int, itemsize: int, buffer_memory: int) -> int:
+    """Returns the number of scan lines that fit in the conversion buffer
+    Arguments:
+        num_lines: the number of scan lines in the image
+        num_samples: the number of samples in each scan line
+        num_bands: the number of bands in the image
+        itemsize: the number of bytes of each value
+        buffer_memory: the size of the buffer in bytes
+    Return:
+        Returns the number of scan lines, which is at least one and at most the number of lines in the image
+    """
+    return int(max(1, min(num_lines, buffer_memory // max(1, num_samples * num_bands * itemsize))))
+
+
+class XpsImage():
+    """The xps_img variable of a converted file, indexed like the (lines, samples, bands) memory map of its RAW file
+    """
+
+    def __init__(self, variable, bands: Optional[range] = None):
+        """Initializes the image
+        Arguments:
+            variable: the xps_img netCDF variable with XPS_IMG_DIMENSIONS dimensions
+            bands: optional range of the bands of the variable in the image; all bands when None
+        Notes:
+            The values are read as they are stored, without masking the netCDF fill value, to match the RAW file. The
+            chunk cache of a compressed variable holds a row of chunks across all bands so that chunks only partly
+            covered by a block of scan lines are decompressed once
+        """
+        self.variable = variable
+        self.bands = range(variable.shape[0]) if bands is None else bands
+        variable.set_auto_maskandscale(False)
+        chunking = variable.chunking()
+        if bands is None and isinstance(chunking, list) and variable.filters().get('zlib'):
+            variable.set_var_chunk_cache(size=int(np.prod(variable.shape[:1] + tuple(chunking[1:]))) *
+                                         variable.dtype.itemsize)
+
+    @property
+    def shape(self) -> tuple:
+        """Returns the number of scan lines, samples and bands of the image"""
+        return (self.variable.shape[1], self.variable.shape[2], len(self.bands))
+
+    @property
+    def dtype(self) -> np.dtype:
+        """Returns the data type of the values"""
+        return self.variable.dtype
+
+    def __getitem__(self, key):
+        """Reads the values of scan lines, or returns the image of a slice of the bands when only bands are indexed
+        Arguments:
+            key: the slices of the scan lines, samples and bands to index
+        Return:
+            Returns the (lines, samples, bands) values read from the variable, or an XpsImage of the bands
+        """
+        key = (key if isinstance(key, tuple) else (key,)) + (slice(None),) * 2
+        lines, samples, bands = key[:3]
+        bands = self.bands[bands]
+        if lines == slice(None) and samples == slice(None):
+            return XpsImage(self.variable, bands)
+        values = self.variable[slice(bands.start, bands.stop, bands.step), lines, samples]
+        return np.transpose(values, (1, 2, 0))
+
+    def __array__(self, dtype=None) -> np.ndarray:
+        """Reads all the values of the image"""
+        return np.asarray(self[0:self.shape[0]], dtype=dtype)
+
+
+def convert_raw(raw_filename: str, out_filename: str, output_type: str = DEFAULT_OUTPUT_TYPE,
+                compression_level: int = 0, buffer_memory: int = DEFAULT_BUFFER_MB * MEGABYTE,
+                chunk_policy: Optional[str] = None,
+                workers: int = hyperspectral_compress.DEFAULT_WORKERS) -> str:
+    """Writes the values of a RAW file to the xps_img variable of a new netCDF file
+    Arguments:
+        raw_filename: the path to the RAW file; its header is expected to be next to it with a '.hdr' extension
+        out_filename: the path of the netCDF file to create
+        output_type: the netCDF type of xps_img; one of the keys of OUTPUT_TYPES
+        compression_level: the zlib compression level of xps_img; zero to not compress
+        buffer_memory: the size of the buffer, in bytes, used to move scan lines from the RAW file to the netCDF file
+        chunk_policy: optional chunking policy of xps_img, one of hyperspectral_storage.CHUNK_POLICIES; chunks never
+                      span more scan lines than are buffered so that each block writes whole chunks
+        workers: the number of threads compressing xps_img chunks; with one thread the netCDF library compresses
+    Return:
+        Returns the path of the netCDF file
+    Notes:
+        The RAW file is read sequentially, one block of scan lines at a time, so that each byte is only read once by
+        the conversion and the memory used doesn't depend on the size of the image. The variable is written in band
+        sequential order, matching the default interleave of the workflow script. The calibration reads the values
+        back from the netCDF file through XpsImage instead of reading the RAW file again
+    Exceptions:
+        Raises RuntimeError if the output type or chunking policy isn't supported
+    """
+    if output_type not in OUTPUT_TYPES:
+        raise RuntimeError("Unsupported xps_img output type '%s'" % output_type)
+
+    raw = envi.open(raw_filename + '.hdr', raw_filename)
+    # Scan lines of band interleaved by line files are contiguous in the file
+    img_dn = raw.open_memmap(interleave='bil')
+    num_lines, num_bands, num_samples = img_dn.shape
+
+    block_lines = get_buffer_lines(num_lines, num_samples, num_bands, img_dn.dtype.itemsize, buffer_memory)
+    if chunk_policy:
+        chunk_sizes = hyperspectral_storage.get_chunk_sizes(chunk_policy, (num_bands, num_lines, num_samples),
+                                                            np.dtype(OUTPUT_TYPES[output_type]).itemsize, block_lines)
+        block_lines = hyperspectral_storage.get_aligned_lines(block_lines, chunk_sizes)
+    else:
+        chunk_sizes = (min(num_bands, CHUNK_BANDS), block_lines, num_samples)
+    buffer = np.empty((num_bands, block_lines, num_samples), dtype=img_dn.dtype)
+    logging.debug("Converting %s to %s using %s scan lines at a time", raw_filename, out_filename, str(block_lines))
+
+    def read_blocks():
+        """Yields the index of the first scan line and the buffered block of raw values"""
+        for first_line in range(0, num_lines, block_lines):
+            last_line = min(first_line + block_lines, num_lines)
+            block = buffer[:, :last_line - first_line, :]
+            np.copyto(block, np.transpose(img_dn[first_line:last_line], (1, 0, 2)))
+            yield first_line, block
+
+    parallel = compression_level > 0 and workers > 1
+    with Dataset(out_filename, 'w', format='NETCDF4') as dst:
+        for name, size in zip(XPS_IMG_DIMENSIONS, (num_bands, num_lines, num_samples)):
+            dst.createDimension(name, size)
+        variable = dst.createVariable(XPS_IMG_NAME, OUTPUT_TYPES[output_type], XPS_IMG_DIMENSIONS,
+                                      zlib=compression_level > 0, complevel=max(compression_level, 1),
+                                      chunksizes=chunk_sizes)
+        if not parallel:
+            for first_line, block in read_blocks():
+                variable[:, first_line:first_line + block.shape[1], :] = block
+
+    if parallel:
+        # Blocks start on chunk boundaries, letting their chunks be compressed on threads and written directly
+        logging.debug("Compressing %s on %s threads", XPS_IMG_NAME, str(workers))
+        with h5py.File(out_filename, 'r+') as dst, \
+                hyperspectral_compress.ChunkWriter(dst[XPS_IMG_NAME], workers) as writer:
+            for first_line, block in read_blocks():
+                writer.write_slab((0, first_line, 0), block)
+
+    del img_dn
+    return out_filename
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""Runs the hyperspectral transformer as a long running worker that processes capture jobs from a spool folder or a
+Unix socket, keeping calibration models and EnvironmentLogger data loaded between captures
+
+A job is a JSON document with the following keys:
+    files: the list of files of the capture (the RAW file and its header)
+    timestamp: the ISO 8601 timestamp of the capture
+    working_folder: the folder to write the resulting files to
+    args: optional dictionary of transformer arguments (eg., "environment_logger") that override the daemon's values;
+          the values are checked against the transformer's parameters, with switches given as true or false and
+          arguments taking several values given as lists
+
+Spool folder jobs are files ending in ".job.json". They are renamed to end in ".job.working" while being processed and
+the result is written next to them in a file ending in ".result.json". Jobs whose result can't be written are renamed
+to end in ".job.failed" so that they're kept without being processed again. Socket jobs are sent as one line of JSON and the
+result is returned as one line of JSON. Results have the same contents as returned by transformer.perform_process()
+"""
+
+import argparse
+import copy
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import stat
+import tempfile
+import threading
+from typing import Optional
+
+import transformer
+import transformer_class
+
+# The endings of the names of spool folder files
+JOB_SUFFIX = '.job.json'
+CLAIMED_SUFFIX = '.job.working'
+RESULT_SUFFIX = '.result.json'
+FAILED_SUFFIX = '.job.failed'
+
+# The default number of seconds between checks of the spool folder for new jobs
+DEFAULT_POLL_SECONDS = 2.0
+
+# The default number of parsed EnvironmentLogger files to keep in memory between jobs
+DEFAULT_ENVLOG_MEMORY_FILES = 8
+
+# How the JSON values of job arguments are described in errors, by the type of the argument
+VALUE_DESCRIPTIONS = {int: 'an integer', float: 'a number', str: 'a string', bool: 'true or false'}
+
+
+def check_value(action: argparse.Action, value):
+    """Returns one value of a job's transformer argument, checked and converted the way the command line is
+    Arguments:
+        action: the parser action of the argument
+        value: the value from the job
+    Return:
+        Returns the value converted to the argument's type
+    Exceptions:
+        Raises ValueError if the value isn't of the argument's type or isn't one of its choices
+    """
+    convert = action.type or str
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        valid = False
+    elif convert is float:
+        valid = isinstance(value, (int, float))
+        value = float(value) if valid else value
+    elif convert is int:
+        valid = isinstance(value, int)
+    elif convert is str:
+        valid = isinstance(value, str)
+    else:
+        # Other argument types are parsed from their command line strings
+        valid = isinstance(value, str)
+        if valid:
+            try:
+                value = convert(value)
+            except (ValueError, TypeError, argparse.ArgumentTypeError) as ex:
+                raise ValueError("Transformer argument '%s' value is invalid: %s" % (action.dest, str(ex))) from ex
+    if not valid:
+        raise ValueError("Transformer argument '%s' needs %s instead of %s" %
+                         (action.dest, VALUE_DESCRIPTIONS.get(convert, 'a string'), json.dumps(value)))
+
+    if action.choices is not None and value not in action.choices:
+        raise ValueError("Transformer argument '%s' value %s is not one of %s" %
+                         (action.dest, json.dumps(value), ', '.join([str(one) for one in action.choices])))
+    return value
+
+
+def check_argument(action: argparse.Action, value):
+    """Returns a job's transformer argument, checked and converted the way the command line is
+    Arguments:
+        action: the parser action of the argument
+        value: the value from the job; a list for arguments taking several values and a boolean for switches
+    Return:
+        Returns the value converted to the argument's type
+    Exceptions:
+        Raises ValueError if the value isn't valid for the argument
+    """
+    if value is None and action.default is None:
+        return None
+    if action.nargs == 0:
+        # Switches such as "store_true" don't take a value on the command line
+        if not isinstance(value, bool):
+            raise ValueError("Transformer argument '%s' needs to be true or false" % action.dest)
+        return value
+    if action.nargs in (None, '?'):
+        return check_value(action, value)
+
+    if not isinstance(value, list):
+        raise ValueError("Transformer argument '%s' needs a list of values" % action.dest)
+    if (isinstance(action.nargs, int) and len(value) != action.nargs) or (action.nargs == '+' and not value):
+        raise ValueError("Transformer argument '%s' has the wrong number of values: %s" %
+                         (action.dest, str(len(value))))
+    values = [check_value(action, one_value) for one_value in value]
+    if isinstance(action, transformer.RangeAction):
+        try:
+            transformer.RangeAction.check_range(values)
+        except ValueError as ex:
+            raise ValueError("Transformer argument '%s' value is invalid: %s" % (action.dest, str(ex))) from ex
+    return values
+
+
+def check_default_type(name: str, value, default):
+    """Returns the value of a job's argument that isn't a transformer parameter, checked against its default
+    Arguments:
+        name: the name of the argument
+        value: the value from the job
+        default: the daemon's value of the argument
+    Return:
+        Returns the value
+    Exceptions:
+        Raises ValueError if the value doesn't have the type of the default
+    """
+    if default is None or value is None:
+        return value
+    if isinstance(default, float) and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if type(value) is not type(default):
+        raise ValueError("Argument '%s' needs %s instead of %s" %
+                         (name, VALUE_DESCRIPTIONS.get(type(default), 'a %s' % type(default).__name__),
+                          json.dumps(value)))
+    return value
+
+
+class JobRunner():
+    """Runs capture jobs through the transformer one at a time
+    """
+
+    def __init__(self, default_args: argparse.Namespace):
+        """Initializes class instance
+        Arguments:
+            default_args: the transformer arguments to use when a job doesn't override them
+        """
+        self.default_args = default_args
+        self.lock = threading.Lock()
+        # The transformer's own parser is used to check the arguments jobs override
+        parser = argparse.ArgumentParser(add_help=False)
+        transformer.add_parameters(parser)
+        self.actions = {action.dest: action for action in parser._actions}  # pylint: disable=protected-access
+
+    def get_job_args(self, job: dict) -> argparse.Namespace:
+        """Returns the transformer arguments for a job
+        Arguments:
+            job: the job to get the arguments for
+        Return:
+            Returns the arguments with any overrides from the job applied
+        Exceptions:
+            Raises ValueError if the job specifies an unknown argument or a value the argument doesn't accept
+        """
+        args = copy.copy(self.default_args)
+        for name, value in job.get('args', {}).items():
+            if not hasattr(args, name):
+                raise ValueError("Unknown transformer argument '%s'" % name)
+            if name in self.actions:
+                value = check_argument(self.actions[name], value)
+            else:
+                value = check_default_type(name, value, getattr(args, name))
+            setattr(args, name, value)
+        return args
+
+    def run(self, job: dict) -> dict:
+        """Processes a job
+        Arguments:
+            job: the job to process
+        Return:
+            Returns the result of processing
+        """
+        try:
+            files = list(job['files'])
+            check_md = {'list_files': lambda: files,
+                        'timestamp': job['timestamp'],
+                        'working_folder': job['working_folder']
+                        }
+            args = self.get_job_args(job)
+        except (KeyError, TypeError, ValueError) as ex:
+            return {'code': -1005, 'error': "Invalid job: %s" % str(ex)}
+
+        instance = transformer_class.Transformer()
+        instance.args = args
+
+        with self.lock:
+            logging.info("Processing job for %s", str(files))
+            try:
+                return transformer.perform_process(instance, check_md, [], [])
+            except Exception as ex:
+                msg = "Exception caught while processing job: %s" % str(ex)
+                logging.exception(msg)
+                return {'code': -1006, 'error': msg}
+
+
+def write_result(result_filename: str, result: dict) -> None:
+    """Writes a job result so that it only appears once it's complete
+    Arguments:
+        result_filename: the path of the file to write
+        result: the result to write
+    """
+    out_handle, temp_filename = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(result_filename) or None)
+    try:
+        with os.fdopen(out_handle, 'w') as out_file:
+            json.dump(result, out_file, indent=2)
+        os.replace(temp_filename, result_filename)
+    except Exception:
+        os.remove(temp_filename)
+        raise
+
+
+def claim_job(job_filename: str) -> Optional[str]:
+    """Claims a spool folder job so that other workers don't process it
+    Arguments:
+        job_filename: the path of the job file
+    Return:
+        Returns the path of the claimed job file, or None if another worker claimed it first
+    """
+    claimed_filename = job_filename[:-len(JOB_SUFFIX)] + CLAIMED_SUFFIX
+    try:
+        os.rename(job_filename, claimed_filename)
+    except FileNotFoundError:
+        return None
+    return claimed_filename
+
+
+def process_spool(runner: JobRunner, spool_folder: str, stop: threading.Event) -> int:
+    """Processes the jobs waiting in the spool folder
+    Arguments:
+        runner: the job runner to use
+        spool_folder: the folder to look in for jobs
+        stop: event that's set when processing is to stop
+    Return:
+        Returns the number of jobs processed
+    """
+    num_jobs = 0
+    for one_file in sorted(os.listdir(spool_folder)):
+        if stop.is_set():
+            break
+        if not one_file.endswith(JOB_SUFFIX):
+            continue
+
+        claimed_filename = claim_job(os.path.join(spool_folder, one_file))
+        if not claimed_filename:
+            continue
+
+        try:
+            with open(claimed_filename, 'r') as in_file:
+                job = json.load(in_file)
+            result = runner.run(job) if isinstance(job, dict) else {'code': -1005, 'error': "Invalid job: not an object"}
+        except (OSError, ValueError) as ex:
+            result = {'code': -1005, 'error': "Unable to read job: %s" % str(ex)}
+
+        job_base = claimed_filename[:-len(CLAIMED_SUFFIX)]
+        try:
+            write_result(job_base + RESULT_SUFFIX, result)
+            os.remove(claimed_filename)
+        except (OSError, TypeError, ValueError):
+            # Keep the job for looking into, under a name that isn't claimed or picked up again
+            logging.exception("Unable to write the result of job '%s' with code %s", claimed_filename,
+                              str(result.get('code')))
+            try:
+                os.rename(claimed_filename, job_base + FAILED_SUFFIX)
+            except OSError:
+                logging.exception("Unable to rename the failed job '%s'", claimed_filename)
+        num_jobs += 1
+
+    return num_jobs
+
+
+class JobRequestHandler(socketserver.StreamRequestHandler):
+    """Handles a socket connection; each line received is a job and the result is sent back as a line
+    """
+
+    def handle(self):
+        """Processes the jobs sent over the connection
+        """
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                result = self.server.runner.run(job) if isinstance(job, dict) else \
+                    {'code': -1005, 'error': "Invalid job: not an object"}
+            except ValueError as ex:
+                result = {'code': -1005, 'error': "Unable to read job: %s" % str(ex)}
+            self.wfile.write((json.dumps(result) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+def start_socket_server(runner: JobRunner, socket_path: str) -> socketserver.ThreadingUnixStreamServer:
+    """Starts listening for jobs on a Unix socket in a background thread
+    Arguments:
+        runner: the job runner to use
+        socket_path: the path of the socket to create
+    Return:
+        Returns the running server
+    Exceptions:
+        Raises RuntimeError if something other than a stale socket is at the path
+    """
+    if os.path.lexists(socket_path):
+        if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            raise RuntimeError("Not replacing '%s' since it isn't a socket" % socket_path)
+        # Only a socket left behind by a daemon that stopped is removed; one that's listening refuses to be replaced
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+            except ConnectionRefusedError:
+                logging.info("Removing the stale socket '%s'", socket_path)
+                os.remove(socket_path)
+            else:
+                raise RuntimeError("Another process is already listening on '%s'" % socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, JobRequestHandler)
+    server.daemon_threads = True
+    server.runner = runner
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Listening for jobs on '%s'", socket_path)
+    return server
+
+
+def add_parameters(parser: argparse.ArgumentParser) -> None:
+    """Adds the daemon parameters
+    Arguments:
+        parser: instance of argparse.ArgumentParser
+    """
+    parser.add_argument('--spool', help='folder to check for job files')
+    parser.add_argument('--socket', help='path of the Unix socket to listen for jobs on')
+    parser.add_argument('--poll_seconds', type=float, default=DEFAULT_POLL_SECONDS,
+                        help='seconds between checks of the spool folder (default %s)' % str(DEFAULT_POLL_SECONDS))
+    parser.add_argument('--debug', action='store_true', help='enable debug logging')
+
+
+def main() -> None:
+    """Runs the daemon until it's terminated
+    """
+    parser = argparse.ArgumentParser(description='Hyperspectral transformer worker daemon')
+    add_parameters(parser)
+    transformer.add_parameters(parser)
+    parser.set_defaults(envlog_memory_files=DEFAULT_ENVLOG_MEMORY_FILES)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    if not args.spool and not args.socket:
+        parser.error("at least one of --spool or --socket must be specified")
+
+    runner = JobRunner(args)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+    try:
+        server = start_socket_server(runner, args.socket) if args.socket else None
+    except (OSError, RuntimeError) as ex:
+        logging.error("Unable to listen for jobs: %s", str(ex))
+        raise SystemExit(1) from ex
+    try:
+        while not stop.is_set():
+            if args.spool:
+                process_spool(runner, args.spool, stop)
+            stop.wait(args.poll_seconds)
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+            os.remove(args.socket)
+        logging.info("Stopped")
+
+
+if __name__ == "__main__":
+    main()
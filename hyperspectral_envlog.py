@@ -0,0 +1,500 @@
+"""Handling of EnvironmentLogger irradiance data for the hyperspectral transformer
+"""
+
+import calendar
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from typing import Optional
+import numpy as np
+
+# Change this value when the layout of the cached arrays changes so that older cache files are no longer used
+CACHE_VERSION = 3
+
+# The default maximum size, in megabytes, of the EnvironmentLogger cache folder
+DEFAULT_CACHE_SIZE_MB = 1024
+
+# EnvironmentLogger files hold one hour of readings and are named after the date and time of their first reading
+# (eg., 2019-03-31_12-00-04_environmentlogger.json)
+ENVLOG_FILE_SUFFIX = 'environmentlogger.json'
+ENVLOG_FILE_TIME_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
+# The format of the timestamp of each EnvironmentLogger reading (eg., 2019.03.31-12:00:04)
+ENVLOG_READING_TIME_FORMAT = '%Y.%m.%d-%H:%M:%S'
+
+# The name of the array holding the readings in an EnvironmentLogger file
+ENVLOG_READINGS_KEY = '"environment_sensor_readings"'
+
+# The number of characters to read from an EnvironmentLogger file at a time
+READ_CHUNK_SIZE = 1024 * 1024
+
+# The initial number of readings to allocate space for; hourly files have one reading every 5 seconds
+READINGS_PER_FILE = 720
+
+
+def get_seconds(timestamp: datetime.datetime) -> float:
+    """Returns the number of seconds since the epoch of a time, ignoring any time zone
+    Arguments:
+        timestamp: the time to convert
+    Return:
+        Returns the number of seconds
+    Notes:
+        EnvironmentLogger readings and image timestamps are both in local time, so they are compared as if they were UTC
+    """
+    return float(calendar.timegm(timestamp.timetuple()))
+
+
+def get_reading_seconds(reading_time: str) -> float:
+    """Returns the number of seconds since the epoch of an EnvironmentLogger reading timestamp
+    Arguments:
+        reading_time: the timestamp of the reading (eg., 2019.03.31-12:00:04)
+    Return:
+        Returns the number of seconds
+    """
+    return get_seconds(datetime.datetime.strptime(reading_time, ENVLOG_READING_TIME_FORMAT))
+
+
+def get_file_start_time(envlog_file: str) -> Optional[datetime.datetime]:
+    """Returns the time of the first reading in an EnvironmentLogger file based upon its name
+    Arguments:
+        envlog_file: the path to the environment logger json file
+    Return:
+        Returns the time found in the file name, or None if the name doesn't contain a time
+    """
+    name_time = os.path.basename(envlog_file)[:-len(ENVLOG_FILE_SUFFIX)].rstrip('_')
+    try:
+        return datetime.datetime.strptime(name_time, ENVLOG_FILE_TIME_FORMAT)
+    except ValueError:
+        return None
+
+
+def select_files(envlog_files: list, window_start: float, window_end: float) -> list:
+    """Returns the EnvironmentLogger files that may contain readings within a window of time
+    Arguments:
+        envlog_files: the list of environment logger json files to select from
+        window_start: the start of the time window in seconds since the epoch
+        window_end: the end of the time window in seconds since the epoch
+    Return:
+        Returns the list of files that may contain readings in the window, in time order
+    Notes:
+        Each file is assumed to hold the readings from the time in its name up to the time in the name of the next file.
+        All the files are returned when a file name doesn't contain a time
+    """
+    start_times = []
+    for one_file in envlog_files:
+        file_time = get_file_start_time(one_file)
+        if file_time is None:
+            logging.debug("Unable to find the time in EnvironmentLogger file name '%s'", one_file)
+            return envlog_files
+        start_times.append((get_seconds(file_time), one_file))
+
+    start_times.sort()
+    selected = []
+    for idx, (file_start, one_file) in enumerate(start_times):
+        file_end = next((seconds for seconds, _ in start_times[idx + 1:] if seconds > file_start), float('inf'))
+        if file_start <= window_end and file_end > window_start:
+            selected.append(one_file)
+
+    return selected
+
+
+class ReadingsReader():
+    """Reads the records of the environment_sensor_readings array of an EnvironmentLogger file one at a time
+    """
+
+    def __init__(self, in_file, chunk_size: int = READ_CHUNK_SIZE):
+        """Initializes class instance
+        Arguments:
+            in_file: the open EnvironmentLogger file to read from
+            chunk_size: the number of characters to read from the file at a time
+        """
+        self.in_file = in_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.offset = 0
+
+    def fill(self) -> bool:
+        """Reads the next chunk of the file into the buffer, dropping what has already been consumed
+        Return:
+            Returns False if the end of the file has been reached
+        """
+        chunk = self.in_file.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.offset:] + chunk
+        self.offset = 0
+        return True
+
+    def next_char(self, skip: str) -> Optional[str]:
+        """Moves past any of the skipped characters and returns the character that follows them
+        Arguments:
+            skip: the characters to skip over
+        Return:
+            Returns the next character without consuming it, or None at the end of the file
+        """
+        while True:
+            while self.offset < len(self.buffer) and self.buffer[self.offset] in skip:
+                self.offset += 1
+            if self.offset < len(self.buffer):
+                return self.buffer[self.offset]
+            if not self.fill():
+                return None
+
+    def find_readings(self) -> None:
+        """Moves to the first record of the readings array
+        Exceptions:
+            Raises ValueError if the readings array isn't found
+        """
+        while True:
+            found = self.buffer.find(ENVLOG_READINGS_KEY, self.offset)
+            if found >= 0:
+                self.offset = found + len(ENVLOG_READINGS_KEY)
+                break
+            # Keep the end of the buffer in case the key is split across chunks
+            self.offset = max(self.offset, len(self.buffer) - len(ENVLOG_READINGS_KEY))
+            if not self.fill():
+                raise ValueError("The environment_sensor_readings array was not found")
+
+        if self.next_char(' \t\r\n:') != '[':
+            raise ValueError("The environment_sensor_readings value is not an array")
+        self.offset += 1
+
+    def __iter__(self):
+        """Yields each record of the readings array as a dictionary
+        """
+        self.find_readings()
+        while True:
+            next_char = self.next_char(' \t\r\n,')
+            if next_char is None:
+                raise ValueError("The environment_sensor_readings array is not terminated")
+            if next_char == ']':
+                return
+
+            # Records are objects, so decoding only succeeds once the closing brace has been read
+            try:
+                reading, self.offset = self.decoder.raw_decode(self.buffer, self.offset)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            yield reading
+
+
+def get_reading_spectrum(camera_type: str, reading: dict) -> list:
+    """Returns the irradiance spectrum of an EnvironmentLogger reading for a camera
+    Arguments:
+        camera_type: the string representing the camera type
+        reading: the EnvironmentLogger record
+    Return:
+        Returns the spectrum
+    """
+    if "spectrometers" in reading:
+        if camera_type == "swir_new":
+            return reading["spectrometers"]["NIRQuest-512"]["spectrum"]
+        return reading["spectrometers"]["FLAME-T"]["spectrum"]
+    return reading["spectrometer"]["spectrum"]
+
+
+def read_envlog_file(camera_type: str, envlog_file: str) -> tuple:
+    """Extract spectral profiles from environment logger json file
+    Arguments:
+        camera_type: the string representing the camera type
+        envlog_file: the path to the environment logger json file
+    Return:
+        Returns a tuple of the loaded times, in seconds since the epoch, and spectra
+    Notes:
+        The readings are decoded one record at a time and copied into arrays that grow as needed, so the whole
+        file is never held in memory
+    """
+    times = np.empty((READINGS_PER_FILE,), dtype=np.float64)
+    spectra = None
+    num_readings = 0
+    with open(envlog_file, "r") as in_file:
+        for reading in ReadingsReader(in_file):
+            spectrum = get_reading_spectrum(camera_type, reading)
+            if spectra is None:
+                spectra = np.empty((READINGS_PER_FILE, len(spectrum)), dtype=np.float64)
+            elif num_readings >= len(times):
+                times = np.resize(times, (len(times) * 2,))
+                spectra = np.resize(spectra, (len(times), spectra.shape[1]))
+
+            times[num_readings] = get_reading_seconds(reading["timestamp"])
+            spectra[num_readings, :] = spectrum
+            num_readings += 1
+
+    if spectra is None:
+        logging.warning("No readings found in environment logger file '%s'", envlog_file)
+        return times[:0].copy(), np.empty((0, 0), dtype=np.float64)
+
+    return times[:num_readings].copy(), spectra[:num_readings].copy()
+
+
+class IrradianceTimeline():
+    """Irradiance readings sorted by time, for finding the readings that match image timestamps
+    """
+
+    def __init__(self, times: np.ndarray, spectra: np.ndarray):
+        """Initializes class instance
+        Arguments:
+            times: the time of each reading in seconds since the epoch
+            spectra: the spectrum of each reading with a shape of (readings, bands)
+        """
+        order = np.argsort(times, kind='stable')
+        self.times = np.asarray(times, dtype=np.float64)[order]
+        self.spectra = spectra[order]
+
+    @classmethod
+    def from_readings(cls, readings: list, num_bands: int) -> 'IrradianceTimeline':
+        """Creates a timeline from the readings of several EnvironmentLogger files
+        Arguments:
+            readings: a list of the (times, spectra) tuples of each file
+            num_bands: the number of bands in each spectrum
+        Return:
+            Returns the new timeline
+        """
+        num_readings = sum(len(times) for times, _ in readings)
+        times = np.empty((num_readings,), dtype=np.float64)
+        spectra = np.empty((num_readings, num_bands), dtype=np.float64)
+        first = 0
+        for file_times, file_spectra in readings:
+            last = first + len(file_times)
+            if last > first:
+                times[first:last] = file_times
+                spectra[first:last, :] = file_spectra
+            first = last
+
+        return cls(times, spectra)
+
+    def __len__(self) -> int:
+        """Returns the number of readings in the timeline
+        """
+        return len(self.times)
+
+    def closest_indices(self, seconds) -> np.ndarray:
+        """Finds the readings closest to one or more times
+        Arguments:
+            seconds: a time, or array of times, in seconds since the epoch
+        Return:
+            Returns the index, or array of indexes, of the closest readings. The earlier reading is returned when two
+            readings are equally close
+        """
+        if not len(self.times):
+            raise ValueError("No irradiance readings are available")
+
+        seconds = np.asarray(seconds, dtype=np.float64)
+        after = np.clip(np.searchsorted(self.times, seconds, side='left'), 0, len(self.times) - 1)
+        before = np.clip(after - 1, 0, len(self.times) - 1)
+        use_before = np.abs(seconds - self.times[before]) <= np.abs(self.times[after] - seconds)
+        return np.where(use_before, before, after)
+
+    def closest_distance(self, seconds: float) -> float:
+        """Returns the number of seconds between a time and the closest reading
+        Arguments:
+            seconds: the time in seconds since the epoch
+        Return:
+            Returns the number of seconds, or infinity if there aren't any readings
+        """
+        if not len(self.times):
+            return float('inf')
+        return float(abs(self.times[self.closest_indices(seconds)] - seconds))
+
+    def window(self, start: float, end: float) -> slice:
+        """Returns the readings within a window of time
+        Arguments:
+            start: the start of the window in seconds since the epoch
+            end: the end of the window in seconds since the epoch (inclusive)
+        Return:
+            Returns the slice of the readings in the window
+        """
+        return slice(int(np.searchsorted(self.times, start, side='left')),
+                     int(np.searchsorted(self.times, end, side='right')))
+
+    def mean_spectrum(self, seconds: float, num_records: int) -> np.ndarray:
+        """Returns the mean spectrum of the readings starting with the one closest to a time
+        Arguments:
+            seconds: the time in seconds since the epoch
+            num_records: the number of records in the scanning time
+        Return:
+            Returns the mean spectrum
+        Notes:
+            As in the original calibration, num_records - 1 readings are averaged
+        """
+        first = int(self.closest_indices(seconds))
+        return np.mean(self.spectra[first: first + num_records - 1, :], axis=0)
+
+    def mean_spectra(self, seconds, num_records: int) -> np.ndarray:
+        """Returns the mean spectra for many times at once
+        Arguments:
+            seconds: the array of times in seconds since the epoch
+            num_records: the number of records in the scanning time
+        Return:
+            Returns the mean spectra with a shape of (times, bands)
+        """
+        firsts = np.atleast_1d(self.closest_indices(seconds))
+        return np.stack([np.mean(self.spectra[first: first + num_records - 1, :], axis=0) for first in firsts.tolist()])
+
+
+class EnvlogCache():
+    """Persistent cache of the times and spectra parsed from EnvironmentLogger JSON files
+    """
+
+    def __init__(self, cache_folder: Optional[str], max_size_mb: int = DEFAULT_CACHE_SIZE_MB, memory_files: int = 0):
+        """Initializes class instance
+        Arguments:
+            cache_folder: the folder to store the cached files in; None to only keep files in memory
+            max_size_mb: the maximum size of the cache folder in megabytes; the least recently used files are
+                         removed when the cache grows beyond this size
+            memory_files: the number of most recently used files to also keep in memory
+        """
+        self.cache_folder = cache_folder
+        self.max_size = max_size_mb * 1024 * 1024
+        self.memory_files = memory_files
+        self.memory = collections.OrderedDict()
+
+    @staticmethod
+    def get_cache_key(envlog_file: str, camera_type: str) -> str:
+        """Returns the key identifying the parsed contents of an EnvironmentLogger file
+        Arguments:
+            envlog_file: the path to the environment logger json file
+            camera_type: the string representing the camera type
+        Return:
+            Returns the key
+        Notes:
+            The key is generated from the path, modification time, and size of the EnvironmentLogger file along with
+            the camera type and cache version. A changed source file, or a new cache version, results in a different
+            key and the stale entry is eventually evicted
+        """
+        file_stat = os.stat(envlog_file)
+        key = '|'.join([os.path.abspath(envlog_file), str(file_stat.st_mtime_ns), str(file_stat.st_size), camera_type,
+                        str(CACHE_VERSION)])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get_cache_filename(self, envlog_file: str, camera_type: str) -> str:
+        """Returns the name of the cache file for an EnvironmentLogger file
+        Arguments:
+            envlog_file: the path to the environment logger json file
+            camera_type: the string representing the camera type
+        Return:
+            Returns the path of the cache file
+        """
+        return os.path.join(self.cache_folder, self.get_cache_key(envlog_file, camera_type) + '.npz')
+
+    def load(self, envlog_file: str, camera_type: str) -> Optional[tuple]:
+        """Loads the cached times and spectra of an EnvironmentLogger file
+        Arguments:
+            envlog_file: the path to the environment logger json file
+            camera_type: the string representing the camera type
+        Return:
+            Returns a tuple of the loaded times and spectra, or None if the file isn't cached
+        """
+        if self.memory_files > 0:
+            cache_key = self.get_cache_key(envlog_file, camera_type)
+            if cache_key in self.memory:
+                self.memory.move_to_end(cache_key)
+                logging.debug("Using EnvironmentLogger data for '%s' from memory", envlog_file)
+                return self.memory[cache_key]
+
+        if not self.cache_folder:
+            return None
+        cache_filename = self.get_cache_filename(envlog_file, camera_type)
+        if not os.path.exists(cache_filename):
+            return None
+
+        try:
+            with np.load(cache_filename) as cached:
+                times = cached['times']
+                spectra = cached['spectra']
+        except (OSError, ValueError, KeyError) as ex:
+            logging.warning("Removing unreadable EnvironmentLogger cache file '%s': %s", cache_filename, str(ex))
+            self.remove(cache_filename)
+            return None
+
+        # Mark the file as recently used so that it's evicted after older entries
+        try:
+            os.utime(cache_filename)
+        except OSError:
+            pass
+
+        logging.debug("Loaded cached EnvironmentLogger data for '%s'", envlog_file)
+        self.remember(envlog_file, camera_type, times, spectra)
+        return times, spectra
+
+    def remember(self, envlog_file: str, camera_type: str, times: np.ndarray, spectra: np.ndarray) -> None:
+        """Keeps the times and spectra of an EnvironmentLogger file in memory, forgetting the least recently used files
+        Arguments:
+            envlog_file: the path to the environment logger json file
+            camera_type: the string representing the camera type
+            times: the times of the readings
+            spectra: the spectrum of each reading
+        """
+        if self.memory_files <= 0:
+            return
+
+        self.memory[self.get_cache_key(envlog_file, camera_type)] = (times, spectra)
+        while len(self.memory) > self.memory_files:
+            self.memory.popitem(last=False)
+
+    def save(self, envlog_file: str, camera_type: str, times: np.ndarray, spectra: np.ndarray) -> None:
+        """Saves the times and spectra of an EnvironmentLogger file to the cache
+        Arguments:
+            envlog_file: the path to the environment logger json file
+            camera_type: the string representing the camera type
+            times: the times of the readings
+            spectra: the spectrum of each reading
+        """
+        self.remember(envlog_file, camera_type, times, spectra)
+        if not self.cache_folder:
+            return
+
+        os.makedirs(self.cache_folder, exist_ok=True)
+        cache_filename = self.get_cache_filename(envlog_file, camera_type)
+
+        # Write to a temporary file first so that other processes never see a partial cache file
+        out_handle, temp_filename = tempfile.mkstemp(suffix='.tmp', dir=self.cache_folder)
+        try:
+            with os.fdopen(out_handle, 'wb') as out_file:
+                np.savez(out_file, times=times, spectra=spectra)
+            os.replace(temp_filename, cache_filename)
+        except Exception:
+            self.remove(temp_filename)
+            raise
+        logging.debug("Cached EnvironmentLogger data for '%s' as '%s'", envlog_file, cache_filename)
+
+        self.evict()
+
+    def evict(self) -> None:
+        """Removes the least recently used cache files until the cache is no larger than its maximum size
+        """
+        entries = []
+        for one_file in os.listdir(self.cache_folder):
+            if one_file.endswith('.npz'):
+                one_path = os.path.join(self.cache_folder, one_file)
+                try:
+                    file_stat = os.stat(one_path)
+                except FileNotFoundError:
+                    continue
+                entries.append((file_stat.st_mtime, file_stat.st_size, one_path))
+
+        cache_size = sum(entry[1] for entry in entries)
+        for _, file_size, one_path in sorted(entries):
+            if cache_size <= self.max_size:
+                break
+            logging.debug("Evicting EnvironmentLogger cache file '%s'", one_path)
+            self.remove(one_path)
+            cache_size -= file_size
+
+    @staticmethod
+    def remove(filename: str) -> None:
+        """Removes a file from the cache, ignoring files that have already been removed
+        Arguments:
+            filename: the path of the file to remove
+        """
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,741 @@
+"""Calculates hyperspectral indices from the reflectances of a calibrated netCDF file, in place of the workflow's
+hyperspectral_indices_make.nco script
+"""
+
+import collections
+import logging
+from typing import Optional
+import numpy as np
+from netCDF4 import Dataset
+
+# The reflectances used by the indices and the wavelengths, in meters, they are taken from (@rfl_lst and @dbl_val_lst
+# of hyperspectral_indices_make.nco)
+REFLECTANCE_WAVELENGTHS = collections.OrderedDict([
+    ('R415', 4.15e-07), ('R420', 4.2e-07), ('R430', 4.3e-07), ('R435', 4.35e-07), ('R440', 4.4e-07),
+    ('R445', 4.45e-07), ('R450', 4.5e-07), ('R470', 4.7e-07), ('R500', 5e-07), ('R510', 5.1e-07), ('R512', 5.12e-07),
+    ('R513', 5.13e-07), ('R520', 5.2e-07), ('R531', 5.31e-07), ('R534', 5.34e-07), ('R540', 5.4e-07),
+    ('R550', 5.5e-07), ('R554', 5.54e-07), ('R570', 5.7e-07), ('R584', 5.84e-07), ('R586', 5.86e-07),
+    ('R590', 5.9e-07), ('R600', 6e-07), ('R650', 6.5e-07), ('R670', 6.7e-07), ('R677', 6.77e-07), ('R680', 6.8e-07),
+    ('R690', 6.9e-07), ('R695', 6.95e-07), ('R698', 6.98e-07), ('R700', 7e-07), ('R704', 7.04e-07),
+    ('R705', 7.05e-07), ('R710', 7.1e-07), ('R715', 7.15e-07), ('R726', 7.26e-07), ('R720', 7.2e-07),
+    ('R724', 7.24e-07), ('R734', 7.34e-07), ('R740', 7.4e-07), ('R747', 7.47e-07), ('R750', 7.5e-07),
+    ('R760', 7.6e-07), ('R780', 7.8e-07), ('R790', 7.9e-07), ('R800', 8e-07), ('R900', 9e-07), ('R970', 9.7e-07)
+])
+# The reflectances that must be found in the image, within the tolerance in meters, for the indices to be calculated
+CHECKED_REFLECTANCES = ('R445', 'R970', 'R700')
+WAVELENGTH_TOLERANCE = 0.01e-7
+
+# The value of reflectances that are missing or masked, and of indices calculated from them
+FILL_VALUE = np.float32(1.0e36)
+
+# The index groups and whether they're calculated by default. The nitrogen, carbon, water content and disease water
+# stress groups need SWIR reflectances and aren't available
+INDEX_GROUPS = collections.OrderedDict([('std', True), ('bgi', True), ('ngi', True), ('lpi', True), ('sdi', True),
+                                        ('mi', True)])
+
+# The functions available to index expressions, with their ncap2 names
+EXPRESSION_FUNCTIONS = {'sqr': np.square, 'sqrt': np.sqrt, 'pow': np.power, 'log': np.log}
+
+# The name of the optional variable flagging soil pixels to exclude (non-zero values are soil)
+SOIL_MASK_NAME = 'SoilRemovalMask'
+
+# The default number of scan lines of the soil mask to read at one time
+DEFAULT_MASK_BLOCK_LINES = 1024
+
+# The variables copied from the reflectance file to the indices file
+COORDINATE_NAMES = ('x', 'y', 'wavelength')
+
+
+class IndexDefinition():
+    """A hyperspectral index and how it's calculated
+    """
+
+    def __init__(self, name: str, group: str, expression: str, attributes: dict):
+        """Initializes class instance
+        Arguments:
+            name: the name of the index variable
+            group: the name of the index group the index belongs to
+            expression: the expression calculating the index from reflectances (such as R800) and earlier indices
+            attributes: the attributes of the index variable
+        """
+        self.name = name
+        self.group = group
+        self.expression = expression
+        self.attributes = attributes
+        self.code = compile(expression, name, 'eval')
+        self.reflectances = []
+
+
+# The indices in the order they're calculated, as defined by hyperspectral_indices_make.nco
+INDICES = [
+    IndexDefinition('ND900_680', 'std', '( R900 -R680) / (R900+R680 )',
+                    {'long_name': 'Normalized Difference Vegetation Index',
+                     'standard_name': 'normalized_difference_vegetation_index',
+                     'description': 'Normalized Difference Vegetation Index | (R900-R680)/(R900+R680) | Rouse et al. (1973)',
+                     'notes': 'Normalized Difference Vegetation Index | ND900_680',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('SR900_680', 'std', 'R900 / R680',
+                    {'long_name': 'Simple ratio',
+                     'standard_name': 'simple_ratio',
+                     'description': 'Simple ratio | R900 / R680 | Rouse et al. (1973)',
+                     'notes': 'Simple ratio | SR900_680',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('OSAVI', 'std', '1.16*( (R800-R670) ) / ( R800+R670+0.16)',
+                    {'long_name': 'Optimized Soil-Adjusted Vegetation index',
+                     'standard_name': 'optimized_soil-adjusted_vegetation_index',
+                     'description': 'Optimized Soil-Adjusted Vegetation index | 1.16f*( (R800-R670) ) /  ( R800+R670+0.16f) | Rondeaux et al. (1996)',
+                     'notes': 'Optimized Soil-Adjusted Vegetation index | OSAVI',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('WI', 'std', 'R900-R970',
+                    {'long_name': 'water index',
+                     'standard_name': 'water_index',
+                     'description': 'water index | R900-R970 | Penuelas. et al. (1993)',
+                     'notes': 'water index | WI',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('ChlIndex', 'std', 'R750 / R550',
+                    {'long_name': 'Chlorophyll index',
+                     'standard_name': 'chlorophyll_index',
+                     'description': 'Chlorophyll index | R750 / R550 | Gitelson and Merzlyak (1994)',
+                     'notes': 'Chlorophyll index | ChlIndex',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('msR705', 'std', '(R750-R445) / (R705-R445)',
+                    {'long_name': 'Modified simple ratio 705',
+                     'standard_name': 'modified_simple_ratio_705',
+                     'description': 'Modified simple ratio 705 | (R750-R445) / (R705-R445) | Sims and Gamon (2002)',
+                     'notes': 'Modified simple ratio 705 | msR705',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('TCARI', 'std', '3.0*( (R700-R670)-0.2 * (R700-R550) * (R700/R670) )',
+                    {'long_name': 'Transformed chlorophyll absorption in reflectance index',
+                     'standard_name': 'transformed_chlorophyll_absorption_in_reflectance_index',
+                     'description': 'Transformed chlorophyll absorption in reflectance index | 3.0f*(  (R700-R670)-0.2f * (R700-R550) * (R700/R670)  ) | Haboudane et al. (2002)',
+                     'notes': 'Transformed chlorophyll absorption in reflectance index | TCARI',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('TCARI_OSAVI', 'std', 'TCARI/OSAVI',
+                    {'long_name': 'Transformed Chlorophyll Absorption in Reflectance Index/Optimized Soil-Adjusted Vegetation Index (TCARI/OSAVI )'}),
+    IndexDefinition('CarChap', 'std', 'R760/R500',
+                    {'long_name': 'Carotenoid index (Chappelle)',
+                     'standard_name': 'carotenoid_index_(chappelle)',
+                     'description': 'Carotenoid index (Chappelle) | R760/R500 | Chappelle et al. (1992)',
+                     'notes': 'Carotenoid index (Chappelle) | CarChap',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('Car1Black', 'std', 'R800/R470',
+                    {'long_name': 'Carotenoid index (BlackBurn)',
+                     'standard_name': 'carotenoid_index_(blackburn)',
+                     'description': 'Carotenoid index (BlackBurn) | R800/R470 | Blackburn (1998)',
+                     'notes': 'Carotenoid index (BlackBurn) | Car1Black',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('Car2Black', 'std', '( R800 - R470 ) / (R800 + R470)',
+                    {'long_name': 'Carotenoid index 2 (BlackBurn)',
+                     'standard_name': 'carotenoid_index_2_(blackBurn)',
+                     'description': 'Carotenoid index 2 (BlackBurn) | ( R800 - R470 ) / (R800 + R470) | Blackburn (1998)',
+                     'notes': 'Carotenoid index 2 (BlackBurn) | Car2Black',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('PRI570', 'std', '(R531 - R570) / (R531+R570)',
+                    {'long_name': 'Photochemical reflectance index (570)',
+                     'standard_name': 'photochemical_reflectance_index_(570)',
+                     'description': 'Photochemical reflectance index (570) | (R531 - R570) / (R531+R570) | Gamon et al. (1992)',
+                     'notes': 'Photochemical reflectance index (570) | PRI570',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('SIPI', 'std', '( R800 - R450) / (R800 + R650)',
+                    {'long_name': 'Structure intensive pigment index',
+                     'standard_name': 'structure_intensive_pigment_index',
+                     'description': 'Structure intensive pigment index | ( R800 - R450) / (R800 + R650) | Penuelas. et al. (1995)',
+                     'notes': 'Structure intensive pigment index | SIPI',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('AntGamon', 'std', 'R650/R550',
+                    {'long_name': 'Anthocyanin (Gamon)',
+                     'standard_name': 'anthocyanin_(gamon)',
+                     'description': 'Anthocyanin (Gamon) | R650/R550 | Gamon and Surfus (1999)',
+                     'notes': 'Anthocyanin (Gamon) | AntGamon',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('AntGitelson', 'std', '( 1.0/R550 - 1.0/R700)*R780',
+                    {'long_name': 'Anthocyanin (Gitelson)',
+                     'standard_name': 'anthocyanin_(gitelson)',
+                     'description': 'Anthocyanin (Gitelson) | ( 1.0f/R550 - 1.0f/R700)*R780 | Gitelson et al.(2003,2006)',
+                     'notes': 'Anthocyanin (Gitelson) | AntGitelson',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('ChlDela', 'std', '( R540-R590 ) / ( R540 + R590)',
+                    {'long_name': 'Chlorophyll content',
+                     'standard_name': 'chlorophyll_content',
+                     'description': 'Chlorophyll content | ( R540-R590 ) / ( R540 + R590) | Delaieux et al. (2014)',
+                     'notes': 'Chlorophyll content | ChlDela',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('NDVI705', 'std', '( R750-R705 ) / ( R750 + R705)',
+                    {'long_name': 'Chlorophyll index',
+                     'standard_name': 'chlorophyll_index',
+                     'description': 'Chlorophyll index | ( R750-R705 ) / ( R750 + R705) | Gitelson and Merzlyak (1994)',
+                     'notes': 'Chlorophyll index | NDVI705',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('PRI586', 'std', '( R531-R586) / ( R531 + R586)',
+                    {'long_name': 'Photochemical reflectance index (586)',
+                     'standard_name': 'photochemical_reflectance_index_(586)',
+                     'description': 'Photochemical reflectance index (586) | ( R531-R586) / ( R531 + R586) | Panigada et al. (2014)',
+                     'notes': 'Photochemical reflectance index (586) | PRI586',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('PRI512', 'std', '( R531-R512) / ( R531 + R512)',
+                    {'long_name': 'Photochemical reflectance index (512)',
+                     'standard_name': 'photochemical_reflectance_index_(512)',
+                     'description': 'Photochemical reflectance index (512) | ( R531-R512) / ( R531 + R512) | Hernández-Clemente et al. (2011)',
+                     'notes': 'Photochemical reflectance index (512) | PRI512',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('FRI1', 'std', 'R690 / R600',
+                    {'long_name': 'Fluorescence ratio index1',
+                     'standard_name': 'fluorescence_ratio_index1',
+                     'description': 'Fluorescence ratio index1 | R690 / R600 | Dobrowski et al. (2005)',
+                     'notes': 'Fluorescence ratio index1 | FRI1',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('FRI2', 'std', 'R740 / R800',
+                    {'long_name': 'Fluorescence ratio indices 2',
+                     'standard_name': 'fluorescence_ratio_indices_2',
+                     'description': 'Fluorescence ratio indices 2 | R740 / R800 | Dobrowski et al. (2005)',
+                     'notes': 'Fluorescence ratio indices 2 | FRI2',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('NDVI1', 'std', '(R800-R670)/ (R800+R670)',
+                    {'long_name': 'Normalized Difference Vegetation Index1',
+                     'standard_name': 'normalized_difference_vegetation_index1',
+                     'description': 'Normalized Difference Vegetation Index1 | (R800-R670)/ (R800+R670) | Rouse et al. (1973)',
+                     'notes': 'Normalized Difference Vegetation Index1 | NDVI1',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('RDVI', 'std', 'NDVI1*0.5',
+                    {'long_name': 'Renormalized Difference Vegetation Index',
+                     'standard_name': 'renormalized_difference_vegetation_index',
+                     'description': 'Renormalized Difference Vegetation Index | NDVI1*0.5f | Rougean and Breon (1995)',
+                     'notes': 'Renormalized Difference Vegetation Index | RDVI',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('SR700_670', 'std', 'R700/R670',
+                    {'long_name': 'Red edge ratio index',
+                     'standard_name': 'red_edge_ratio_index',
+                     'description': 'Red edge ratio index | R700/R670 | Part of TCARI index',
+                     'notes': 'Red edge ratio index | SR700_670',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('SR750_710', 'std', 'R750 / R710',
+                    {'long_name': 'Red edge',
+                     'standard_name': 'red_edge',
+                     'description': 'Red edge | R750 / R710 | Zarco-Tejada et al. (2001)',
+                     'notes': 'Red edge | SR750_710',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('REP', 'std', '700.0 +40.0*(((R670+R780)/2-R700) /(R740-R700))',
+                    {'long_name': 'Red edge position',
+                     'standard_name': 'red_edge_position',
+                     'description': 'Red edge position | 700.0f +40.0f*(((R670+R780)/2-R700) /(R740-R700)) | Guyot and Baret, 1988',
+                     'notes': 'Red edge position | REP',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('NDRE', 'std', '(R790-R720)/(R790+R720)',
+                    {'long_name': 'Normalized difference vegetation index',
+                     'standard_name': 'normalized_difference_vegetation_index',
+                     'description': 'Normalized difference vegetation index | (R790-R720)/(R790+R720) | Barnes et al. (2000)',
+                     'notes': 'Normalized differenc vegetation index | NDRE',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('TVI', 'std', 'pow( 0.5, (120.0*(R750-R550)-200.0*(R670-R550)))',
+                    {'long_name': 'Triangular Vegetation Index',
+                     'standard_name': 'triangular_vegetation_index',
+                     'description': 'Triangular Vegetation Index | 0.5f**(120.0f*(R750-R550)-200.0f*(R670-R550))) | Haboudaneet al. (2004)',
+                     'notes': 'Triangular Vegetation Index | TVI',
+                     'units': 'ratio',
+                     'label': 'Reflectance Index',
+                     'type': 'trait'}),
+    IndexDefinition('EVI', 'bgi', '2.5 * (R800 - R680) / (R800 + 6.0 * R680 - 7.5 * R450 + 1.0)',
+                    {'long_name': 'Enhanced Vegetation Index [Huete et al. (1997)]'}),
+    IndexDefinition('ARVI', 'bgi', '(R800 - (2.0 * R680 - R450)) / (R800 + (2.0 * R680 - R450))',
+                    {'long_name': 'Atmospherically Resistant Vegetation Index [Kaufman and Tanré (1996)]'}),
+    IndexDefinition('ETA', 'bgi', '(2.0 * ( sqr(R800) - sqr(R680)) + 1.5 * R800 + 0.5 * R680) / (R800 + R680 + 0.5)',
+                    {}),
+    IndexDefinition('GEMI', 'bgi', '(ETA * (1.0 - 0.25 * ETA)) - ((R680 - 0.125) / (1.0 - R680))',
+                    {'long_name': 'Global Environmental Monitoring Index [Pinty and Verstraete (1992)]'}),
+    IndexDefinition('GARI', 'bgi', '(R800 - (R550 - 1.7 * (R450 - R680))) / (R800 + (R550 - 1.7 * (R450 - R680)))',
+                    {'long_name': 'Green Atmospherically Resistant Index [Gitelson et al. (1996)]'}),
+    IndexDefinition('DVI', 'bgi', 'R800 - R680',
+                    {'long_name': 'Difference Vegetation Index [Tucker et al. (1979)]'}),
+    IndexDefinition('GDVI', 'bgi', 'R800 - R550',
+                    {'long_name': 'Green Difference Vegetation Index [Sripada et al. (2006)]'}),
+    IndexDefinition('GNDVI', 'bgi', '(R800 - R550) / (R800 + R550)',
+                    {'long_name': 'Green Normalized Difference Vegetation Index [Gitelson and Merzlyak (1998)]'}),
+    IndexDefinition('GRVI', 'bgi', 'R800 / R550',
+                    {'long_name': 'Green Ratio Vegetation Index [Sripada et al. (2006)]'}),
+    IndexDefinition('IPVI', 'bgi', 'R800 / (R800 + R680)',
+                    {'long_name': 'Infrared Percentage Vegetation Index [Crippen et al. (1990)]'}),
+    IndexDefinition('LAI', 'bgi', '3.618 * ((2.5 * (R800 - R680)) / (R800 + 6.0 * R680 - 7.5 * R450 + 1.0)) - 0.118',
+                    {'long_name': 'Leaf Area Index [Boegh et al. (2002)]'}),
+    IndexDefinition('MSR', 'bgi', '((R800 / R680) - 1.0) / (sqrt(R800 / R680) + 1)',
+                    {'long_name': 'Modified Simple Ratio [Chen et al. (1996)]'}),
+    IndexDefinition('NLI', 'bgi', '(sqr(R800) - R680) / (sqr(R800) + R680)',
+                    {'long_name': 'Non-Linear Index [Goel and Qin (1994)]'}),
+    IndexDefinition('MNLI', 'bgi', '((pow(R800, 2) - R680) * 1.5) / (pow(R800, 2) + R680 + 0.5)',
+                    {'long_name': 'Modified Non-Linear Index [Yang et al. (2008)]'}),
+    IndexDefinition('SAVI', 'bgi', '(1.5 * (R800 - R680)) / (R800 + R680 + 0.5)',
+                    {'long_name': 'Soil Adjusted Vegetation Index [Huete et al. (1988)]'}),
+    IndexDefinition('TDVI', 'bgi', 'sqrt(0.5 + ((R800 - R680) / (R800 + R680)))',
+                    {'long_name': 'Transformed Difference Vegetation Index [Bannari et al. (2002)]'}),
+    IndexDefinition('VARI', 'bgi', '(R550 - R680) / (R550 + R680 - R450)',
+                    {'long_name': 'Visible Atmospherically Resistant Index [Gitelson et al. (2002)]'}),
+    IndexDefinition('RENDVI', 'ngi', '(R750 - R705) / (R750 + R705)',
+                    {'long_name': 'Red Edge Normalized Difference Vegetation Index [Gitelson and Merzlyak (1994)]'}),
+    IndexDefinition('mRESR', 'ngi', '(R750 - R445) / (R750 + R445)',
+                    {'long_name': 'Modified Red Edge Simple Ratio Index [Sims and Gamon (2002)]'}),
+    IndexDefinition('mRENDVI', 'ngi', '(R750 - R705) / (R750 + R705 - 2.0 * R445)',
+                    {'long_name': 'Modified Red Edge Normalized Difference Vegetation Index [Sims and Gamon (2002)]'}),
+    IndexDefinition('VOG1', 'ngi', 'R740 / R720',
+                    {'long_name': 'Vogelmann Red Edge Index 1 [Vogelmann et al. (1993)]'}),
+    IndexDefinition('VOG2', 'ngi', '(R734 - R747) / (R715 + R726)',
+                    {'long_name': 'Vogelmann Red Edge Index 2 [Vogelmann et al. (1993)]'}),
+    IndexDefinition('VOG3', 'ngi', '(R734 - R747) / (R715 + R720)',
+                    {'long_name': 'Vogelmann Red Edge Index 3 [Vogelmann et al. (1993)]'}),
+    IndexDefinition('MCARI', 'ngi', '((R700 - R670) - 0.2 * (R700 - R550)) * (R700 / R670)',
+                    {'long_name': 'Modified Chlorophyll Absorption Reflectance Index [Daughtry et al. (2000)]'}),
+    IndexDefinition('MCARI1', 'ngi', '1.2 * (2.5 * (R790 - R670) - 1.3 * (R790 - R550))',
+                    {'long_name': 'Modified Chlorophyll Absorption Reflectance Index Improved 1 [Haboudane et al. (2004)]'}),
+    IndexDefinition('MCARI2', 'ngi', '(1.5 * (2.5 * (R800 - R670) - 1.3 * (R800 - R550))) / sqrt( sqr(2.0 * R800 + 1.0) - 6.0 * R800 - 5.0 * sqrt(R670) - 0.5)',
+                    {'long_name': 'Modified Chlorophyll Absorption Reflectance Index Improved 2 [Haboudane et al. (2004)]'}),
+    IndexDefinition('MTVI', 'ngi', '1.2 * (1.2 * (R800 - R550) - 2.5 * (R670 - R550))',
+                    {'long_name': 'Modified Triangular Vegetation Index [Haboudane et al. (2004)]'}),
+    IndexDefinition('MTVI2', 'ngi', '1.5 * (1.2 * (R800 - R550) - 2.5 * (R670 - R550)) / sqrt( sqr(2.0 * R800 + 1.0) - (6.0 * R800 - 5.0 * sqrt(R670)) - 0.5)',
+                    {'long_name': 'Modified Triangular Vegetation Index Improved [Haboudane et al. (2004)]'}),
+    IndexDefinition('GMI1', 'ngi', 'R750 / R550',
+                    {'long_name': 'Gitelson and Merzlak Index 1 [Gitelson and Merzlak (1997)]'}),
+    IndexDefinition('GMI2', 'ngi', 'R750 / R700',
+                    {'long_name': 'Gitelson and Merzlak Index 2 [Gitelson and Merzlak (1997)]'}),
+    IndexDefinition('G', 'ngi', 'R554 / R677',
+                    {'long_name': 'Greenness Index'}),
+    IndexDefinition('Lic1', 'ngi', '(R790 - R680) / (R790 + R680)',
+                    {'long_name': 'Lichtenthaler Index 1 [Lichtenthaler et al. 1996]'}),
+    IndexDefinition('Lic2', 'ngi', 'R440 / R690',
+                    {'long_name': 'Lichtenthaler Index 2 [Lichtenthaler et al. 1996]'}),
+    IndexDefinition('Lic3', 'ngi', 'R440 / R740',
+                    {'long_name': 'Lichtenthaler Index 3 [Lichtenthaler et al. 1996]'}),
+    IndexDefinition('PRI531', 'ngi', '(R531 - R570) / (R531 + R570)',
+                    {'long_name': 'Photochemical Reflectance Index [Gamon et al. (1992)]'}),
+    IndexDefinition('CRI1', 'lpi', '1.0 / R510 - 1.0 / R550',
+                    {'long_name': 'Carotenoid Reflectance Index 1 [Gitelson et al. (2002)]'}),
+    IndexDefinition('CRI2', 'lpi', '1.0 / R510 - 1.0 / R700',
+                    {'long_name': 'Carotenoid Reflectance Index 2 [Gitelson et al. (2002)]'}),
+    IndexDefinition('ARI1', 'lpi', '1.0 / R550 - 1.0 / R700',
+                    {'long_name': 'Anthocyanin Reflectance Index 1 [Gitelson et al. (2001)]'}),
+    IndexDefinition('ARI2', 'lpi', 'R800 * ((1.0 / R550) - (1.0 / R700))',
+                    {'long_name': 'Anthocyanin Reflectance Index 2 [Gitelson et al. (2001)]'}),
+    IndexDefinition('SRPI', 'lpi', 'R430 / R680',
+                    {'long_name': 'Simple Ration Pigment Index [Penuelas et al. (1995)]'}),
+    IndexDefinition('NPQI', 'lpi', '(R415 - R435) / (R415 + R435)',
+                    {'long_name': 'Normalized Phaeophytinization Index [Barnes et al. (1992)]'}),
+    IndexDefinition('NPCI', 'lpi', '(R680 - R430) / (R680 + R430)',
+                    {'long_name': 'Normalized Pigment Chlorophyll Index [Penuelas et al. (1994)]'}),
+    IndexDefinition('HI', 'sdi', '((R534 - R698) / (R534 + R698)) - (R704 / 2.0)',
+                    {'long_name': 'Healthy Index [Mahlein et al. (2013)]'}),
+    IndexDefinition('CLSI', 'sdi', '((R698 - R570) / (R698 + R570)) - R734',
+                    {'long_name': 'Cercospora Leaf Spot Index [Mahlein et al. (2013)]'}),
+    IndexDefinition('SBRI', 'sdi', '((R570 - R513) / (R570 + R513)) + (R704 / 2.0)',
+                    {'long_name': 'Sugar Beet Rust Index [Mahlein et al. (2013)]'}),
+    IndexDefinition('PMI', 'sdi', '((R520 - R584) / (R520 + R584)) + R724',
+                    {'long_name': 'Powdery Mildew Index [Mahlein et al. (2013)]'}),
+    IndexDefinition('Crt1', 'mi', 'R695 / R420',
+                    {'long_name': 'Carter Index 1 [Carter (1994)]'}),
+    IndexDefinition('Crt2', 'mi', 'R695 / R760',
+                    {'long_name': 'Carter Index 2 [Carter (1996)]'}),
+    IndexDefinition('BIG2', 'mi', 'R450 / R550',
+                    {'long_name': 'Blue/Green Index [Zarco-Tejada et al. (2005)]'}),
+    IndexDefinition('BRI', 'mi', '((1.0 / R550) - (1.0 / R700)) / R800',
+                    {'long_name': 'Browning Reflectance Index [Chivkunova et al. (2001)]'}),
+]
+
+
+def resolve_reflectances(definitions: list) -> None:
+    """Finds the reflectances each index is calculated from, including those of the indices it uses
+    Arguments:
+        definitions: the list of index definitions in the order they're calculated
+    Exceptions:
+        Raises RuntimeError if an index uses a name that's not a reflectance, function, or earlier index
+    """
+    found = {}
+    for definition in definitions:
+        reflectances = set()
+        for name in definition.code.co_names:
+            if name in REFLECTANCE_WAVELENGTHS:
+                reflectances.add(name)
+            elif name in found:
+                reflectances.update(found[name].reflectances)
+            elif name not in EXPRESSION_FUNCTIONS:
+                raise RuntimeError("Index %s uses unknown name '%s'" % (definition.name, name))
+        definition.reflectances = sorted(reflectances)
+        found[definition.name] = definition
+
+
+resolve_reflectances(INDICES)
+
+
+def get_index_definitions(groups: Optional[list] = None) -> list:
+    """Returns the definitions of the indices in the groups
+    Arguments:
+        groups: the names of the groups to return; None returns the groups that are calculated by default
+    Return:
+        Returns the list of definitions in the order they're calculated
+    Exceptions:
+        Raises RuntimeError if an unknown group is specified
+    """
+    if groups is None:
+        groups = [name for name, enabled in INDEX_GROUPS.items() if enabled]
+    unknown = [name for name in groups if name not in INDEX_GROUPS]
+    if unknown:
+        raise RuntimeError("Unknown index groups: %s" % ', '.join(unknown))
+
+    return [definition for definition in INDICES if definition.group in groups]
+
+
+def get_band_indices(wavelengths: np.ndarray, reflectances: list) -> dict:
+    """Finds the bands closest to the wavelengths of the reflectances
+    Arguments:
+        wavelengths: the wavelengths of the image bands in meters
+        reflectances: the names of the reflectances to find
+    Return:
+        Returns a dictionary of the band index of each reflectance
+    Exceptions:
+        Raises RuntimeError if the image doesn't have bands for the checked reflectances
+    """
+    band_indices = {}
+    for name in set(reflectances).union(CHECKED_REFLECTANCES):
+        band_indices[name] = int(np.argmin(np.abs(wavelengths - REFLECTANCE_WAVELENGTHS[name])))
+        if name in CHECKED_REFLECTANCES and \
+                abs(wavelengths[band_indices[name]] - REFLECTANCE_WAVELENGTHS[name]) > WAVELENGTH_TOLERANCE:
+            raise RuntimeError("wavelength %s not in wavelength coord" % name)
+
+    return {name: band_indices[name] for name in reflectances}
+
+
+class IndexStatistics():
+    """Running minimum, maximum, average and optional histogram of the finite values of an index that aren't missing
+    """
+
+    def __init__(self, histogram_edges: Optional[np.ndarray] = None):
+        """Initializes class instance
+        Arguments:
+            histogram_edges: the edges of the histogram bins to count values in; None to not keep a histogram
+        """
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.histogram_edges = histogram_edges
+        self.histogram = np.zeros(len(histogram_edges) - 1, dtype=np.int64) if histogram_edges is not None else None
+        self.below = 0
+        self.above = 0
+
+    def update(self, values: np.ndarray) -> None:
+        """Adds the finite values that aren't missing to the statistics
+        Arguments:
+            values: the index values with missing values set to FILL_VALUE
+        """
+        # NaN values, such as those of an index that isn't defined for a pixel's reflectances, aren't counted
+        values = values[np.isfinite(values) & (values != FILL_VALUE)]
+        if values.size == 0:
+            return
+        self.count += values.size
+        self.total += float(np.sum(values, dtype=np.float64))
+        minimum = values.min()
+        maximum = values.max()
+        self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+        self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+
+        if self.histogram is not None:
+            self.histogram += np.histogram(values, bins=self.histogram_edges)[0]
+            self.below += int(np.count_nonzero(values < self.histogram_edges[0]))
+            self.above += int(np.count_nonzero(values > self.histogram_edges[-1]))
+
+    @property
+    def average(self) -> Optional[float]:
+        """Returns the average of the values, or None if there were no values
+        """
+        return self.total / self.count if self.count else None
+
+    def get_attributes(self) -> dict:
+        """Returns the statistics as variable attributes
+        Return:
+            Returns a dictionary with the min, max and avg attributes; the dictionary is empty if there were no values
+        """
+        if not self.count:
+            return {}
+        return {'min': np.float32(self.minimum), 'max': np.float32(self.maximum), 'avg': np.float32(self.average)}
+
+
+def calculate_block(definitions: list, bands: dict, missing: dict) -> dict:
+    """Calculates the indices for a block of scan lines
+    Arguments:
+        definitions: the definitions of the indices to calculate, in order
+        bands: the dictionary of the reflectance values of each needed reflectance
+        missing: the dictionary of the boolean mask of each reflectance's missing values
+    Return:
+        Returns a dictionary of the values of each index, with values calculated from a missing reflectance set to
+        FILL_VALUE
+    """
+    values = dict(bands)
+    results = {}
+    with np.errstate(all='ignore'):
+        for definition in definitions:
+            result = np.asarray(eval(definition.code, {'__builtins__': {}}, {**EXPRESSION_FUNCTIONS, **values}),
+                                dtype=np.float32)
+            values[definition.name] = result
+            invalid = None
+            for name in definition.reflectances:
+                invalid = missing[name] if invalid is None else invalid | missing[name]
+            result = result.copy()
+            if invalid is not None:
+                result[invalid] = FILL_VALUE
+            results[definition.name] = result
+
+    return results
+
+
+class SoilMask():
+    """The soil pixels to exclude from the indices, kept as a bitmap with one bit per pixel
+    """
+
+    def __init__(self, num_lines: int, num_samples: int):
+        """Initializes class instance with no soil pixels
+        Arguments:
+            num_lines: the number of scan lines (y) of the image
+            num_samples: the number of samples (x) of each scan line
+        """
+        self.num_samples = num_samples
+        self.bits = np.zeros((num_lines, (num_samples + 7) // 8), dtype=np.uint8)
+
+    def set_lines(self, first_line: int, mask: np.ndarray) -> None:
+        """Sets the soil pixels of a block of scan lines
+        Arguments:
+            first_line: the index of the first scan line of the block
+            mask: the (lines, samples) array that's non-zero for soil pixels
+        """
+        self.bits[first_line:first_line + mask.shape[0]] = np.packbits(np.asarray(mask) != 0, axis=1)
+
+    def get_lines(self, first_line: int, last_line: int) -> np.ndarray:
+        """Returns the soil pixels of a block of scan lines
+        Arguments:
+            first_line: the index of the first scan line of the block
+            last_line: the index after the last scan line of the block
+        Return:
+            Returns the (lines, samples) boolean array that's True for soil pixels
+        """
+        return np.unpackbits(self.bits[first_line:last_line], axis=1, count=self.num_samples).view(bool)
+
+
+def read_soil_mask(dataset: Dataset, mask_filename: Optional[str],
+                   block_lines: int = DEFAULT_MASK_BLOCK_LINES) -> Optional[SoilMask]:
+    """Reads the soil mask from the mask file, or the reflectance file if there isn't a mask file
+    Arguments:
+        dataset: the open reflectance file
+        mask_filename: the optional path of the netCDF file with the soil mask
+        block_lines: the number of scan lines of the mask to read at one time
+    Return:
+        Returns the soil mask, or None if there isn't a mask or its shape doesn't match the reflectances
+    """
+    mask_dataset = Dataset(mask_filename) if mask_filename else None
+    try:
+        if mask_dataset is not None and SOIL_MASK_NAME in mask_dataset.variables:
+            variable = mask_dataset[SOIL_MASK_NAME]
+        elif SOIL_MASK_NAME in dataset.variables:
+            if mask_dataset is not None:
+                logging.warning("No %s found in '%s'", SOIL_MASK_NAME, mask_filename)
+            variable = dataset[SOIL_MASK_NAME]
+        else:
+            if mask_dataset is not None:
+                logging.warning("No %s found in '%s'", SOIL_MASK_NAME, mask_filename)
+            return None
+
+        # Check the shape before reading any of the mask
+        shape = (len(dataset.dimensions['y']), len(dataset.dimensions['x']))
+        if tuple(variable.shape) != shape:
+            logging.warning("Ignoring %s since its shape %s doesn't match the data dims y=%s, x=%s", SOIL_MASK_NAME,
+                            str(tuple(variable.shape)), str(shape[0]), str(shape[1]))
+            return None
+
+        variable.set_auto_mask(False)
+        soil_mask = SoilMask(shape[0], shape[1])
+        for first_line in range(0, shape[0], block_lines):
+            soil_mask.set_lines(first_line, variable[first_line:first_line + block_lines, :])
+        return soil_mask
+    finally:
+        if mask_dataset is not None:
+            mask_dataset.close()
+
+
+def create_index_variables(dst: Dataset, definitions: list, pixels: bool, histogram_bins: int) -> None:
+    """Creates the variables of the indices file
+    Arguments:
+        dst: the indices file
+        definitions: the definitions of the indices being calculated
+        pixels: create (y, x) variables for the index of each pixel; otherwise scalar variables holding the average
+        histogram_bins: the number of histogram bins of each index; zero if there are no histograms
+    """
+    for definition in definitions:
+        dst.createVariable(definition.name, 'f4', ('y', 'x') if pixels else (), fill_value=FILL_VALUE)
+        dst[definition.name].setncatts(definition.attributes)
+
+    if histogram_bins > 0:
+        dst.createDimension('histogram_bin', histogram_bins)
+        dst.createDimension('histogram_edge', histogram_bins + 1)
+        dst.createVariable('histogram_edges', 'f8', ('histogram_edge',))
+        dst['histogram_edges'].long_name = "Edges of the hyperspectral index histogram bins"
+        for definition in definitions:
+            name = definition.name + '_histogram'
+            dst.createVariable(name, 'i8', ('histogram_bin',))
+            dst[name].long_name = "Histogram of %s" % definition.name
+            dst[name].units = "1"
+
+
+def calculate_indices(in_filename: str, out_filename: str, groups: Optional[list] = None, block_lines: int = 64,
+                      mask_filename: Optional[str] = None, aggregate: bool = False, pixels: bool = True,
+                      histogram_bins: int = 0, histogram_range: tuple = (-1.0, 1.0)) -> str:
+    """Calculates the hyperspectral indices of a calibrated file and writes them to a new file
+    Arguments:
+        in_filename: the path of the netCDF file with the rfl_img reflectances
+        out_filename: the path of the indices file to create
+        groups: the names of the index groups to calculate; None for the groups calculated by default
+        block_lines: the number of scan lines to calculate at one time; zero calculates the entire image at once
+        mask_filename: optional netCDF file containing the SoilRemovalMask variable
+        aggregate: add the min, max and avg attributes to each index variable
+        pixels: write the index of each pixel; if False only the statistics are kept while calculating, and each
+                index variable is a scalar holding the average with the min, max and avg attributes
+        histogram_bins: the number of bins of a histogram of each index; zero to not calculate histograms
+        histogram_range: the lower and upper edges of the histograms; values outside the range are counted in the
+                         histogram's "below" and "above" attributes
+    Return:
+        Returns the path of the indices file
+    Notes:
+        Reflectances that are zero or less, NaN or infinite are missing. Soil pixels, according to the mask, are
+        excluded from the calculations and set to missing. Each needed reflectance is read once per block of scan
+        lines and all the indices are calculated from it
+    """
+    # pylint: disable=too-many-locals
+    definitions = get_index_definitions(groups)
+    reflectances = sorted(set(name for definition in definitions for name in definition.reflectances))
+    histogram_edges = np.linspace(histogram_range[0], histogram_range[1], histogram_bins + 1) \
+        if histogram_bins > 0 else None
+
+    with Dataset(in_filename) as src, Dataset(out_filename, 'w', format='NETCDF4') as dst:
+        rfl_img = src['rfl_img']
+        # Packed values are unpacked here so that the fill value is found before it's scaled
+        rfl_img.set_auto_maskandscale(False)
+        rfl_fill = rfl_img.getncattr('_FillValue') if '_FillValue' in rfl_img.ncattrs() else None
+        rfl_scale = rfl_img.getncattr('scale_factor') if 'scale_factor' in rfl_img.ncattrs() else None
+        rfl_offset = rfl_img.getncattr('add_offset') if 'add_offset' in rfl_img.ncattrs() else None
+        num_lines = rfl_img.shape[1]
+        band_indices = get_band_indices(np.asarray(src['wavelength'][:], dtype=np.float64), reflectances)
+        bands_to_read = sorted(set(band_indices.values()))
+        soil_mask = read_soil_mask(src, mask_filename)
+
+        dst.setncatts(src.__dict__)
+        for name in ('wavelength', 'y', 'x'):
+            dst.createDimension(name, len(src.dimensions[name]))
+        for name in COORDINATE_NAMES:
+            if name in src.variables:
+                dst.createVariable(name, src[name].datatype, src[name].dimensions)
+                dst[name][:] = src[name][:]
+                dst[name].setncatts(src[name].__dict__)
+        create_index_variables(dst, definitions, pixels, histogram_bins)
+
+        statistics = {}
+        if aggregate or not pixels or histogram_edges is not None:
+            statistics = {definition.name: IndexStatistics(histogram_edges) for definition in definitions}
+        step = block_lines if block_lines > 0 else num_lines
+        logging.info("Calculating %s indices from %s reflectances, %s scan lines at a time", str(len(definitions)),
+                     str(len(reflectances)), str(step))
+        for first_line in range(0, num_lines, step):
+            last_line = min(first_line + step, num_lines)
+            raw_block = rfl_img[bands_to_read, first_line:last_line, :]
+            block = np.asarray(raw_block, dtype=np.float32)
+            if rfl_scale is not None:
+                block *= np.float32(rfl_scale)
+            if rfl_offset is not None:
+                block += np.float32(rfl_offset)
+
+            # Soil pixels are dropped before calculating so that they don't need to be masked in each reflectance
+            keep = None
+            if soil_mask is not None:
+                keep = ~soil_mask.get_lines(first_line, last_line)
+                if keep.all():
+                    keep = None
+
+            bands = {}
+            missing = {}
+            for name, band_index in band_indices.items():
+                band = block[bands_to_read.index(band_index)]
+                raw_band = raw_block[bands_to_read.index(band_index)]
+                if keep is not None:
+                    band = band[keep]
+                    raw_band = raw_band[keep]
+                # NaN isn't less than zero, so the values of uncalibrated bands are tested for separately
+                invalid = ~np.isfinite(band) | (band <= 0.0)
+                if rfl_fill is not None:
+                    invalid |= raw_band == rfl_fill
+                bands[name] = band
+                missing[name] = invalid
+
+            for name, values in calculate_block(definitions, bands, missing).items():
+                if name in statistics:
+                    statistics[name].update(values)
+                if pixels:
+                    if keep is not None:
+                        pixel_values = np.full(keep.shape, FILL_VALUE, dtype=np.float32)
+                        pixel_values[keep] = values
+                        values = pixel_values
+                    dst[name][first_line:last_line, :] = values
+
+        if histogram_edges is not None:
+            dst['histogram_edges'][:] = histogram_edges
+        for name, one_statistics in statistics.items():
+            if aggregate or not pixels:
+                dst[name].setncatts(one_statistics.get_attributes())
+            if not pixels and one_statistics.count:
+                dst[name].assignValue(np.float32(one_statistics.average))
+            if histogram_edges is not None:
+                dst[name + '_histogram'][:] = one_statistics.histogram
+                dst[name + '_histogram'].setncatts({'below': one_statistics.below, 'above': one_statistics.above})
+
+    return out_filename
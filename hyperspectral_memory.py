@@ -0,0 +1,248 @@
+"""Estimates the peak memory of calibrating a RAW file and plans how to run the calibration within a memory budget
+"""
+
+import logging
+import resource
+from typing import Optional
+import numpy as np
+import spectral.io.envi as envi
+
+import hyperspectral_bands
+
+# The numpy data types of the ENVI "data type" header values
+ENVI_DATA_TYPES = {
+    1: np.uint8,
+    2: np.int16,
+    3: np.int32,
+    4: np.float32,
+    5: np.float64,
+    12: np.uint16,
+    13: np.uint32,
+    14: np.int64,
+    15: np.uint64
+}
+
+# The memory, in bytes, used by the interpreter and the loaded libraries before any data is read
+BASE_MEMORY = 150 * 1024 * 1024
+
+# The number of EnvironmentLogger readings loaded for a calibration: two hourly files with one reading every 5 seconds
+ENVLOG_READINGS = 2 * 720
+
+# The bytes of memory per reflectance value: the float64 result of dividing by irrad2dn and its float32 copy made when
+# writing to the netCDF file
+REFLECTANCE_VALUE_BYTES = np.dtype(np.float64).itemsize + np.dtype(np.float32).itemsize
+
+# The bytes per reflectance value of packing a block, by packing mode: the peak while packing (the float64 scaled,
+# rounded and clipped values, or the float64 errors of half precision values, along with the masks) and the packed value
+PACKING_VALUE_BYTES = {
+    'uint16': (33, 2),
+    'int16': (33, 2),
+    'half': (29, 4)
+}
+
+# The bytes per value of a band binned block: the float64 sums of the bands and their means
+BAND_BIN_VALUE_BYTES = 2 * np.dtype(np.float64).itemsize
+
+# The bytes per value of a block being added to the overviews: the float64 sums of pairs of lines (4 bytes per value of
+# the block), their sums along the samples (2 bytes), the means (2 bytes), and the float32 means written (1 byte)
+OVERVIEW_VALUE_BYTES = 9
+
+# The bytes per value of an unpacked reflectance block held by the chunks queued for the Zarr store
+STORE_VALUE_BYTES = np.dtype(np.float32).itemsize
+
+MEGABYTE = 1024 * 1024
+
+
+class MemoryPlan():
+    """How a RAW file is to be calibrated, along with the estimated peak memory of each stage
+    """
+
+    def __init__(self, block_lines: int, stages: dict, budget: Optional[int]):
+        """Initializes class instance
+        Arguments:
+            block_lines: the number of scan lines to calibrate at one time; zero to calibrate the entire image at once
+            stages: the estimated bytes of memory held by each stage at the time of the peak
+            budget: the number of bytes available for the calibration; None if there's no limit
+        """
+        self.block_lines = block_lines
+        self.stages = stages
+        self.budget = budget
+
+    @property
+    def mode(self) -> str:
+        """Returns the name of the execution mode
+        """
+        return 'stream' if self.block_lines > 0 else 'whole'
+
+    @property
+    def required(self) -> int:
+        """Returns the estimated number of bytes that can't be reclaimed by the system while calibrating
+        """
+        return sum(size for name, size in self.stages.items() if name != 'raw_pages')
+
+    @property
+    def peak(self) -> int:
+        """Returns the estimated peak resident memory, including the memory mapped RAW file pages
+        """
+        return sum(self.stages.values())
+
+    @property
+    def fits(self) -> bool:
+        """Returns whether the plan fits in the budget
+        """
+        return self.budget is None or self.required <= self.budget
+
+    def describe(self) -> str:
+        """Returns a description of the plan for logging
+        """
+        stages = ' '.join(['%s=%.1fMB' % (name, size / MEGABYTE) for name, size in self.stages.items()])
+        budget = 'unlimited' if self.budget is None else '%.1fMB' % (self.budget / MEGABYTE)
+        return "mode=%s block_lines=%s %s required=%.1fMB peak=%.1fMB budget=%s" % \
+               (self.mode, str(self.block_lines), stages, self.required / MEGABYTE, self.peak / MEGABYTE, budget)
+
+
+def get_image_info(hdr_filename: str) -> tuple:
+    """Returns the dimensions and data type of a RAW file from its header
+    Arguments:
+        hdr_filename: the path to the ENVI header file
+    Return:
+        Returns a tuple of the number of lines, samples, bands, and the numpy data type of the values
+    """
+    header = envi.read_envi_header(hdr_filename)
+    data_type = ENVI_DATA_TYPES.get(int(header.get('data type', 12)), np.uint16)
+    return int(header['lines']), int(header['samples']), int(header['bands']), np.dtype(data_type)
+
+
+def estimate_stages(image_info: tuple, camera_type: str, num_bands: Optional[int], num_bands_irradiance: Optional[int],
+                    block_lines: int, copy_memory: int, packing: Optional[str] = None,
+                    bins: Optional[hyperspectral_bands.BandBins] = None, overviews: int = 0, store: bool = False,
+                    convert_memory: int = 0) -> dict:
+    """Estimates the memory of each stage of calibrating a RAW file
+    Arguments:
+        image_info: the lines, samples, bands and data type of the RAW file as returned by get_image_info()
+        camera_type: the string representing the camera type
+        num_bands: the number of bands that have calibration values; None if all bands are calibrated
+        num_bands_irradiance: the number of bands in each irradiance spectrum; None if not calibrated
+        block_lines: the number of scan lines to calibrate at one time; zero to calibrate the entire image at once
+        copy_memory: the number of bytes read at one time when copying variables to a new netCDF file; zero if the
+                     file is updated in place
+        packing: the reflectance packing mode, one of the keys of PACKING_VALUE_BYTES; None if it's not packed
+        bins: the bins of the band profile the reflectance is written with; None if all the bands are written
+        overviews: the number of overview levels built from the blocks
+        store: whether the blocks are also written to a Zarr store
+        convert_memory: the bytes of the buffer converting the RAW file to netCDF before calibrating; zero if the RAW
+                        file isn't converted
+    Return:
+        Returns a dictionary of the estimated bytes held by each stage at the time of the peak
+    Notes:
+        The stages of the optional features are only included when they're used. Converting the RAW file happens
+        before calibrating, but its buffer is still counted since the chunk cache reading a compressed xps_img holds up
+        to as many scan lines
+    """
+    lines, samples, bands, data_type = image_info
+    if camera_type == 'swir_old_middle':
+        # The raw values are written without calibration, only needing a copy of the values as float32
+        value_bytes = np.dtype(np.float32).itemsize
+        num_irradiance_bytes = 0
+        # The raw values aren't reflectance and aren't packed
+        packing = None
+    else:
+        value_bytes = REFLECTANCE_VALUE_BYTES
+        num_irradiance_bytes = ENVLOG_READINGS * (num_bands_irradiance or 0) * np.dtype(np.float64).itemsize
+    calibrated_bands = num_bands or bands
+    # The bands read and calibrated, the bands written, and the bands of rfl_img including any uncalibrated bands
+    read_bands, written_bands, rfl_bands = calibrated_bands, calibrated_bands, bands
+    if bins is not None:
+        read_bands, written_bands, rfl_bands = bins.stop - bins.first, bins.num_bins, bins.num_bins
+    block_values = (block_lines if 0 < block_lines < lines else lines) * samples
+
+    stages = {
+        'base': BASE_MEMORY,
+        # the parsed readings and their copy in the irradiance timeline
+        'envlog': 2 * num_irradiance_bytes,
+        'raw_pages': lines * samples * bands * data_type.itemsize,
+        'reflectance': block_values * read_bands * value_bytes,
+        'netcdf_copy': copy_memory
+    }
+    if convert_memory > 0:
+        stages['convert'] = convert_memory
+        # the block of raw values read from xps_img
+        stages['converted_block'] = block_values * read_bands * data_type.itemsize
+    if bins is not None and bins.binned:
+        stages['band_profile'] = block_values * written_bands * BAND_BIN_VALUE_BYTES
+    stored_bytes = STORE_VALUE_BYTES
+    if packing is not None:
+        packing_bytes, stored_bytes = PACKING_VALUE_BYTES[packing]
+        stages['packing'] = block_values * written_bands * packing_bytes
+    if overviews > 0:
+        stages['overviews'] = block_values * written_bands * OVERVIEW_VALUE_BYTES
+    if store:
+        # the previous block held by the chunks queued for compression, and the block with any uncalibrated bands
+        # filled in
+        stages['store'] = block_values * rfl_bands * stored_bytes * (1 if written_bands == rfl_bands else 2)
+    return stages
+
+
+def plan_calibration(image_info: tuple, camera_type: str, num_bands: Optional[int],
+                     num_bands_irradiance: Optional[int], block_lines: int, copy_memory: int,
+                     budget: Optional[int], packing: Optional[str] = None,
+                     bins: Optional[hyperspectral_bands.BandBins] = None, overviews: int = 0, store: bool = False,
+                     convert_memory: int = 0) -> MemoryPlan:
+    """Plans a calibration that fits in a memory budget
+    Arguments:
+        image_info: the lines, samples, bands and data type of the RAW file as returned by get_image_info()
+        camera_type: the string representing the camera type
+        num_bands: the number of bands that have calibration values; None if all bands are calibrated
+        num_bands_irradiance: the number of bands in each irradiance spectrum; None if not calibrated
+        block_lines: the requested number of scan lines to calibrate at one time; zero to calibrate the entire image
+        copy_memory: the number of bytes read at one time when copying variables to a new netCDF file; zero if the
+                     file is updated in place
+        budget: the number of bytes available for the calibration; None if there's no limit
+        packing: the reflectance packing mode, one of the keys of PACKING_VALUE_BYTES; None if it's not packed
+        bins: the bins of the band profile the reflectance is written with; None if all the bands are written
+        overviews: the number of overview levels built from the blocks
+        store: whether the blocks are also written to a Zarr store
+        convert_memory: the bytes of the buffer converting the RAW file to netCDF before calibrating; zero if the RAW
+                        file isn't converted
+    Return:
+        Returns the plan using the requested number of scan lines if it fits, otherwise the largest number of scan lines
+        that fits. If nothing fits, the plan for one scan line at a time is returned
+    """
+    def make_plan(lines: int) -> MemoryPlan:
+        return MemoryPlan(lines, estimate_stages(image_info, camera_type, num_bands, num_bands_irradiance, lines,
+                                                 copy_memory, packing, bins, overviews, store, convert_memory), budget)
+
+    plan = make_plan(block_lines)
+    if plan.fits:
+        return plan
+
+    # Every stage holding a block grows with the number of scan lines, so the largest number that fits is searched for
+    low, high = 1, max(1, image_info[0] - 1)
+    if block_lines > 0:
+        high = min(high, block_lines - 1)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if make_plan(middle).fits:
+            low = middle
+        else:
+            high = middle - 1
+    return make_plan(low)
+
+
+def get_peak_memory() -> int:
+    """Returns the peak resident memory of this process so far
+    Return:
+        Returns the number of bytes
+    """
+    # Linux reports the maximum resident set size in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def log_actual(plan: MemoryPlan) -> None:
+    """Logs the estimated peak memory of a plan along with the actual peak memory of the process
+    Arguments:
+        plan: the plan that was used
+    """
+    actual = get_peak_memory()
+    logging.info("Memory estimate %.1fMB, actual peak %.1fMB (%+.1f%%)", plan.peak / MEGABYTE, actual / MEGABYTE,
+                 100.0 * (actual - plan.peak) / plan.peak if plan.peak else 0.0)
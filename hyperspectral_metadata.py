@@ -83,7 +83,7 @@ import re
 import math
 from datetime import date, datetime, timedelta
 from netCDF4 import Dataset, stringtochar
-from hyperspectral_calculation import pixel2Geographic, solar_zenith_angle, REFERENCE_POINT
+from hyperspectral_calculation import pixel2Geographic, solar_zenith_angles, REFERENCE_POINT
 
 _UNIT_DICTIONARY = {'m':   'meter',
                     's':   'second', 
@@ -111,6 +111,16 @@ _WARN_MSG         = "{msg}"
 
 NCATTRS = {"_FillValue" : 1e36}
 
+_UNIX_BASEDATE       = date(year=1970, month=1, day=1)
+
+_GANTRY_DATE_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+_GANTRY_TIME_PATTERN = re.compile(r'(\d{2})/(\d{2})/(\d{4})\s(\d{2}):(\d{2}):(\d{2})')
+
+# The frame times in *frameIndex.txt are HH:MM:SS, with the colons and digits at these positions
+_FRAME_TIME_WIDTH    = 8
+_FRAME_TIME_COLONS   = [2, 5]
+_FRAME_TIME_DIGITS   = [0, 1, 3, 4, 6, 7]
+
 
 class DataContainer(object):
     '''
@@ -204,7 +214,7 @@ class DataContainer(object):
         setattr(frameTime, "notes",    "date stamp per each scanline")
 
         solar_zenith_ang = netCDFHandler.createVariable("solar_zenith_angle", "f8", ("time",))
-        solar_zenith_ang[...] = [solar_zenith_angle(datetime(year=1970,month=1,day=1)+timedelta(days=time_member)) for time_member in tempFrameTime]
+        solar_zenith_ang[...] = solar_zenith_angles(tempFrameTime)
         setattr(solar_zenith_ang, "units", "degree")
         setattr(solar_zenith_ang, "long_name", "Solar Zenith Angle")
         setattr(solar_zenith_ang, "acknowledgements", "Algorithm provided by Charles S. Zender, this Python implementation was translated from his original C program")
@@ -609,35 +619,68 @@ def jsonHandler(jsonFile, _debug=True):
             jsonCheck(fileHandler)
         return json.loads(fileHandler.read(), object_hook=_filter_the_headings)
 
-def translate_time(gantry_system_time, frameTimeString=None):
-    hourUnpack, timeUnpack = None, None
-    _unix_basetime    = date(year=1970, month=1, day=1)
-    time_pattern      = re.compile(r'(\d{4})-(\d{2})-(\d{2})'),\
-                        re.compile(r'(\d{2})/(\d{2})/(\d{4})\s(\d{2}):(\d{2}):(\d{2})'),\
-                        re.compile(r'(\d{2}):(\d{2}):(\d{2})')
-    if frameTimeString:
-        hourUnpack = datetime.strptime(frameTimeString, "%H:%M:%S").timetuple()
-    
-    if time_pattern[1].match(gantry_system_time):
+def _unix_day_seconds(gantry_system_time):
+    '''
+    seconds from the UNIX basetime to the start of the day of the gantry system time
+    '''
+    timeUnpack = None
+    if _GANTRY_TIME_PATTERN.match(gantry_system_time):
         timeUnpack = datetime.strptime(gantry_system_time, "%m/%d/%Y %H:%M:%S").timetuple()
-    elif time_pattern[0].match(gantry_system_time):
+    elif _GANTRY_DATE_PATTERN.match(gantry_system_time):
         timeUnpack = datetime.strptime(gantry_system_time, "%Y-%m-%d").timetuple()
 
     timeSplit  = date(year=timeUnpack.tm_year, month=timeUnpack.tm_mon,
-                      day=timeUnpack.tm_mday) - _unix_basetime #time period to the UNIX basetime
+                      day=timeUnpack.tm_mday) - _UNIX_BASEDATE #time period to the UNIX basetime
+    return timeSplit.total_seconds()
+
+def translate_time(gantry_system_time, frameTimeString=None):
+    hourUnpack = None
+    if frameTimeString:
+        hourUnpack = datetime.strptime(frameTimeString, "%H:%M:%S").timetuple()
+
+    daySeconds = _unix_day_seconds(gantry_system_time)
     if frameTimeString:
-        return (timeSplit.total_seconds() + hourUnpack.tm_hour * 3600.0 + hourUnpack.tm_min * 60.0 +
+        return (daySeconds + hourUnpack.tm_hour * 3600.0 + hourUnpack.tm_min * 60.0 +
                 hourUnpack.tm_sec) / (3600.0 * 24.0)
     else:
-        return timeSplit.total_seconds() / (3600.0 * 24.0)
+        return daySeconds / (3600.0 * 24.0)
 
 def frame_index_parser(fileName, gantry_system_time):
     '''
     translate all the time in *frameIndex.txt
+
+    The gantry date is parsed once and the frame times written as HH:MM:SS are converted together, adding the
+    hours, minutes and seconds in the same order as translate_time() so the days are the same to the last bit.
+    Any other frame time (such as "9:05:07") goes through translate_time() on its own
     '''
     with open(fileName) as fileHandler:
-        return [translate_time(gantry_system_time, dataMembers.split()[1]) for dataMembers in fileHandler.readlines()[1:]]
-
+        frameTimeStrings = [dataMembers.split()[1] for dataMembers in fileHandler.readlines()[1:]]
+    if not frameTimeStrings:
+        return np.zeros((0,), dtype=np.float64)
+
+    # One row of character codes per frame time; shorter strings are padded with zeros
+    characters = np.array(frameTimeStrings)
+    codes = characters.view(np.uint32).reshape((len(frameTimeStrings), -1))
+    regular = np.ones((codes.shape[0],), dtype=bool)
+    if codes.shape[1] < _FRAME_TIME_WIDTH:
+        regular[:] = False
+    else:
+        regular &= np.all(codes[:, _FRAME_TIME_WIDTH:] == 0, axis=1)
+        regular &= np.all(codes[:, _FRAME_TIME_COLONS] == ord(':'), axis=1)
+        digits = codes[:, :_FRAME_TIME_WIDTH].astype(np.int64) - ord('0')
+        regular &= np.all((digits[:, _FRAME_TIME_DIGITS] >= 0) & (digits[:, _FRAME_TIME_DIGITS] <= 9), axis=1)
+        hours, minutes, seconds = [digits[:, index] * 10 + digits[:, index + 1] for index in (0, 3, 6)]
+        # The same ranges datetime.strptime() accepts, so the times it would reject still raise its error below
+        regular &= (hours <= 23) & (minutes <= 59) & (seconds <= 59)
+
+    frameTime = np.empty((codes.shape[0],), dtype=np.float64)
+    if np.any(regular):
+        daySeconds = _unix_day_seconds(gantry_system_time)
+        frameTime[regular] = (daySeconds + hours[regular] * 3600.0 + minutes[regular] * 60.0 +
+                              seconds[regular]) / (3600.0 * 24.0)
+    for index in np.flatnonzero(~regular):
+        frameTime[index] = translate_time(gantry_system_time, frameTimeStrings[index])
+    return frameTime
 
 def file_dependency_check(filePath):
     '''
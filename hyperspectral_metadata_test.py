@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+
+import hyperspectral_metadata
+
+'''
+Test for hyperspectral_metadata
+
+Checks that the frame times read from a *frameIndex.txt file in bulk match the times translated one frame at a time.
+
+==============================================================================
+To run the test from the commandline, do:
+python hyperspectral_metadata_test.py
+'''
+
+# The gantry system times in both of the formats found in the metadata
+GANTRY_SYSTEM_TIMES = ('03/31/2019 12:38:49', '2016-02-29')
+
+# Every second of a day as HH:MM:SS, including the edges of the day
+REGULAR_FRAME_TIMES = ['%02d:%02d:%02d' % (second // 3600, second // 60 % 60, second % 60)
+                       for second in range(0, 86400, 7)] + ['00:00:00', '23:59:59']
+
+# Frame times that strptime() accepts but that aren't two digits per field
+IRREGULAR_FRAME_TIMES = ['9:05:07', '09:5:07', '09:05:7', '0:0:0', '1:2:3']
+
+# Frame times that strptime() rejects, some of which look like HH:MM:SS
+REJECTED_FRAME_TIMES = ['23:59:60', '24:00:00', '12:60:00', 'ab:cd:ef', '12-00-00', '12:00:00.5']
+
+
+class HyperspectralMetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'abc_frameIndex.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_frame_index(self, frame_times):
+        '''Writes a *frameIndex.txt file with a header line and one numbered line per frame time'''
+        with open(self.filename, 'w') as file_handler:
+            file_handler.write('Frame# Time\n')
+            for index, frame_time in enumerate(frame_times):
+                file_handler.write('%d %s\n' % (index + 1, frame_time))
+
+    def testRegularTimesMatchOneFrameAtATime(self):
+        self.write_frame_index(REGULAR_FRAME_TIMES)
+        for gantry_system_time in GANTRY_SYSTEM_TIMES:
+            expected = [hyperspectral_metadata.translate_time(gantry_system_time, one_time)
+                        for one_time in REGULAR_FRAME_TIMES]
+            # The days need to be the same to the last bit
+            np.testing.assert_array_equal(hyperspectral_metadata.frame_index_parser(self.filename,
+                                                                                    gantry_system_time),
+                                          np.array(expected, dtype=np.float64), err_msg=gantry_system_time)
+
+    def testRegularTimesAreConvertedTogether(self):
+        self.write_frame_index(REGULAR_FRAME_TIMES)
+        with mock.patch.object(hyperspectral_metadata, 'translate_time') as translate_time:
+            hyperspectral_metadata.frame_index_parser(self.filename, GANTRY_SYSTEM_TIMES[0])
+        translate_time.assert_not_called()
+
+    def testIrregularTimesMatchOneFrameAtATime(self):
+        frame_times = REGULAR_FRAME_TIMES[:50] + IRREGULAR_FRAME_TIMES + REGULAR_FRAME_TIMES[50:100]
+        self.write_frame_index(frame_times)
+        for gantry_system_time in GANTRY_SYSTEM_TIMES:
+            expected = [hyperspectral_metadata.translate_time(gantry_system_time, one_time)
+                        for one_time in frame_times]
+            np.testing.assert_array_equal(hyperspectral_metadata.frame_index_parser(self.filename,
+                                                                                    gantry_system_time),
+                                          np.array(expected, dtype=np.float64), err_msg=gantry_system_time)
+
+    def testOnlyIrregularTimes(self):
+        self.write_frame_index(IRREGULAR_FRAME_TIMES)
+        expected = [hyperspectral_metadata.translate_time(GANTRY_SYSTEM_TIMES[1], one_time)
+                    for one_time in IRREGULAR_FRAME_TIMES]
+        np.testing.assert_array_equal(hyperspectral_metadata.frame_index_parser(self.filename, GANTRY_SYSTEM_TIMES[1]),
+                                      np.array(expected, dtype=np.float64))
+
+    def testRejectedTimesRaiseTheSameError(self):
+        for frame_time in REJECTED_FRAME_TIMES:
+            with self.assertRaises(ValueError) as expected:
+                hyperspectral_metadata.translate_time(GANTRY_SYSTEM_TIMES[0], frame_time)
+            self.write_frame_index(REGULAR_FRAME_TIMES[:10] + [frame_time] + REGULAR_FRAME_TIMES[10:20])
+            with self.assertRaises(ValueError) as raised:
+                hyperspectral_metadata.frame_index_parser(self.filename, GANTRY_SYSTEM_TIMES[0])
+            self.assertEqual(str(raised.exception), str(expected.exception), msg=frame_time)
+
+    def testNoFrames(self):
+        self.write_frame_index([])
+        frame_time = hyperspectral_metadata.frame_index_parser(self.filename, GANTRY_SYSTEM_TIMES[0])
+        self.assertEqual(frame_time.shape, (0,))
+        self.assertEqual(frame_time.dtype, np.float64)
+
+
+if __name__ == "__main__":
+    unittest.main()
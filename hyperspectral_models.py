@@ -0,0 +1,138 @@
+"""Calibration models used to convert irradiance to raw image values
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import threading
+from typing import Optional
+import numpy as np
+
+# The files making up a calibration model, found in the calibration_new/<camera type> folders
+MODEL_FILES = ['best_matched_index.npy', 'bias_coeff.npy', 'gain_coeff.npy']
+
+# The default number of irradiance to DN conversions to keep
+DEFAULT_IRRAD2DN_CACHE_SIZE = 64
+
+
+class CalibrationModel():
+    """The pre-computed calibration coefficients of a camera
+    """
+
+    def __init__(self, model_folder: str):
+        """Initializes class instance by loading the model files
+        Arguments:
+            model_folder: the folder containing the model files
+        """
+        self.model_folder = model_folder
+        self.mtimes = self.get_mtimes(model_folder)
+
+        # The coefficients are memory mapped so that processes sharing a model share the same pages
+        self.best_matched_index = np.load(os.path.join(model_folder, 'best_matched_index.npy')).astype(int)
+        self.bias = np.load(os.path.join(model_folder, 'bias_coeff.npy'), mmap_mode='r')
+        self.gain = np.load(os.path.join(model_folder, 'gain_coeff.npy'), mmap_mode='r')
+
+    @staticmethod
+    def get_mtimes(model_folder: str) -> tuple:
+        """Returns the modification times of the model files
+        Arguments:
+            model_folder: the folder containing the model files
+        Return:
+            Returns a tuple of the modification times
+        """
+        return tuple(os.stat(os.path.join(model_folder, one_file)).st_mtime_ns for one_file in MODEL_FILES)
+
+    def is_current(self) -> bool:
+        """Checks if the model files have changed since they were loaded
+        Return:
+            Returns True if the loaded model is current and False if the files have changed
+        """
+        try:
+            return self.get_mtimes(self.model_folder) == self.mtimes
+        except OSError:
+            return False
+
+    def get_irrad2dn(self, mean_spectrum: np.ndarray, num_spectral_bands: int,
+                     num_bands: Optional[int] = None) -> np.ndarray:
+        """Computes the irradiance to DN conversion for a mean irradiance spectrum
+        Arguments:
+            mean_spectrum: the mean irradiance spectrum for the image
+            num_spectral_bands: the number of spectral bands of the camera
+            num_bands: the number of bands that have calibration values; None if all bands are calibrated
+        Return:
+            Returns the conversion values with a shape of (1, bands)
+        """
+        # Select the irradiance bands that best match the image bands
+        test_irridance = mean_spectrum[self.best_matched_index.tolist()]
+        test_irridance_re = np.resize(test_irridance, (1, num_spectral_bands))
+        if num_bands is not None:
+            test_irridance_re = test_irridance_re[:, 0:num_bands]
+
+        return (self.gain * test_irridance_re) + self.bias
+
+
+class CalibrationRegistry():
+    """Process wide store of the loaded calibration models and the irradiance to DN conversions computed with them
+    """
+
+    def __init__(self, irrad2dn_cache_size: int = DEFAULT_IRRAD2DN_CACHE_SIZE):
+        """Initializes class instance
+        Arguments:
+            irrad2dn_cache_size: the maximum number of irradiance to DN conversions to keep
+        """
+        self.models = {}
+        self.irrad2dn = collections.OrderedDict()
+        self.irrad2dn_cache_size = irrad2dn_cache_size
+        self.lock = threading.Lock()
+
+    def get_model(self, model_folder: str) -> CalibrationModel:
+        """Returns the calibration model found in a folder, loading it if needed
+        Arguments:
+            model_folder: the folder containing the model files
+        Return:
+            Returns the calibration model
+        """
+        with self.lock:
+            model = self.models.get(model_folder)
+            if model is None or not model.is_current():
+                logging.debug("Loading calibration model from '%s'", model_folder)
+                model = CalibrationModel(model_folder)
+                self.models[model_folder] = model
+                # Drop any conversions computed with an older version of the model
+                for key in [key for key in self.irrad2dn if key[0] == model_folder]:
+                    del self.irrad2dn[key]
+            return model
+
+    def get_irrad2dn(self, model_folder: str, mean_spectrum: np.ndarray, num_spectral_bands: int,
+                     num_bands: Optional[int] = None) -> np.ndarray:
+        """Returns the irradiance to DN conversion for a mean irradiance spectrum, computing it if needed
+        Arguments:
+            model_folder: the folder containing the model files
+            mean_spectrum: the mean irradiance spectrum for the image
+            num_spectral_bands: the number of spectral bands of the camera
+            num_bands: the number of bands that have calibration values; None if all bands are calibrated
+        Return:
+            Returns the conversion values with a shape of (1, bands)
+        Notes:
+            The returned array is shared with other callers and must not be modified
+        """
+        model = self.get_model(model_folder)
+        spectrum = np.ascontiguousarray(mean_spectrum, dtype=np.float64)
+        key = (model_folder, num_spectral_bands, num_bands, hashlib.sha1(spectrum.tobytes()).hexdigest())
+
+        with self.lock:
+            irrad2dn = self.irrad2dn.get(key)
+            if irrad2dn is not None:
+                self.irrad2dn.move_to_end(key)
+                return irrad2dn
+
+        irrad2dn = model.get_irrad2dn(spectrum, num_spectral_bands, num_bands)
+        irrad2dn.setflags(write=False)
+
+        with self.lock:
+            self.irrad2dn[key] = irrad2dn
+            while len(self.irrad2dn) > self.irrad2dn_cache_size:
+                self.irrad2dn.popitem(last=False)
+
+        return irrad2dn
@@ -0,0 +1,231 @@
+"""Builds spatially averaged overviews of an image cube while its blocks of scan lines are being written
+
+Each overview level averages 2 x 2 pixels of the level below it, so the levels are 2x, 4x, 8x, ... smaller than the
+cube in both y and x. Levels are stored in the same file as the cube, as variables named after the cube with an
+"_ovr<factor>" suffix on their own y and x dimensions. Reading a level only reads its own, much smaller, variable
+"""
+
+import logging
+import re
+from typing import Optional
+import numpy as np
+
+# The number of pixels along y and x averaged into one pixel of the next level
+LEVEL_FACTOR = 2
+
+# The suffix of the names of overview variables and dimensions, followed by the factor of the level
+OVERVIEW_SUFFIX = '_ovr'
+
+# The attribute of an overview variable holding its factor
+FACTOR_ATTRIBUTE = 'overview_factor'
+
+
+def get_overview_name(name: str, factor: int) -> str:
+    """Returns the name of the overview of a variable or dimension
+    Arguments:
+        name: the name of the variable or dimension
+        factor: the factor of the overview level
+    """
+    return name + OVERVIEW_SUFFIX + str(factor)
+
+
+def is_overview_name(name: str) -> bool:
+    """Returns whether a variable or dimension name is the name of an overview
+    Arguments:
+        name: the name to check
+    """
+    return re.search(re.escape(OVERVIEW_SUFFIX) + r'\d+$', name) is not None
+
+
+def sum_pairs(values: np.ndarray, axis: int) -> np.ndarray:
+    """Sums each pair of values along an axis, with an odd last value kept on its own
+    Arguments:
+        values: the values to sum
+        axis: the axis to sum along
+    """
+    def along_axis(start: int, stop: Optional[int], step: Optional[int] = None) -> tuple:
+        index = [slice(None)] * values.ndim
+        index[axis] = slice(start, stop, step)
+        return tuple(index)
+
+    size = values.shape[axis]
+    pairs = size // LEVEL_FACTOR
+    shape = list(values.shape)
+    shape[axis] = -(-size // LEVEL_FACTOR)
+    # Adding strided views is several times faster than np.add.reduceat()
+    result = np.empty(shape, dtype=values.dtype)
+    np.add(values[along_axis(0, pairs * LEVEL_FACTOR, LEVEL_FACTOR)],
+           values[along_axis(1, pairs * LEVEL_FACTOR, LEVEL_FACTOR)], out=result[along_axis(0, pairs)])
+    if size % LEVEL_FACTOR:
+        result[along_axis(pairs, None)] = values[along_axis(pairs * LEVEL_FACTOR, None)]
+    return result
+
+
+class OverviewLevel():
+    """Sums pairs of lines and samples of the level below, and writes the means of the lines that are complete
+    """
+
+    def __init__(self, variable, sample_counts: np.ndarray, num_bands: Optional[int] = None):
+        """Initializes class instance
+        Arguments:
+            variable: the (wavelength, y, x) netCDF variable of the level
+            sample_counts: the number of cube samples summed into each sample of the level below
+            num_bands: the number of bands the values cover with any remaining bands set to NaN; None indicates the
+                       values cover all bands
+        """
+        self.variable = variable
+        self.sample_counts = sum_pairs(sample_counts, 0)
+        self.num_bands = num_bands
+        self.next_line = 0
+        # The sums and count of the last line of the level below when it's waiting for the line it's paired with
+        self.pending = None
+
+    def add(self, sums: np.ndarray, line_counts: np.ndarray) -> Optional[tuple]:
+        """Adds lines of the level below and writes the lines of this level that are complete
+        Arguments:
+            sums: the (bands, lines, samples) sums of lines of the level below
+            line_counts: the number of cube lines summed into each of the lines
+        Return:
+            Returns the sums and line counts of the lines written, for the next level; None if no lines were written
+        """
+        parts = []
+        if self.pending is not None and sums.shape[1] > 0:
+            pending_sums, pending_count = self.pending
+            self.pending = None
+            parts.append((np.add(pending_sums, sums[:, :1], dtype=np.float64),
+                          np.array([pending_count + line_counts[0]])))
+            sums, line_counts = sums[:, 1:], line_counts[1:]
+        if sums.shape[1] % LEVEL_FACTOR:
+            # The odd line waits for the first line of the next block
+            self.pending = (np.array(sums[:, -1:], dtype=np.float64), line_counts[-1])
+            sums, line_counts = sums[:, :-1], line_counts[:-1]
+        if sums.shape[1] > 0:
+            # Summing in double precision also keeps integer values from overflowing
+            parts.append((np.add(sums[:, 0::LEVEL_FACTOR], sums[:, 1::LEVEL_FACTOR], dtype=np.float64),
+                          line_counts[0::LEVEL_FACTOR] + line_counts[1::LEVEL_FACTOR]))
+        if not parts:
+            return None
+
+        # Each part is summed along the samples before joining them, keeping the copy small
+        level_sums = [sum_pairs(one_part[0], 2) for one_part in parts]
+        level_line_counts = [one_part[1] for one_part in parts]
+        for one_sums, one_counts in zip(level_sums, level_line_counts):
+            self.write(one_sums, one_counts)
+        if len(parts) == 1:
+            return level_sums[0], level_line_counts[0]
+        return np.concatenate(level_sums, axis=1), np.concatenate(level_line_counts)
+
+    def flush(self) -> Optional[tuple]:
+        """Writes the last line on its own when the level below has an odd number of lines
+        Return:
+            Returns the sums and line counts of the line written, for the next level; None if there wasn't a line
+        """
+        if self.pending is None:
+            return None
+        pending_sums, pending_count = self.pending
+        self.pending = None
+        level_sums = sum_pairs(pending_sums, 2)
+        level_line_counts = np.array([pending_count])
+        self.write(level_sums, level_line_counts)
+        return level_sums, level_line_counts
+
+    def write(self, sums: np.ndarray, line_counts: np.ndarray) -> None:
+        """Writes the means of lines of this level
+        Arguments:
+            sums: the (bands, lines, samples) sums of the lines
+            line_counts: the number of cube lines summed into each line
+        """
+        # Converting to the variable's type here is faster than leaving it to the netCDF library
+        means = (sums / np.outer(line_counts, self.sample_counts)[np.newaxis, :, :]).astype(self.variable.dtype)
+        last_line = self.next_line + means.shape[1]
+        if self.num_bands is None:
+            self.variable[:, self.next_line:last_line, :] = means
+        else:
+            self.variable[:self.num_bands, self.next_line:last_line, :] = means
+            self.variable[self.num_bands:, self.next_line:last_line, :] = np.nan
+        self.next_line = last_line
+
+
+class OverviewBuilder():
+    """Creates the overview variables of a cube and fills them from the blocks of scan lines written to the cube
+    """
+
+    def __init__(self, cube_variable, num_levels: int, num_bands: Optional[int] = None):
+        """Initializes class instance, creating the dimensions and variables of the overviews when they're missing
+        Arguments:
+            cube_variable: the (wavelength, y, x) netCDF variable being written
+            num_levels: the number of overview levels
+            num_bands: the number of bands the blocks cover with any remaining bands set to NaN; None indicates the
+                       blocks cover all bands
+        Exceptions:
+            Raises RuntimeError if an existing overview dimension has a different size
+        """
+        dataset = cube_variable.group()
+        band_dim, line_dim, sample_dim = cube_variable.dimensions
+        _, num_lines, num_samples = cube_variable.shape
+
+        self.levels = []
+        sample_counts = np.ones((num_samples,), dtype=np.int64)
+        for level_number in range(1, num_levels + 1):
+            factor = LEVEL_FACTOR ** level_number
+            dimensions = [band_dim]
+            for dim_name, size in ((line_dim, num_lines), (sample_dim, num_samples)):
+                name = get_overview_name(dim_name, factor)
+                level_size = -(-size // factor)
+                if name not in dataset.dimensions:
+                    dataset.createDimension(name, level_size)
+                elif len(dataset.dimensions[name]) != level_size:
+                    raise RuntimeError("Overview dimension %s has %s entries instead of %s" %
+                                       (name, str(len(dataset.dimensions[name])), str(level_size)))
+                if dim_name in dataset.variables and name not in dataset.variables:
+                    # The coordinates of an overview pixel are the mean of the coordinates of its cube pixels
+                    coordinate = dataset[dim_name]
+                    values = np.asarray(coordinate[:], dtype=np.float64)
+                    level_variable = dataset.createVariable(name, coordinate.datatype, (name,))
+                    level_variable.setncatts({key: coordinate.getncattr(key) for key in coordinate.ncattrs()
+                                              if key != '_FillValue'})
+                    starts = np.arange(0, values.size, factor)
+                    level_variable[:] = np.add.reduceat(values, starts) / np.diff(np.append(starts, values.size))
+                dimensions.append(name)
+
+            name = get_overview_name(cube_variable.name, factor)
+            if name not in dataset.variables:
+                dataset.createVariable(name, 'f4', tuple(dimensions))
+            variable = dataset[name]
+            variable.setncatts({'long_name': '%sx overview of %s' % (str(factor), cube_variable.name),
+                                FACTOR_ATTRIBUTE: np.int32(factor),
+                                'cell_methods': '%s: mean %s: mean' % (line_dim, sample_dim)})
+
+            level = OverviewLevel(variable, sample_counts, num_bands)
+            sample_counts = level.sample_counts
+            self.levels.append(level)
+        logging.debug("Writing %s overview levels of %s", str(num_levels), cube_variable.name)
+
+    def cascade(self, first_level: int, sums: np.ndarray, line_counts: np.ndarray) -> None:
+        """Adds lines to a level and passes the lines it completes up to the next levels
+        Arguments:
+            first_level: the index of the level to add the lines to
+            sums: the (bands, lines, samples) sums of the lines of the level below
+            line_counts: the number of cube lines summed into each of the lines
+        """
+        for level in self.levels[first_level:]:
+            result = level.add(sums, line_counts)
+            if result is None:
+                return
+            sums, line_counts = result
+
+    def add(self, block: np.ndarray) -> None:
+        """Adds the next block of scan lines of the cube
+        Arguments:
+            block: the (bands, lines, samples) values of the scan lines, following the previous block
+        """
+        if self.levels:
+            self.cascade(0, block, np.ones((block.shape[1],), dtype=np.int64))
+
+    def close(self) -> None:
+        """Writes the last line of each level that's waiting for a line that isn't coming
+        """
+        for index, level in enumerate(self.levels):
+            result = level.flush()
+            if result is not None:
+                self.cascade(index + 1, *result)
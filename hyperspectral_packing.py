@@ -0,0 +1,129 @@
+"""Packs the reflectance written to rfl_img into 16 bit integers, or rounds it to half precision
+
+Integer packing follows the CF conventions: the values are stored with scale_factor and add_offset attributes that
+netCDF readers apply when reading them. Half precision values are stored as float32, since netCDF doesn't have a 16 bit
+float type, and compress better once their low bits are zero. The largest error of the values written is recorded in
+attributes of the variable
+"""
+
+import numpy as np
+
+# The integer types reflectance can be packed into: the data type, the fill value, and the range of packed values
+PACKED_TYPES = {
+    'uint16': (np.uint16, np.uint16(65535), 0, 65534),
+    'int16': (np.int16, np.int16(-32768), -32767, 32767)
+}
+
+# Rounds reflectance to half precision while storing it as float32, since netCDF doesn't have a 16 bit float type
+HALF_PACKING = 'half'
+
+# The reflectance packing modes
+PACKING_MODES = tuple(PACKED_TYPES.keys()) + (HALF_PACKING,)
+
+# The default range of reflectance mapped onto the packed integer values
+DEFAULT_PACKING_RANGE = (0.0, 1.5)
+
+# The largest relative error of rounding to half precision: half of the spacing of its 11 significant bits, for values
+# in its normal range (at least 6.1e-5)
+HALF_RELATIVE_ERROR = 2.0 ** -11
+
+# The attributes describing how a variable is packed
+PACKING_ATTRIBUTES = ('scale_factor', 'add_offset', 'valid_range', 'packing_error_bound', 'packing_max_error',
+                      'packing_relative_error_bound', 'packing_max_relative_error', 'packing_clipped_values')
+
+
+class ReflectancePacker():
+    """Packs reflectance into 16 bit integers with CF scale_factor and add_offset attributes, or rounds it to half
+    precision, while keeping track of the error
+    """
+
+    def __init__(self, mode: str, value_range: tuple = DEFAULT_PACKING_RANGE):
+        """Initializes class instance
+        Arguments:
+            mode: one of the PACKING_MODES
+            value_range: the lowest and highest reflectance that's packed into integers; values outside the range are
+                         clipped to it
+        Exceptions:
+            Raises RuntimeError if the mode isn't known or the range is empty
+        """
+        if mode not in PACKING_MODES:
+            raise RuntimeError("Unknown reflectance packing mode '%s'" % mode)
+        if not value_range[1] > value_range[0]:
+            raise RuntimeError("Reflectance packing range %s is empty" % str(value_range))
+        self.mode = mode
+        self.clipped = 0
+        # The largest error of the values packed so far, relative for half precision
+        self.max_error = 0.0
+        if mode == HALF_PACKING:
+            self.datatype = np.dtype(np.float32)
+            self.fill_value = None
+            return
+
+        datatype, self.fill_value, self.packed_min, self.packed_max = PACKED_TYPES[mode]
+        self.datatype = np.dtype(datatype)
+        # Values are packed with the float32 attributes so that unpacking gives back the same values
+        self.scale_factor = np.float32((value_range[1] - value_range[0]) / (self.packed_max - self.packed_min))
+        self.add_offset = np.float32(value_range[0] - self.packed_min * float(self.scale_factor))
+        # Unpacking in float32 adds its own rounding to the rounding of packing
+        self.unpack_error = float(np.finfo(np.float32).eps) * max(abs(value_range[0]), abs(value_range[1]))
+
+    @property
+    def error_bound(self) -> float:
+        """Returns the largest error of an unpacked value within the range, relative for half precision
+        """
+        if self.mode == HALF_PACKING:
+            return HALF_RELATIVE_ERROR
+        return float(self.scale_factor) / 2.0 + self.unpack_error
+
+    def get_attributes(self) -> dict:
+        """Returns the attributes of the packed variable, other than the fill value
+        """
+        if self.mode == HALF_PACKING:
+            return {'packing_relative_error_bound': np.float32(self.error_bound)}
+        return {'scale_factor': self.scale_factor,
+                'add_offset': self.add_offset,
+                'valid_range': np.array([self.packed_min, self.packed_max], dtype=self.datatype),
+                'packing_error_bound': np.float32(self.error_bound)
+                }
+
+    def get_result_attributes(self) -> dict:
+        """Returns the attributes describing the values packed so far
+        """
+        if self.mode == HALF_PACKING:
+            return {'packing_max_relative_error': np.float32(self.max_error)}
+        return {'packing_max_error': np.float32(self.max_error),
+                'packing_clipped_values': np.int64(self.clipped)}
+
+    def pack(self, values: np.ndarray) -> np.ndarray:
+        """Packs reflectance values
+        Arguments:
+            values: the reflectance values; NaN values are stored as the fill value when packing into integers
+        Return:
+            Returns the packed values
+        """
+        values = np.asarray(values)
+        if self.mode == HALF_PACKING:
+            packed = values.astype(np.float16).astype(np.float32)
+            # Values too small for the normal range of half precision have fewer significant bits
+            with np.errstate(invalid='ignore'):
+                normal = np.abs(values) >= np.finfo(np.float16).tiny
+            if normal.any():
+                relative = np.abs(packed[normal] - values[normal]) / np.abs(values[normal])
+                self.max_error = max(self.max_error, float(relative.max()))
+            return packed
+
+        missing = np.isnan(values)
+        scaled = (values - float(self.add_offset)) / float(self.scale_factor)
+        with np.errstate(invalid='ignore'):
+            outside = (scaled < self.packed_min - 0.5) | (scaled > self.packed_max + 0.5)
+            packed = np.clip(np.rint(scaled), self.packed_min, self.packed_max)
+        self.clipped += int(np.count_nonzero(outside))
+        packed[missing] = self.fill_value
+        packed = packed.astype(self.datatype)
+
+        # The error of the values that weren't clipped
+        in_range = ~(missing | outside)
+        if in_range.any():
+            unpacked = packed[in_range] * self.scale_factor + self.add_offset
+            self.max_error = max(self.max_error, float(np.abs(unpacked - values[in_range]).max()))
+        return packed
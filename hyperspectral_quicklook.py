@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""Makes a small RGB preview PNG of a capture from the three "default bands" of its ENVI header
+
+Only the three bands are read, a block of scan lines at a time, either from the RAW file or from the calibrated
+reflectance of a netCDF file. The bands are averaged down to the preview size and each one is stretched between
+percentiles of its values.
+
+Run this file with a RAW file or netCDF file, and the PNG file to create, to make a preview outside the transformer
+"""
+
+import argparse
+import logging
+import os
+import struct
+import zlib
+from typing import Optional
+import numpy as np
+from netCDF4 import Dataset
+import spectral.io.envi as envi
+import hyperspectral_bands
+import hyperspectral_overviews
+
+# The sources of the preview
+QUICKLOOK_SOURCES = ('raw', 'reflectance')
+
+# The suffix replacing ".nc" in the name of the preview file
+QUICKLOOK_SUFFIX = '_quicklook.png'
+
+# The default number of pixels of the longer side of the preview
+DEFAULT_QUICKLOOK_SIZE = 1024
+
+# The percentiles of each band's values that are stretched to black and white
+DEFAULT_STRETCH_PERCENTILES = (2.0, 98.0)
+
+# The red, green and blue wavelengths, in nanometers, used when the header doesn't have default bands
+DEFAULT_RGB_WAVELENGTHS = (640.0, 550.0, 460.0)
+
+# The number of preview rows read at one time
+BLOCK_ROWS = 64
+
+# The PNG file signature and the compression level of its image data
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_COMPRESSION_LEVEL = 6
+
+
+def get_header_bands(hdr_filename: str) -> tuple:
+    """Returns the RGB bands and the band wavelengths of a RAW file
+    Arguments:
+        hdr_filename: the path of the ENVI header file
+    Return:
+        Returns a tuple of the zero based (red, green, blue) band indexes and the wavelengths of all the bands in
+        nanometers (None if the header doesn't have them)
+    Notes:
+        The header's "default bands" are numbered from one. Without them, the bands closest to DEFAULT_RGB_WAVELENGTHS
+        are used, or the first band as gray when the wavelengths aren't known either
+    """
+    header = envi.read_envi_header(hdr_filename)
+    num_bands = int(header['bands'])
+    wavelengths = None
+    if 'wavelength' in header:
+        wavelengths = np.array([float(value) for value in header['wavelength']], dtype=np.float64)
+
+    if 'default bands' in header and len(header['default bands']) == 3:
+        bands = tuple(min(max(int(float(value)) - 1, 0), num_bands - 1) for value in header['default bands'])
+    elif wavelengths is not None:
+        bands = tuple(int(np.argmin(np.abs(wavelengths - one_wavelength)))
+                      for one_wavelength in DEFAULT_RGB_WAVELENGTHS)
+    else:
+        bands = (0, 0, 0)
+    logging.debug("Quicklook bands of %s: %s", hdr_filename, str(bands))
+    return bands, wavelengths
+
+
+def get_step(num_lines: int, num_samples: int, max_size: int) -> int:
+    """Returns the number of lines and samples averaged into each preview pixel
+    Arguments:
+        num_lines: the number of scan lines of the image
+        num_samples: the number of samples of each scan line
+        max_size: the largest number of pixels of the longer side of the preview
+    """
+    return max(1, -(-max(num_lines, num_samples) // max(1, max_size)))
+
+
+def average_pixels(values: np.ndarray, step: int) -> np.ndarray:
+    """Averages blocks of step x step values, ignoring values that aren't finite
+    Arguments:
+        values: the (lines, samples) values
+        step: the number of lines and samples in a block; blocks at the edges may be smaller
+    Return:
+        Returns the means as float64, NaN where a block has no finite values
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if step == 1:
+        return values
+    finite = np.isfinite(values)
+    line_starts = np.arange(0, values.shape[0], step)
+    sample_starts = np.arange(0, values.shape[1], step)
+    sums = np.add.reduceat(np.add.reduceat(np.where(finite, values, 0.0), line_starts, axis=0), sample_starts, axis=1)
+    counts = np.add.reduceat(np.add.reduceat(finite.astype(np.int64), line_starts, axis=0), sample_starts, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def read_raw_bands(raw_filename: str, bands: tuple, max_size: int) -> np.ndarray:
+    """Reads and averages the preview bands of a RAW file
+    Arguments:
+        raw_filename: the path of the RAW file, with the header next to it
+        bands: the zero based indexes of the bands to read
+        max_size: the largest number of pixels of the longer side of the preview
+    Return:
+        Returns the (rows, columns, bands) averaged values
+    """
+    img_dn = envi.open(raw_filename + '.hdr').open_memmap()
+    num_lines, num_samples, _ = img_dn.shape
+    step = get_step(num_lines, num_samples, max_size)
+    block_lines = BLOCK_ROWS * step
+
+    rows = []
+    for first_line in range(0, num_lines, block_lines):
+        # Each band of a scan line is stored together, so only the pages of the three bands are read
+        rows.append(np.stack([average_pixels(img_dn[first_line:first_line + block_lines, :, band], step)
+                              for band in bands], axis=2))
+    return np.concatenate(rows, axis=0)
+
+
+def get_reflectance_variable(dataset: Dataset, step: int) -> tuple:
+    """Returns the rfl_img variable, or its coarsest overview whose pixels evenly divide the preview pixels
+    Arguments:
+        dataset: the open netCDF file
+        step: the number of lines and samples of rfl_img averaged into each preview pixel
+    Return:
+        Returns the variable and the number of its lines and samples to average into each preview pixel
+    Notes:
+        The preview has the same pixels whichever variable is used; only pixels at the right and bottom edges, which
+        average fewer pixels of rfl_img, can differ
+    """
+    variable, factor = dataset['rfl_img'], 1
+    prefix = 'rfl_img' + hyperspectral_overviews.OVERVIEW_SUFFIX
+    for name, candidate in dataset.variables.items():
+        if name.startswith(prefix) and hyperspectral_overviews.FACTOR_ATTRIBUTE in candidate.ncattrs():
+            candidate_factor = int(candidate.getncattr(hyperspectral_overviews.FACTOR_ATTRIBUTE))
+            if candidate_factor > factor and step % candidate_factor == 0:
+                variable, factor = candidate, candidate_factor
+    return variable, step // factor
+
+
+def read_reflectance_bands(nc_filename: str, wavelengths: tuple, max_size: int) -> np.ndarray:
+    """Reads and averages the preview bands of the calibrated reflectance in a netCDF file
+    Arguments:
+        nc_filename: the path of the netCDF file with the rfl_img variable
+        wavelengths: the (red, green, blue) wavelengths in nanometers; the closest bands are used
+        max_size: the largest number of pixels of the longer side of the preview
+    Return:
+        Returns the (rows, columns, bands) averaged values
+    Exceptions:
+        Raises RuntimeError if the file doesn't have rfl_img
+    """
+    with Dataset(nc_filename) as dataset:
+        if 'rfl_img' not in dataset.variables:
+            raise RuntimeError("Missing the rfl_img variable needed for a reflectance quicklook: '%s'" % nc_filename)
+        file_wavelengths = np.asarray(dataset['wavelength'][:], dtype=np.float64) / \
+            hyperspectral_bands.METERS_PER_NANOMETER
+        bands = [int(np.argmin(np.abs(file_wavelengths - one_wavelength))) for one_wavelength in wavelengths]
+
+        _, num_lines, num_samples = dataset['rfl_img'].shape
+        variable, step = get_reflectance_variable(dataset, get_step(num_lines, num_samples, max_size))
+        logging.debug("Quicklook of %s from %s bands %s averaging %s pixels", nc_filename, variable.name, str(bands),
+                      str(step))
+        # Packed values are unpacked and fill values become NaN
+        variable.set_auto_maskandscale(True)
+        block_lines = BLOCK_ROWS * step
+        rows = []
+        for first_line in range(0, variable.shape[1], block_lines):
+            block = [np.ma.filled(variable[band, first_line:first_line + block_lines, :].astype(np.float64), np.nan)
+                     for band in bands]
+            rows.append(np.stack([average_pixels(one_band, step) for one_band in block], axis=2))
+    return np.concatenate(rows, axis=0)
+
+
+def stretch(values: np.ndarray, percentiles: tuple = DEFAULT_STRETCH_PERCENTILES) -> np.ndarray:
+    """Stretches each band between percentiles of its values to 8 bit values
+    Arguments:
+        values: the (rows, columns, bands) values
+        percentiles: the percentiles stretched to 0 and 255
+    Return:
+        Returns the stretched values as uint8, with values that aren't finite set to 0
+    """
+    result = np.zeros(values.shape, dtype=np.uint8)
+    for band in range(values.shape[2]):
+        band_values = values[:, :, band]
+        finite = np.isfinite(band_values)
+        if not finite.any():
+            continue
+        low, high = np.percentile(band_values[finite], percentiles)
+        scale = 255.0 / (high - low) if high > low else 0.0
+        with np.errstate(invalid='ignore'):
+            scaled = np.clip((band_values - low) * scale, 0.0, 255.0)
+        result[:, :, band] = np.where(finite, np.rint(scaled), 0).astype(np.uint8)
+    return result
+
+
+def write_png(filename: str, rgb: np.ndarray) -> None:
+    """Writes an 8 bit RGB PNG file
+    Arguments:
+        filename: the path of the file to write
+        rgb: the (rows, columns, 3) uint8 values
+    """
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+    rows, columns, _ = rgb.shape
+    # Each row starts with the number of its filter, 0 for none
+    scan_lines = np.concatenate((np.zeros((rows, 1), dtype=np.uint8), rgb.reshape(rows, columns * 3)), axis=1)
+    with open(filename, 'wb') as out_file:
+        out_file.write(PNG_SIGNATURE)
+        out_file.write(chunk(b'IHDR', struct.pack('>IIBBBBB', columns, rows, 8, 2, 0, 0, 0)))
+        out_file.write(chunk(b'IDAT', zlib.compress(scan_lines.tobytes(), PNG_COMPRESSION_LEVEL)))
+        out_file.write(chunk(b'IEND', b''))
+
+
+def make_quicklook(raw_filename: str, out_filename: str, source: str = 'raw', nc_filename: Optional[str] = None,
+                   max_size: int = DEFAULT_QUICKLOOK_SIZE,
+                   percentiles: tuple = DEFAULT_STRETCH_PERCENTILES) -> str:
+    """Writes the RGB preview of a capture
+    Arguments:
+        raw_filename: the path of the RAW file, with the header next to it
+        out_filename: the path of the PNG file to write
+        source: one of QUICKLOOK_SOURCES; 'raw' reads the raw values and 'reflectance' the rfl_img of nc_filename
+        nc_filename: the netCDF file with the calibrated reflectance, needed for the 'reflectance' source
+        max_size: the largest number of pixels of the longer side of the preview
+        percentiles: the percentiles of each band's values stretched to black and white
+    Return:
+        Returns the path of the PNG file
+    Exceptions:
+        Raises RuntimeError if the source isn't known or nc_filename is missing for the 'reflectance' source
+    """
+    if source not in QUICKLOOK_SOURCES:
+        raise RuntimeError("Unknown quicklook source '%s'" % source)
+    bands, wavelengths = get_header_bands(raw_filename + '.hdr')
+    if source == 'raw':
+        values = read_raw_bands(raw_filename, bands, max_size)
+    else:
+        if not nc_filename:
+            raise RuntimeError("A netCDF file is needed for a reflectance quicklook of '%s'" % raw_filename)
+        if wavelengths is None:
+            raise RuntimeError("Missing the band wavelengths needed for a reflectance quicklook: '%s.hdr'" %
+                               raw_filename)
+        values = read_reflectance_bands(nc_filename, tuple(wavelengths[band] for band in bands), max_size)
+
+    temp_filename = out_filename + '.tmp'
+    write_png(temp_filename, stretch(values, percentiles))
+    os.replace(temp_filename, out_filename)
+    logging.debug("Wrote the %s x %s quicklook %s", str(values.shape[1]), str(values.shape[0]), out_filename)
+    return out_filename
+
+
+def main() -> None:
+    """Writes the RGB preview of a capture
+    """
+    parser = argparse.ArgumentParser(description='Writes an RGB preview PNG of a hyperspectral capture')
+    parser.add_argument('--size', type=int, default=DEFAULT_QUICKLOOK_SIZE,
+                        help='number of pixels of the longer side of the preview (default %s)' %
+                        str(DEFAULT_QUICKLOOK_SIZE))
+    parser.add_argument('--reflectance', help='netCDF file with the calibrated rfl_img to preview instead of the raw '
+                                              'values')
+    parser.add_argument('raw_file', help='the RAW file, with its header next to it')
+    parser.add_argument('out_file', help='the PNG file to create')
+    args = parser.parse_args()
+
+    make_quicklook(args.raw_file, args.out_file, 'reflectance' if args.reflectance else 'raw', args.reflectance,
+                   args.size)
+
+
+if __name__ == "__main__":
+    main()
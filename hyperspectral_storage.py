@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Chooses how the (wavelength, y, x) image cubes are chunked in the netCDF files, and benchmarks reading them
+
+Run this file with the path of a netCDF file to benchmark reading its image cubes
+"""
+
+import argparse
+import logging
+import time
+from typing import Optional
+import numpy as np
+from netCDF4 import Dataset
+
+# The chunking policies:
+#   spectral: a chunk holds all the bands of a small area, favoring reading the spectrum of a pixel
+#   spatial: a chunk holds a large area of a single band, favoring reading the image of a band
+#   balanced: a chunk is scaled down evenly from the whole cube, a compromise between the two
+CHUNK_POLICIES = ('spectral', 'spatial', 'balanced')
+
+# The default size, in bytes, of a chunk
+DEFAULT_CHUNK_BYTES = 1024 * 1024
+
+# The image cube variables that are benchmarked
+CUBE_NAMES = ('xps_img', 'rfl_img')
+
+# The default number of reads of each access pattern when benchmarking
+DEFAULT_BENCHMARK_READS = 20
+
+
+def spread_size(size: int, dimension_size: int) -> int:
+    """Returns a chunk size that splits a dimension into the same number of chunks as the size, but more evenly
+    Arguments:
+        size: the largest chunk size
+        dimension_size: the size of the dimension
+    Return:
+        Returns the chunk size, which is no more than size
+    Notes:
+        The last chunk of a dimension is stored whole even when the dimension only covers part of it
+    """
+    num_chunks = -(-dimension_size // size)
+    return -(-dimension_size // num_chunks)
+
+
+def get_chunk_sizes(policy: str, shape: tuple, itemsize: int, max_lines: Optional[int] = None,
+                    chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> tuple:
+    """Returns the chunk sizes of a (wavelength, y, x) cube for a chunking policy
+    Arguments:
+        policy: one of the CHUNK_POLICIES
+        shape: the (bands, lines, samples) shape of the cube
+        itemsize: the number of bytes of each value
+        max_lines: the maximum number of scan lines in a chunk; used when the cube is written a block of scan lines
+                   at a time so that each chunk is completely written by one block
+        chunk_bytes: the target size of a chunk in bytes
+    Return:
+        Returns the (bands, lines, samples) chunk sizes
+    Exceptions:
+        Raises RuntimeError if the policy isn't known
+    """
+    num_bands, num_lines, num_samples = (int(size) for size in shape)
+    max_lines = min(num_lines, max_lines) if max_lines and max_lines > 0 else num_lines
+    chunk_values = max(1, chunk_bytes // itemsize)
+
+    if policy == 'spectral':
+        bands = num_bands
+        samples = spread_size(max(1, min(num_samples, chunk_values // num_bands)), num_samples)
+    elif policy == 'spatial':
+        bands = 1
+        samples = spread_size(max(1, min(num_samples, chunk_values)), num_samples)
+    elif policy == 'balanced':
+        # Scale each dimension by the same factor so the chunk has the target number of values
+        scale = min(1.0, (chunk_values / float(num_bands * num_lines * num_samples)) ** (1.0 / 3.0))
+        bands = spread_size(max(1, min(num_bands, int(round(num_bands * scale)))), num_bands)
+        samples = spread_size(max(1, min(num_samples, int(round(num_samples * scale)))), num_samples)
+    else:
+        raise RuntimeError("Unknown chunking policy '%s'" % policy)
+    lines = spread_size(max(1, min(max_lines, chunk_values // (bands * samples))), num_lines)
+    chunks = (bands, lines, samples)
+
+    logging.debug("Chunk sizes for %s policy and shape %s: %s", policy, str(shape), str(chunks))
+    return chunks
+
+
+def get_aligned_lines(block_lines: int, chunk_sizes: tuple) -> int:
+    """Returns the number of scan lines to write at one time so that blocks don't split chunks
+    Arguments:
+        block_lines: the largest number of scan lines to write at one time
+        chunk_sizes: the (bands, lines, samples) chunk sizes as returned by get_chunk_sizes()
+    Return:
+        Returns the largest multiple of the chunk lines that's not more than block_lines, and at least the chunk lines
+    Notes:
+        A chunk split between blocks is held in the chunk cache, or read back and rewritten, until it's complete
+    """
+    chunk_lines = max(1, int(chunk_sizes[1]))
+    return max(chunk_lines, (block_lines // chunk_lines) * chunk_lines)
+
+
+def benchmark_reads(filename: str, variable_name: str, num_reads: int = DEFAULT_BENCHMARK_READS,
+                    seed: int = 0) -> dict:
+    """Times reading a cube variable by pixel spectrum and by band image
+    Arguments:
+        filename: the path of the netCDF file
+        variable_name: the name of the (wavelength, y, x) variable
+        num_reads: the number of spectra and band images to read
+        seed: the seed for picking the pixels and bands to read
+    Return:
+        Returns a dictionary with the chunk sizes and the average number of seconds to read a spectrum and a band
+    Notes:
+        Reading the same file more than once is faster when it's in the operating system's page cache; for comparable
+        numbers benchmark files that are all cached or all uncached
+    """
+    rng = np.random.default_rng(seed)
+    with Dataset(filename) as dataset:
+        variable = dataset[variable_name]
+        variable.set_auto_mask(False)
+        num_bands, num_lines, num_samples = variable.shape
+        # Disable the chunk cache so that each read is measured on its own
+        variable.set_var_chunk_cache(size=0)
+
+        start = time.perf_counter()
+        for line, sample in zip(rng.integers(0, num_lines, num_reads), rng.integers(0, num_samples, num_reads)):
+            variable[:, int(line), int(sample)]
+        spectrum_seconds = (time.perf_counter() - start) / num_reads
+
+        start = time.perf_counter()
+        for band in rng.integers(0, num_bands, num_reads):
+            variable[int(band), :, :]
+        band_seconds = (time.perf_counter() - start) / num_reads
+
+        chunks = variable.chunking()
+
+    return {'variable': variable_name,
+            'chunks': chunks if isinstance(chunks, list) else str(chunks),
+            'spectrum_seconds': spectrum_seconds,
+            'band_seconds': band_seconds
+            }
+
+
+def main() -> None:
+    """Benchmarks reading the image cubes of netCDF files
+    """
+    parser = argparse.ArgumentParser(description='Benchmarks reading hyperspectral image cubes by spectrum and by band')
+    parser.add_argument('--reads', type=int, default=DEFAULT_BENCHMARK_READS,
+                        help='number of spectra and bands to read (default %s)' % str(DEFAULT_BENCHMARK_READS))
+    parser.add_argument('files', nargs='+', help='the netCDF files to benchmark')
+    args = parser.parse_args()
+
+    for one_file in args.files:
+        with Dataset(one_file) as dataset:
+            names = [name for name in CUBE_NAMES if name in dataset.variables]
+        for name in names:
+            result = benchmark_reads(one_file, name, args.reads)
+            print("%s %s chunks=%s spectrum=%.3fms band=%.3fms" %
+                  (one_file, name, str(result['chunks']), result['spectrum_seconds'] * 1000.0,
+                   result['band_seconds'] * 1000.0))
+
+
+if __name__ == "__main__":
+    main()
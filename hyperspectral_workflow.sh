@@ -148,6 +148,8 @@ par_typ='bck'
 typ_out='NC_USHORT'                                                                                                                                       # [enm] netCDF output type
 unq_sfx=".pid${spt_pid}"                                                                                                                                  # [sng] Unique suffix
 xps_img_fl=''                                                                                                                                             # [sng] write Level 0 data intermediate file xps_img, xps_img_wht, xps_img_drk
+trn_nc_fl=''                                                                                                                                              # [sng] Raw data already translated to netCDF, skips ncks translation
+cnk_dmn=''                                                                                                                                                # [sng] Chunk sizes of the wavelength, y and x dimensions when compressing (e.g., '939,4,16')
 
 # Set temporary-file directory
 if [ -d '/gpfs_scratch/arpae' ]; then
@@ -220,7 +222,7 @@ if [ ${arg_nbr} -eq 0 ]; then
   fnc_usg_prn
 fi # !arg_nbr
 
-OPTS=$(getopt -n "$0" -o "c:d:hI:i:j:m:N:n:O:o:p:T:t:u:x" -l "output_xps_img:,new_clb_mth,new_calibration_method" -- "$@")
+OPTS=$(getopt -n "$0" -o "c:d:hI:i:j:m:N:n:O:o:p:T:t:u:x" -l "output_xps_img:,new_clb_mth,new_calibration_method,translated_nc:,skip_calibration,chunk_dimensions:" -- "$@")
 # OPTS=$(getopt -n "$0"  -o "c:d:hI:i:j:m:N:n:O:o:p:T:t:u:x" -- "$@")
 if [ $? -ne 0 ]; then
   fnc_usg_prn
@@ -313,6 +315,18 @@ while [ $# -gt 0 ]; do
     new_clb_flg='Yes'
     shift
     ;;
+  --translated_nc)
+    trn_nc_fl="$2"
+    shift 2
+    ;; # Raw data already translated to xps_img in netCDF (e.g., by transformer.py)
+  --skip_calibration)
+    clb_flg='No'
+    shift
+    ;; # Reflectance is calibrated by the caller (e.g., transformer.py)
+  --chunk_dimensions)
+    cnk_dmn="$2"
+    shift 2
+    ;; # Chunk sizes of the wavelength, y and x dimensions of the final data file when it's compressed (-c)
   -*)
     # Unrecognized option
     printf "\nERROR: Option ${fnt_bld}-${1}${fnt_nrm} not allowed"
@@ -383,6 +397,15 @@ if [ -n "${dfl_lvl}" ]; then
     cmp_flg='Yes'
   fi # !dfl_lvl
 fi # !dfl_lvl
+cmp_opt=''
+if [ -n "${dfl_lvl}" ]; then
+  cmp_opt="-L ${dfl_lvl}"
+fi # !dfl_lvl
+if [ -n "${cnk_dmn}" ]; then
+  # Rechunk the (wavelength, y, x) image cubes when compressing, which already rewrites the final file
+  IFS=',' read -r cnk_wvl cnk_y cnk_x <<< "${cnk_dmn}"
+  cmp_opt="${cmp_opt} --cnk_plc=g3d --cnk_dmn wavelength,${cnk_wvl} --cnk_dmn y,${cnk_y} --cnk_dmn x,${cnk_x}"
+fi # !cnk_dmn
 if [ -z "${drc_in}" ]; then
   drc_in="${drc_pwd}"
 else # !drc_in
@@ -682,19 +705,30 @@ for ((fl_idx = 0; fl_idx < ${fl_nbr}; fl_idx++)); do
     # Translate raw data to .nc file
     # --------------------------------------------------------------------------------------------------------------------------------
 
-    cmd_trn[${fl_idx}]="ncks -O ${nco_opt} --no_tmp_fl --trr_wxy=${wvl_nbr},${xdm_nbr},${ydm_nbr} --trr typ_in=${typ_in} --trr typ_out=${typ_out} --trr ntl_in=${ntl_in} --trr ntl_out=${ntl_out} --trr_in=${trn_in} ${drc_spt}/hyperspectral_dummy.nc ${trn_out}"
-    hst_att="$(date): ${cmd_ln}"
-    att_in="${trn_out}"
-    if [ ${dbg_lvl} -ge 1 ]; then
-      echo ${cmd_trn[${fl_idx}]}
-    fi # !dbg
-    if [ ${dbg_lvl} -ne 2 ]; then
-      eval ${cmd_trn[${fl_idx}]}
-      if [ $? -ne 0 ] || [ ! -f ${trn_out} ]; then
-        printf "${spt_nm}: ERROR Failed to translate raw data. Debug this:\n${cmd_trn[${fl_idx}]}\n"
+    if [ -n "${trn_nc_fl}" ]; then
+      # Header information above is still needed by later steps, only the translation itself is skipped
+      if [ ! -f "${trn_nc_fl}" ]; then
+        printf "${spt_nm}: ERROR Translated raw data file ${trn_nc_fl} not found\n"
         exit 1
-      fi # !err
-    fi # !dbg
+      fi # !trn_nc_fl
+      printf "trn(in)  : using previously translated ${trn_nc_fl}\n"
+      hst_att="$(date): ${cmd_ln};Used previously translated raw data"
+      att_in="${trn_nc_fl}"
+    else # !trn_nc_fl
+      cmd_trn[${fl_idx}]="ncks -O ${nco_opt} --no_tmp_fl --trr_wxy=${wvl_nbr},${xdm_nbr},${ydm_nbr} --trr typ_in=${typ_in} --trr typ_out=${typ_out} --trr ntl_in=${ntl_in} --trr ntl_out=${ntl_out} --trr_in=${trn_in} ${drc_spt}/hyperspectral_dummy.nc ${trn_out}"
+      hst_att="$(date): ${cmd_ln}"
+      att_in="${trn_out}"
+      if [ ${dbg_lvl} -ge 1 ]; then
+        echo ${cmd_trn[${fl_idx}]}
+      fi # !dbg
+      if [ ${dbg_lvl} -ne 2 ]; then
+        eval ${cmd_trn[${fl_idx}]}
+        if [ $? -ne 0 ] || [ ! -f ${trn_out} ]; then
+          printf "${spt_nm}: ERROR Failed to translate raw data. Debug this:\n${cmd_trn[${fl_idx}]}\n"
+          exit 1
+        fi # !err
+      fi # !dbg
+    fi # !trn_nc_fl
 
   else # !trn_flg
     att_in=${fl_in[$fl_idx]/_raw/_raw.nc}
@@ -938,7 +972,13 @@ for ((fl_idx = 0; fl_idx < ${fl_nbr}; fl_idx++)); do
     printf "xps(out) : ${xps_out}\n"
 
     # cmd_xps[${fl_idx}]="cp \"${xps_in}\" \"${xps_out}\"  && ncks -A -C -v wavelength,x,y \"${jsn_out}\" \"${xps_out}\""
-    cmd_xps[${fl_idx}]="cp \"${xps_in}\" \"${xps_out}\""
+    if [ "${clb_flg}" != 'Yes' ] && [ "${cmp_flg}" = 'Yes' ]; then
+      # The merged file is renamed and appended to below, so it needs its own copy
+      cmd_xps[${fl_idx}]="cp \"${xps_in}\" \"${xps_out}\""
+    else # !cmp_flg
+      # The merged file is only read from here on, so a hard link does when both are on the same file system
+      cmd_xps[${fl_idx}]="ln -f \"${xps_in}\" \"${xps_out}\" 2> /dev/null || cp \"${xps_in}\" \"${xps_out}\""
+    fi # !cmp_flg
 
     if [ ${dbg_lvl} -ge 1 ]; then
       echo ${cmd_xps[${fl_idx}]}
@@ -956,6 +996,7 @@ for ((fl_idx = 0; fl_idx < ${fl_nbr}; fl_idx++)); do
   # Calibrate
   # --------------------------------------------------------------------------------------------------------------------------------
 
+  cmp_xcl='' # [sng] Variables the compression step drops
   if [ "${clb_flg}" = 'Yes' ]; then
     clb_in=${mrg_out}
     clb_out="${clb_fl}.fl${idx_prn}.tmp"
@@ -1036,6 +1077,33 @@ for ((fl_idx = 0; fl_idx < ${fl_nbr}; fl_idx++)); do
         mv "$hsi_tmp" "$hsi_out"
       fi
     fi # !hsi_flg
+  else # !clb_flg
+    # Reflectance is calibrated after the workflow, so only drop the raw exposures as the NCO calibration does
+    clb_in=${mrg_out}
+    clb_out="${clb_fl}.fl${idx_prn}.tmp"
+    printf "clb(in)  : ${clb_in}\n"
+    printf "clb(out) : ${clb_out}\n"
+    if [ "${cmp_flg}" = 'Yes' ]; then
+      # The compression step rewrites the file anyway, so it drops the raw exposures and the merged file is only renamed
+      cmp_xcl="-x -v '^xps_img'"
+      cmd_clb[${fl_idx}]="/bin/mv -f ${clb_in} ${clb_out}"
+    else # !cmp_flg
+      # Variables can't be removed from a netCDF4 file in place, so dropping the raw exposures needs one copy of the rest
+      cmd_clb[${fl_idx}]="ncks -O ${nco_opt} -x -v '^xps_img' ${clb_in} ${clb_out}"
+    fi # !cmp_flg
+    if [ ${dbg_lvl} -ge 1 ]; then
+      echo ${cmd_clb[${fl_idx}]}
+    fi # !dbg
+    if [ ${dbg_lvl} -ne 2 ]; then
+      eval ${cmd_clb[${fl_idx}]}
+      if [ $? -ne 0 ] || [ ! -f ${clb_out} ]; then
+        printf "${spt_nm}: ERROR Failed to copy uncalibrated data. Debug this:\n${cmd_clb[${fl_idx}]}\n"
+        exit 1
+      fi # !err
+    fi # !dbg
+    if [ "${hsi_flg}" = 'Yes' ]; then
+      printf "${spt_nm}: WARNING Hyperspectral indices require calibration and are not created\n"
+    fi # !hsi_flg
   fi # !clb_flg
 
   # --------------------------------------------------------------------------------------------------------------------------------
@@ -1069,7 +1137,7 @@ for ((fl_idx = 0; fl_idx < ${fl_nbr}; fl_idx++)); do
     cmp_out="${cmp_fl}.fl${idx_prn}.tmp"
     printf "cmp(in)  : ${cmp_in}\n"
     printf "cmp(out) : ${cmp_out}\n"
-    cmd_cmp[${fl_idx}]="ncks -O --no_tmp_fl ${nco_opt} -L ${dfl_lvl} ${cmp_in} ${cmp_out}"
+    cmd_cmp[${fl_idx}]="ncks -O --no_tmp_fl ${nco_opt} ${cmp_opt} ${cmp_xcl} ${cmp_in} ${cmp_out}"
     if [ ${dbg_lvl} -ge 1 ]; then
       echo ${cmd_cmp[${fl_idx}]}
     fi # !dbg
@@ -0,0 +1,416 @@
+"""Writes netCDF files as chunked Zarr (version 2) directory stores, without needing the zarr package
+
+Each chunk of an array is a separate file, so chunks can be written at the same time by different threads or processes
+and read on their own. The dimension names are kept in the "_ARRAY_DIMENSIONS" attribute of each array, which is how
+xarray opens Zarr stores as netCDF-like datasets
+"""
+
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from typing import Optional
+import numpy as np
+from netCDF4 import Dataset
+import hyperspectral_compress
+import hyperspectral_storage
+
+# The Zarr specification version written
+ZARR_FORMAT = 2
+
+# The extension of the directory stores
+STORE_EXTENSION = '.zarr'
+
+# The output formats of the calibrated file
+OUTPUT_FORMATS = ('netcdf', 'zarr', 'both')
+
+# The attribute holding the dimension names of an array
+DIMENSIONS_ATTRIBUTE = '_ARRAY_DIMENSIONS'
+
+# The metadata files of groups and arrays, and of the whole store
+GROUP_FILE = '.zgroup'
+ARRAY_FILE = '.zarray'
+ATTRIBUTES_FILE = '.zattrs'
+CONSOLIDATED_FILE = '.zmetadata'
+
+# The names of the reflectance cube dimensions, which are chunked by a chunking policy
+CUBE_DIMENSIONS = ('wavelength', 'y', 'x')
+
+# The chunking policy of contiguous reflectance cubes when one isn't specified
+DEFAULT_CUBE_POLICY = 'balanced'
+
+
+def to_json_value(value):
+    """Returns an attribute value as a type that can be written as JSON
+    Arguments:
+        value: the attribute value
+    Return:
+        Returns the value as a Python type; arrays become lists
+    """
+    if isinstance(value, np.ndarray):
+        return [to_json_value(one_value) for one_value in value.tolist()]
+    if isinstance(value, (list, tuple)):
+        return [to_json_value(one_value) for one_value in value]
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, np.generic):
+        return to_json_value(value.item())
+    if isinstance(value, float) and not np.isfinite(value):
+        # The specification's names for the values JSON doesn't have
+        return 'NaN' if np.isnan(value) else ('Infinity' if value > 0 else '-Infinity')
+    return value
+
+
+def write_json(filename: str, document: dict) -> None:
+    """Writes a metadata document
+    Arguments:
+        filename: the path of the file to write
+        document: the document to write
+    """
+    with open(filename, 'w') as out_file:
+        json.dump(document, out_file, indent=4, sort_keys=True)
+
+
+def encode_strings(values: np.ndarray) -> bytes:
+    """Encodes variable length strings in the layout of the "vlen-utf8" filter
+    Arguments:
+        values: the strings to encode
+    Return:
+        Returns the number of strings, followed by the length and UTF-8 bytes of each string
+    """
+    encoded = [('' if one_value is None else str(one_value)).encode('utf-8') for one_value in values.ravel()]
+    return struct.pack('<I', len(encoded)) + b''.join([struct.pack('<I', len(one_value)) + one_value
+                                                       for one_value in encoded])
+
+
+class ZarrArray():
+    """An array of a Zarr directory store whose chunks are written one at a time
+    """
+
+    def __init__(self, path: str, shape: tuple, chunks: tuple, dtype, dimensions: tuple, attributes: dict,
+                 fill_value=None, compression_level: int = 0):
+        """Initializes class instance and writes the array's metadata
+        Arguments:
+            path: the path of the array's folder
+            shape: the shape of the array
+            chunks: the chunk sizes of the array
+            dtype: the numpy data type of the values; str for variable length strings
+            dimensions: the names of the dimensions
+            attributes: the attributes of the array
+            fill_value: the value of missing data, if any
+            compression_level: the zlib compression level of the chunks; zero to not compress
+        """
+        self.path = path
+        self.shape = tuple(int(size) for size in shape)
+        self.chunks = tuple(int(size) for size in chunks) if self.shape else ()
+        self.strings = dtype is str
+        self.dtype = np.dtype(object) if self.strings else np.dtype(dtype)
+        self.compression_level = compression_level
+        # Compressed values are shuffled first, as they are in the compressed netCDF files
+        self.shuffle = compression_level > 0 and not self.strings and self.dtype.itemsize > 1
+        filters = None
+        if self.strings:
+            filters = [{'id': 'vlen-utf8'}]
+        elif self.shuffle:
+            filters = [{'id': 'shuffle', 'elementsize': self.dtype.itemsize}]
+
+        metadata = {
+            'zarr_format': ZARR_FORMAT,
+            'shape': list(self.shape),
+            'chunks': list(self.chunks),
+            'dtype': '|O' if self.strings else self.dtype.str,
+            'compressor': {'id': 'zlib', 'level': compression_level} if compression_level > 0 else None,
+            'fill_value': None if fill_value is None else to_json_value(np.asarray(fill_value, self.dtype).item()),
+            'order': 'C',
+            'filters': filters
+        }
+        attributes = {name: to_json_value(value) for name, value in attributes.items()}
+        attributes[DIMENSIONS_ATTRIBUTE] = list(dimensions)
+
+        os.makedirs(path, exist_ok=True)
+        write_json(os.path.join(path, ARRAY_FILE), metadata)
+        write_json(os.path.join(path, ATTRIBUTES_FILE), attributes)
+
+    def write_chunk(self, index: tuple, values: np.ndarray) -> None:
+        """Writes one chunk
+        Arguments:
+            index: the index of the chunk in each dimension (not the index of its first value)
+            values: the values of the chunk; chunks at the end of a dimension may be smaller than the chunk size
+        Notes:
+            The chunk is written to a temporary file that's then renamed, so readers never see a partial chunk.
+            Different chunks can be written at the same time
+        """
+        values = np.asarray(values)
+        if self.strings:
+            data = encode_strings(values)
+        else:
+            if values.shape != self.chunks:
+                # Chunks at the end of a dimension are stored whole
+                padded = np.zeros(self.chunks, dtype=self.dtype)
+                padded[tuple(slice(0, size) for size in values.shape)] = values
+                values = padded
+            data = np.ascontiguousarray(values, dtype=self.dtype)
+            if self.shuffle:
+                data = hyperspectral_compress.shuffle_bytes(data)
+        if self.compression_level > 0:
+            data = zlib.compress(data, self.compression_level)
+
+        key = '.'.join([str(one_index) for one_index in index]) if index else '0'
+        temp_filename = os.path.join(self.path, '.' + key + '.tmp')
+        with open(temp_filename, 'wb') as out_file:
+            out_file.write(data)
+        os.replace(temp_filename, os.path.join(self.path, key))
+
+    def write_slab(self, start: tuple, values: np.ndarray, executor: Optional[concurrent.futures.Executor] = None,
+                   pending: Optional[list] = None, copy: bool = True) -> None:
+        """Writes the chunks covering a region of the array
+        Arguments:
+            start: the index of the first value of the region in each dimension; must be a multiple of the chunk size
+            values: the values of the region; each dimension must be a multiple of the chunk size unless the region
+                    reaches the end of the array in that dimension
+            executor: optional executor to write the chunks with; the chunks are written here when None
+            pending: the list to add the futures of the submitted chunks to when an executor is used
+            copy: copy the chunks submitted to the executor, for callers that reuse the values
+        """
+        if not self.shape:
+            self.write_chunk((), values)
+            return
+        ranges = [range(0, size, chunk) for size, chunk in zip(values.shape, self.chunks)]
+        for offset in itertools.product(*ranges):
+            region = values[tuple(slice(first, first + chunk) for first, chunk in zip(offset, self.chunks))]
+            index = tuple((first + one_start) // chunk for first, one_start, chunk in zip(offset, start, self.chunks))
+            if executor is None:
+                self.write_chunk(index, region)
+            else:
+                # The region is copied when the caller may reuse the values
+                pending.append(executor.submit(self.write_chunk, index, np.array(region) if copy else region))
+
+
+class CubeWriter():
+    """Writes the chunks of a calibrated cube's array as its blocks of scan lines are written to the netCDF file, so
+    that the cube doesn't have to be read back when the file is written as a store
+    """
+
+    def __init__(self, folder: str, compression_level: int = 0,
+                 workers: int = hyperspectral_compress.DEFAULT_WORKERS):
+        """Initializes class instance
+        Arguments:
+            folder: the folder to write the chunks in, on the same file system as the store
+            compression_level: the zlib compression level of the chunks; zero to not compress
+            workers: the number of threads compressing and writing chunks
+        Notes:
+            The chunk sizes are set, by assigning chunks, before the first block is written. Blocks of scan lines
+            need to start on the chunk boundaries
+        """
+        self.path = tempfile.mkdtemp(suffix=STORE_EXTENSION + '.tmp', dir=folder)
+        self.compression_level = compression_level
+        self.workers = max(1, workers)
+        self.chunks = None
+        self.array = None
+        self.executor = None
+        self.pending = []
+
+    def start(self, variable) -> None:
+        """Creates the array of a netCDF cube variable whose values are about to be written
+        Arguments:
+            variable: the netCDF variable of the cube; the array has its shape, data type and dimensions
+        """
+        self.array = ZarrArray(self.path, variable.shape, self.chunks or variable.shape, variable.dtype,
+                               variable.dimensions, {}, None, self.compression_level)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+    def write(self, first_line: int, values: np.ndarray) -> None:
+        """Writes the chunks of a block of scan lines
+        Arguments:
+            first_line: the index of the first scan line of the block
+            values: the (bands, lines, samples) values of the block, as they're stored in the netCDF variable; they
+                    aren't copied, so they can't be changed until the chunks are written
+        """
+        self.array.write_slab((0, first_line, 0), values, self.executor, self.pending, copy=False)
+        while len(self.pending) > self.workers * hyperspectral_compress.QUEUED_CHUNKS_PER_WORKER:
+            self.pending.pop(0).result()
+
+    def close(self) -> None:
+        """Waits for the chunks to be written"""
+        for future in self.pending:
+            future.result()
+        self.pending = []
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def matches(self, variable) -> bool:
+        """Returns whether the chunks were written for the current shape and data type of a netCDF variable"""
+        return self.array is not None and self.executor is None and self.array.shape == tuple(variable.shape) and \
+            self.array.dtype == variable.dtype
+
+    def remove(self) -> None:
+        """Removes the chunks when they aren't used by a store"""
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def write_group(path: str, attributes: dict) -> None:
+    """Writes the metadata of a group
+    Arguments:
+        path: the path of the group's folder
+        attributes: the attributes of the group
+    """
+    os.makedirs(path, exist_ok=True)
+    write_json(os.path.join(path, GROUP_FILE), {'zarr_format': ZARR_FORMAT})
+    write_json(os.path.join(path, ATTRIBUTES_FILE), {name: to_json_value(value) for name, value in attributes.items()})
+
+
+def consolidate_metadata(store_path: str) -> None:
+    """Writes the metadata of all the groups and arrays of a store to one file, so that it's opened with one read
+    Arguments:
+        store_path: the path of the store
+    """
+    metadata = {}
+    for folder, _, filenames in os.walk(store_path):
+        for filename in (GROUP_FILE, ARRAY_FILE, ATTRIBUTES_FILE):
+            if filename in filenames:
+                key = os.path.relpath(os.path.join(folder, filename), store_path).replace(os.sep, '/')
+                with open(os.path.join(folder, filename)) as in_file:
+                    metadata[key] = json.load(in_file)
+    write_json(os.path.join(store_path, CONSOLIDATED_FILE), {'zarr_consolidated_format': 1, 'metadata': metadata})
+
+
+def get_array_chunks(variable, chunk_policy: Optional[str], chunk_bytes: int) -> tuple:
+    """Returns the chunk sizes of the array of a netCDF variable
+    Arguments:
+        variable: the netCDF variable
+        chunk_policy: the chunking policy of contiguous reflectance cubes; None for the default policy
+        chunk_bytes: the largest number of bytes of the chunks of other contiguous variables
+    Return:
+        Returns the chunk sizes of the variable if it's chunked, otherwise chunk sizes that keep the chunks small
+    """
+    shape = tuple(max(1, size) for size in variable.shape)
+    chunking = variable.chunking()
+    if isinstance(chunking, list):
+        return tuple(chunking)
+    itemsize = variable.dtype.itemsize if isinstance(variable.dtype, np.dtype) else 1
+    if tuple(variable.dimensions) == CUBE_DIMENSIONS:
+        return hyperspectral_storage.get_chunk_sizes(chunk_policy or DEFAULT_CUBE_POLICY, shape, itemsize,
+                                                     chunk_bytes=chunk_bytes)
+
+    # Split the outer dimensions until the chunks are small enough
+    chunks = list(shape)
+    for axis in range(len(chunks)):
+        if int(np.prod(chunks)) * itemsize <= chunk_bytes:
+            break
+        inner_bytes = int(np.prod(chunks[axis + 1:])) * itemsize
+        chunks[axis] = max(1, chunk_bytes // max(1, inner_bytes))
+    return tuple(chunks)
+
+
+def export_group(group, path: str, compression_level: int, chunk_policy: Optional[str], chunk_bytes: int,
+                 executor: concurrent.futures.Executor, max_pending: int, read_bytes: int,
+                 cubes: Optional[dict] = None) -> None:
+    """Writes a netCDF group, its variables and its subgroups to a folder of a store
+    Arguments:
+        group: the netCDF group or dataset
+        path: the path of the group's folder
+        compression_level: the zlib compression level of the chunks; zero to not compress
+        chunk_policy: the chunking policy of contiguous reflectance cubes; None for the default policy
+        chunk_bytes: the largest number of bytes of the chunks of other contiguous variables
+        executor: the executor writing the chunks
+        max_pending: the number of chunks waiting to be written before reading more of a variable
+        read_bytes: the maximum number of bytes of a variable to read at one time
+        cubes: optional CubeWriter instances of arrays already written, by the path of their variable
+    """
+    write_group(path, group.__dict__)
+    cubes = cubes or {}
+
+    for name, variable in group.variables.items():
+        logging.debug("Writing %s to %s", name, path)
+        variable.set_auto_maskandscale(False)
+        attributes = variable.__dict__
+        fill_value = attributes.pop('_FillValue', None)
+        dtype = variable.dtype if isinstance(variable.dtype, np.dtype) else str
+        chunks = get_array_chunks(variable, chunk_policy, chunk_bytes)
+        cube = cubes.get(group.path.rstrip('/') + '/' + name)
+        if cube is not None and cube.matches(variable):
+            # The chunks were written as the values were calibrated, only the metadata is left to write
+            logging.debug("Using the chunks of %s written during calibration", name)
+            os.rename(cube.path, os.path.join(path, name))
+            ZarrArray(os.path.join(path, name), variable.shape, cube.array.chunks, dtype, variable.dimensions,
+                      attributes, fill_value, compression_level)
+            continue
+        array = ZarrArray(os.path.join(path, name), variable.shape, chunks, dtype, variable.dimensions, attributes,
+                          fill_value, compression_level)
+        if not variable.shape:
+            array.write_slab((), np.asarray(variable[0] if dtype is str else variable.getValue()))
+            continue
+        if 0 in variable.shape:
+            continue
+
+        # Read slabs of whole chunks and write their chunks on the executor's threads
+        itemsize = variable.dtype.itemsize if dtype is not str else 1
+        axis = hyperspectral_compress.get_slab_axis(variable.shape, chunks, itemsize, read_bytes)
+        pending = []
+        for offset in itertools.product(*[range(0, size, chunk) for size, chunk in
+                                          zip(variable.shape[:axis], chunks[:axis])]):
+            slab = tuple(slice(first, first + chunk) for first, chunk in zip(offset, chunks)) + \
+                   tuple(slice(None) for _ in variable.shape[axis:])
+            array.write_slab(tuple(offset) + (0,) * (len(variable.shape) - axis), np.asarray(variable[slab]),
+                             executor, pending)
+            while len(pending) > max_pending:
+                pending.pop(0).result()
+        for future in pending:
+            future.result()
+
+    for name, subgroup in group.groups.items():
+        export_group(subgroup, os.path.join(path, name), compression_level, chunk_policy, chunk_bytes, executor,
+                     max_pending, read_bytes, cubes)
+
+
+def export_netcdf(nc_filename: str, store_path: str, compression_level: int = 0,
+                  workers: int = hyperspectral_compress.DEFAULT_WORKERS, chunk_policy: Optional[str] = None,
+                  chunk_bytes: int = hyperspectral_storage.DEFAULT_CHUNK_BYTES,
+                  read_bytes: int = hyperspectral_compress.DEFAULT_READ_BYTES,
+                  cubes: Optional[dict] = None) -> str:
+    """Writes a netCDF file as a Zarr directory store with the same groups, dimension names and attributes
+    Arguments:
+        nc_filename: the path of the netCDF file
+        store_path: the path of the store to create; an existing store is replaced
+        compression_level: the zlib compression level of the chunks; zero to not compress
+        workers: the number of threads compressing and writing chunks
+        chunk_policy: the chunking policy of contiguous reflectance cubes; None for the default policy. Chunked
+                      variables keep their chunk sizes
+        chunk_bytes: the largest number of bytes of the chunks of other contiguous variables
+        read_bytes: the maximum number of bytes of a variable to read at one time
+        cubes: optional CubeWriter instances, by the path of their variable (such as "/rfl_img"), whose chunks are
+               moved into the store instead of reading the variable's values; writers that don't match their
+               variable are ignored
+    Return:
+        Returns the path of the store
+    Notes:
+        The store is written next to its final path and renamed when it's complete. Values are written as stored in the
+        netCDF file, with any packing attributes (such as scale_factor) kept. The metadata is consolidated into the
+        ".zmetadata" file
+    """
+    temp_path = store_path + '.tmp'
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    try:
+        with Dataset(nc_filename) as src, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            export_group(src, temp_path, compression_level, chunk_policy, chunk_bytes, executor,
+                         max(1, workers) * hyperspectral_compress.QUEUED_CHUNKS_PER_WORKER, read_bytes, cubes)
+        consolidate_metadata(temp_path)
+    except Exception:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.rename(temp_path, store_path)
+    return store_path
@@ -2,11 +2,14 @@
 """
 
 import argparse
+import concurrent.futures
 import datetime
+import itertools
 import json
 import logging
 import os
 import subprocess
+import tempfile
 from typing import Optional
 import numpy as np
 import psutil
@@ -15,9 +18,40 @@ import spectral.io.envi as envi
 
 import configuration
 import transformer_class
+import hyperspectral_bands
+import hyperspectral_compress
+import hyperspectral_convert
+import hyperspectral_envlog
+import hyperspectral_indices
+import hyperspectral_memory
+import hyperspectral_overviews
+import hyperspectral_packing
+import hyperspectral_quicklook
+import hyperspectral_storage
+import hyperspectral_zarr
+from hyperspectral_envlog import DEFAULT_CACHE_SIZE_MB, EnvlogCache, IrradianceTimeline
+from hyperspectral_models import CalibrationRegistry
 
 CALIB_ROOT = "/home/extractor"
 
+# The default number of scan lines to calibrate at one time when streaming reflectance to the output file
+DEFAULT_BLOCK_LINES = 64
+
+# The default amount of memory, in megabytes, to use for each hyperslab when copying variables between files
+DEFAULT_COPY_MEMORY_MB = 256
+
+# The calibration models shared by all the captures processed by this process
+CALIBRATION_MODELS = CalibrationRegistry()
+
+# The EnvironmentLogger caches shared by all the captures processed by this process, by their settings
+ENVLOG_CACHES = {}
+
+# The memory, in bytes, to leave free for the system and the workflow script when planning calibrations
+MEMORY_RESERVE = 512 * 1024 * 1024
+
+# The number of seconds before the image time and after the end of the scan to load EnvironmentLogger readings for
+ENVLOG_WINDOW_MARGIN = 60
+
 class __internal__():
     """Class for internal use only functions
     """
@@ -47,157 +81,862 @@ class __internal__():
         return raw_file
 
     @staticmethod
-    def get_local_time(timestamp: str) -> str:
-        """Returns the time extracted from the timestamp
+    def get_raw_files(source_files: list) -> list:
+        """Returns the names of all the RAW files
+        Arguments:
+            source_files: a list of file names to look through
+        Return:
+            Returns the list of RAW file names in the order found
+        """
+        return [one_file for one_file in source_files if one_file.endswith('_raw')]
+
+    @staticmethod
+    def get_capture_timestamp(raw_filename: str, default_timestamp: str) -> str:
+        """Returns the timestamp of a capture from the metadata file that accompanies the RAW file
         Arguments:
-            timestamp: the ISO 8601 timestamp string
+            raw_filename: the path to the RAW file
+            default_timestamp: the timestamp to return if one isn't found in the capture's metadata
         Return:
-            Returns the extracted time. If a time isn't found, the original string is returned
+            Returns the ISO 8601 timestamp of the capture
         """
-        if 'T' in timestamp:
-            time_only = timestamp.split('T')[1]
-            return time_only[0:8]
+        metadata_filename = raw_filename[:-len('_raw')] + '_metadata.json'
+        if os.path.exists(metadata_filename):
+            try:
+                with open(metadata_filename, 'r') as in_file:
+                    metadata = json.load(in_file)
+                gantry_time = metadata['lemnatec_measurement_metadata']['gantry_system_variable_metadata']['time']
+                return datetime.datetime.strptime(gantry_time, '%m/%d/%Y %H:%M:%S').isoformat()
+            except (OSError, ValueError, KeyError, TypeError) as ex:
+                logging.debug("Unable to find the capture time in '%s': %s", metadata_filename, str(ex))
 
-        return timestamp
+        return default_timestamp
 
     @staticmethod
-    def check_raw_file_size(raw_filename: str) -> Optional[str]:
-        """Checks if the file may be too large for available memory
+    def get_data_date(args: argparse.Namespace, timestamp: str) -> str:
+        """Returns the date to associate with the data of a capture
         Arguments:
-            raw_filename: the path to the RAW file to check
+            args: the transformer arguments
+            timestamp: the ISO 8601 timestamp of the capture
         Return:
-            Returns None if size checking passes and an error message if failing
+            Returns the date in 'YYYY-MM-DD' format
         """
-        reserve_memory = 5 * 1024 * 1024    # Megabytes
-        # Get the name of the raw file
-        raw_file_size = os.stat(raw_filename).st_size
+        data_date = args.date_override if args.date_override else timestamp[:10]
+        return data_date.replace('/', '-').replace('_', '-')
 
-        # Determine the amount of available memory
-        available_mem = psutil.virtual_memory().available
+    @staticmethod
+    def plan_memory(args: argparse.Namespace, raw_filename: str, data_date: str,
+                    memory_budget: Optional[int]) -> hyperspectral_memory.MemoryPlan:
+        """Plans the calibration of a RAW file so that it fits in the memory budget
+        Arguments:
+            args: the transformer arguments
+            raw_filename: the path to the RAW file
+            data_date: the date associated with the data (in 'YYYY-MM-DD' format)
+            memory_budget: the number of bytes available; None if there's no limit
+        Return:
+            Returns the plan, including the buffers of the packing, band profile, overviews, Zarr store and conversion
+            that are requested
+        """
+        camera_type, _, num_bands_irradiance, _ = __internal__.get_camera_info(args.sensor, data_date)
+        hdr_filename = raw_filename + '.hdr'
+        image_info = hyperspectral_memory.get_image_info(hdr_filename)
+        num_lines, num_samples, num_raw_bands, data_type = image_info
+        copy_memory = 0 if args.in_place else args.copy_memory_mb * 1024 * 1024
+        bins = None
+        if args.band_profile is not None:
+            # The header has the same wavelengths as the file that's calibrated, in nanometers
+            header = envi.read_envi_header(hdr_filename)
+            if 'wavelength' in header:
+                wavelengths = np.asarray(header['wavelength'], dtype=np.float64) * \
+                    hyperspectral_bands.METERS_PER_NANOMETER
+                bins = args.band_profile.get_bins(wavelengths, __internal__.get_calibrated_band_count(camera_type))
+        convert_memory = 0
+        if args.convert:
+            line_bytes = num_samples * num_raw_bands * data_type.itemsize
+            convert_memory = line_bytes * hyperspectral_convert.get_buffer_lines(num_lines, num_samples, num_raw_bands,
+                                                                                 data_type.itemsize,
+                                                                                 args.convert_buffer_mb * 1024 * 1024)
+        return hyperspectral_memory.plan_calibration(image_info, camera_type,
+                                                     __internal__.get_calibrated_band_count(camera_type),
+                                                     num_bands_irradiance, args.block_lines, copy_memory,
+                                                     memory_budget, packing=args.rfl_packing, bins=bins,
+                                                     overviews=args.overviews,
+                                                     store=args.output_format != 'netcdf',
+                                                     convert_memory=convert_memory)
+
+    @staticmethod
+    def process_raw_file(args: argparse.Namespace, raw_filename: str, timestamp: str, working_folder: str,
+                         memory_budget: Optional[int] = None) -> dict:
+        """Creates the netCDF files for one RAW file and calibrates them
+        Arguments:
+            args: the transformer arguments
+            raw_filename: the path to the RAW file
+            timestamp: the ISO 8601 timestamp of the capture
+            working_folder: the folder to write the files to
+            memory_budget: the number of bytes available for calibrating; None if there's no limit
+        Return:
+            Returns a dictionary with the result code and either the list of file metadata or an error message
+        """
+        data_date = __internal__.get_data_date(args, timestamp)
+        try:
+            plan = __internal__.plan_memory(args, raw_filename, data_date, memory_budget)
+        except Exception as ex:
+            msg = "Exception caught while planning memory use: " + str(ex)
+            logging.exception(msg)
+            return {'code': -1003, 'error': msg}
+        logging.info("Memory plan: %s", plan.describe())
+        if not plan.fits:
+            return {'code': -1002, 'error': "Try using the --skip_memory_check switch. Estimated memory needed for "
+                                            "'%s' is %s bytes but only %s bytes are available" %
+                                            (raw_filename, str(plan.required), str(memory_budget))}
 
-        # Determine if we have a fit
-        if available_mem <= raw_file_size:
-            return "RAW file size %s is too large for available memory %s: '%s'" % \
-                   (str(raw_file_size), str(available_mem), raw_filename)
-        if available_mem - reserve_memory <= raw_file_size:
-            return "RAW file size %s will consume available and reserved memory: %s (%s + %s): '%s'" % \
-                   (str(raw_file_size), str(available_mem + reserve_memory), str(available_mem), str(reserve_memory), raw_filename)
+        # Get the destination file names
+        out_base_filename = os.path.join(working_folder, os.path.splitext(os.path.basename(raw_filename))[0])
+        out_filename = out_base_filename + '.nc'
+        xps_filename = out_base_filename + '_xps.nc'
+        logging.debug("Output filename: %s", out_filename)
+        logging.debug("XPS filename: %s", xps_filename)
+        del out_base_filename
 
-        return None
+        # Convert the RAW file here instead of in the workflow
+        workflow_args = []
+        translated_filename = None
+        if args.convert:
+            translated_filename = os.path.splitext(out_filename)[0] + '_trn.nc'
+            logging.info("Converting %s to netCDF", raw_filename)
+            try:
+                hyperspectral_convert.convert_raw(raw_filename, translated_filename,
+                                                  compression_level=args.compression_level,
+                                                  buffer_memory=args.convert_buffer_mb * 1024 * 1024,
+                                                  chunk_policy=args.chunk_policy, workers=args.compression_workers)
+            except Exception as ex:
+                msg = "Exception caught while converting RAW file: " + str(ex)
+                logging.exception(msg)
+                if os.path.exists(translated_filename):
+                    os.remove(translated_filename)
+                return {'code': -1007, 'error': msg}
+            workflow_args = ["--translated_nc", translated_filename]
+        if args.skip_nco_calibration:
+            workflow_args.append("--skip_calibration")
+
+        # Run the commands to create the files
+        logging.info('Running the hyperspectral workflow')
+        logging.debug("Calling hyperspectal_workflow.sh")
+        subprocess_code = subprocess.call(["bash", "hyperspectral_workflow.sh", "-d", "1",
+                                           "--output_xps_img", xps_filename] + workflow_args +
+                                          ["-i", raw_filename, "-o", out_filename])
+        logging.debug("Subprocess return code: %s", str(subprocess_code))
+
+        logging.info("Running calibration")
+        logging.debug("Sensor: %s  Data date: %s", args.sensor, data_date)
+        envlog_cache = __internal__.get_envlog_cache(args.envlog_cache, args.envlog_cache_mb, args.envlog_memory_files)
+        translated = None
+        cube_writer = None
+        if args.output_format != 'netcdf':
+            # The store's rfl_img chunks are written as the reflectance is calibrated
+            cube_writer = hyperspectral_zarr.CubeWriter(working_folder, args.deflate_level, args.compression_workers)
+        try:
+            raw_image = None
+            if translated_filename and os.path.exists(translated_filename):
+                # Calibrate the converted values instead of reading the RAW file a second time
+                translated = Dataset(translated_filename)
+                raw_image = hyperspectral_convert.XpsImage(translated[hyperspectral_convert.XPS_IMG_NAME])
+            packer = None
+            if args.rfl_packing:
+                packer = hyperspectral_packing.ReflectancePacker(args.rfl_packing, tuple(args.rfl_packing_range))
+            calibration_filename = __internal__.apply_calibration(raw_filename, args.sensor, data_date, timestamp,
+                                                                  args.environment_logger, out_filename,
+                                                                  plan.block_lines, args.copy_memory_mb * 1024 * 1024,
+                                                                  args.in_place, envlog_cache,
+                                                                  chunk_policy=args.chunk_policy, packer=packer,
+                                                                  band_profile=args.band_profile,
+                                                                  overviews=args.overviews,
+                                                                  raw_image=raw_image, cube_writer=cube_writer)
+        except Exception as ex:
+            msg = "Exception caught while applying calibration: " + str(ex)
+            logging.exception(msg)
+            if cube_writer is not None:
+                cube_writer.remove()
+            return {'code': -1004, 'error': msg}
+        finally:
+            if translated is not None:
+                translated.close()
+            if translated_filename and os.path.exists(translated_filename):
+                os.remove(translated_filename)
+        hyperspectral_memory.log_actual(plan)
+
+        file_md = [__internal__.get_file_md(out_filename, args.sensor, raw_filename),
+                   __internal__.get_file_md(xps_filename, args.sensor, raw_filename)]
+        if calibration_filename != out_filename:
+            file_md.append(__internal__.get_file_md(calibration_filename, args.sensor, raw_filename))
+
+        if args.indices is not None:
+            indices_filename = os.path.splitext(out_filename)[0] + '_ind.nc'
+            logging.info("Calculating hyperspectral indices to %s", indices_filename)
+            try:
+                hyperspectral_indices.calculate_indices(calibration_filename, indices_filename, args.indices or None,
+                                                        plan.block_lines, args.soil_mask, args.indices_aggregate,
+                                                        not args.indices_stats_only, args.indices_histogram_bins,
+                                                        tuple(args.indices_histogram_range))
+            except Exception as ex:
+                msg = "Exception caught while calculating hyperspectral indices: " + str(ex)
+                logging.exception(msg)
+                if cube_writer is not None:
+                    cube_writer.remove()
+                return {'code': -1008, 'error': msg}
+            file_md.append(__internal__.get_file_md(indices_filename, args.sensor, calibration_filename))
+
+        if args.quicklook:
+            quicklook_filename = os.path.splitext(out_filename)[0] + hyperspectral_quicklook.QUICKLOOK_SUFFIX
+            logging.info("Writing the %s quicklook %s", args.quicklook, quicklook_filename)
+            try:
+                hyperspectral_quicklook.make_quicklook(raw_filename, quicklook_filename, args.quicklook,
+                                                       calibration_filename, args.quicklook_size)
+            except Exception as ex:
+                msg = "Exception caught while writing the quicklook: " + str(ex)
+                logging.exception(msg)
+                if cube_writer is not None:
+                    cube_writer.remove()
+                return {'code': -1011, 'error': msg}
+            file_md.append(__internal__.get_file_md(quicklook_filename, args.sensor,
+                                                    raw_filename if args.quicklook == 'raw' else calibration_filename))
+
+        if args.output_format != 'netcdf':
+            store_path = os.path.splitext(calibration_filename)[0] + hyperspectral_zarr.STORE_EXTENSION
+            logging.info("Writing the calibrated file as the Zarr store %s", store_path)
+            try:
+                hyperspectral_zarr.export_netcdf(calibration_filename, store_path, args.deflate_level,
+                                                 args.compression_workers, args.chunk_policy,
+                                                 cubes={'/rfl_img': cube_writer})
+            except Exception as ex:
+                msg = "Exception caught while writing the Zarr store: " + str(ex)
+                logging.exception(msg)
+                return {'code': -1010, 'error': msg}
+            finally:
+                # Nothing is left when the chunks were moved into the store
+                cube_writer.remove()
+            file_md.append(__internal__.get_file_md(store_path, args.sensor, raw_filename))
+            if args.output_format == 'zarr':
+                # The store replaces the calibrated netCDF file
+                os.remove(calibration_filename)
+                file_md = [one_md for one_md in file_md if one_md['path'] != calibration_filename]
+
+        if args.deflate_level > 0:
+            logging.info("Compressing the netCDF files on %s threads", str(args.compression_workers))
+            try:
+                for one_md in file_md:
+                    if os.path.isfile(one_md['path']) and one_md['path'].endswith('.nc'):
+                        hyperspectral_compress.compress_in_place(one_md['path'], args.deflate_level,
+                                                                 args.compression_workers)
+            except Exception as ex:
+                msg = "Exception caught while compressing netCDF files: " + str(ex)
+                logging.exception(msg)
+                return {'code': -1009, 'error': msg}
+
+        return {'code': 0, 'file': file_md}
+
+    @staticmethod
+    def process_batch(args: argparse.Namespace, raw_filenames: list, check_md: dict) -> list:
+        """Processes several RAW files at the same time, as memory allows
+        Arguments:
+            args: the transformer arguments
+            raw_filenames: the list of RAW files to process
+            check_md: request specific metadata
+        Return:
+            Returns a list of tuples of each RAW file name and its result, in the order of raw_filenames
+        Notes:
+            A RAW file is only started when its estimated memory, along with the estimates of the files being
+            processed, fits in the memory that was available when the batch started. The number of scan lines
+            calibrated at one time is reduced for files that don't fit by themselves, and files that still don't fit
+            are rejected unless memory checks are skipped
+        """
+        max_workers = args.batch_workers if args.batch_workers > 0 else (os.cpu_count() or 1)
+        memory_budget = None if args.skip_memory_check else psutil.virtual_memory().available - MEMORY_RESERVE
+        logging.info("Batch memory budget: %s bytes with up to %s workers", str(memory_budget), str(max_workers))
+
+        pending = []
+        results = {}
+        for one_file in raw_filenames:
+            timestamp = __internal__.get_capture_timestamp(one_file, check_md['timestamp'])
+            try:
+                plan = __internal__.plan_memory(args, one_file, __internal__.get_data_date(args, timestamp),
+                                                memory_budget)
+            except Exception as ex:
+                msg = "Exception caught while planning memory use for %s: %s" % (one_file, str(ex))
+                logging.exception(msg)
+                results[one_file] = {'code': -1003, 'error': msg}
+                continue
+            if not plan.fits:
+                logging.warning("Not enough memory to process %s", one_file)
+                results[one_file] = {'code': -1002,
+                                     'error': "Try using the --skip_memory_check switch. Estimated memory needed for "
+                                              "'%s' is %s bytes but only %s bytes are available" %
+                                              (one_file, str(plan.required), str(memory_budget))}
+                continue
+            pending.append((one_file, timestamp, plan.required))
+
+        running = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                while pending and len(running) < max_workers:
+                    raw_filename, timestamp, estimate = pending[0]
+                    worker_budget = None
+                    if memory_budget is not None:
+                        worker_budget = memory_budget - sum(one_estimate for _, one_estimate in running.values())
+                        if estimate > worker_budget:
+                            break
+                    logging.info("Starting %s (estimated memory %s bytes)", raw_filename, str(estimate))
+                    future = executor.submit(__internal__.process_raw_file, args, raw_filename, timestamp,
+                                             check_md['working_folder'], worker_budget)
+                    running[future] = (raw_filename, estimate)
+                    pending.pop(0)
+
+                if not running:
+                    continue
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    raw_filename, _ = running.pop(future)
+                    try:
+                        results[raw_filename] = future.result()
+                    except Exception as ex:
+                        msg = "Exception caught while processing %s: %s" % (raw_filename, str(ex))
+                        logging.exception(msg)
+                        results[raw_filename] = {'code': -1004, 'error': msg}
+
+        return [(one_file, results[one_file]) for one_file in raw_filenames]
+
+    @staticmethod
+    def get_file_md(filename: str, sensor: str, source: str) -> dict:
+        """Returns the metadata describing a file created by the transformer
+        Arguments:
+            filename: the path of the created file
+            sensor: the name of the sensor the file is for
+            source: the path of the file that the created file was generated from
+        Return:
+            Returns the file metadata dictionary
+        """
+        return {
+            'path': filename,
+            'key': sensor,
+            'metadata': {
+                'source': source,
+                'transformer': configuration.TRANSFORMER_NAME,
+                'version': configuration.TRANSFORMER_VERSION,
+                'timestamp': datetime.datetime.utcnow().isoformat()
+            }
+        }
+
+    @staticmethod
+    def get_envlog_cache(cache_folder: Optional[str], max_size_mb: int, memory_files: int) -> Optional[EnvlogCache]:
+        """Returns the process wide environment logger cache for the settings
+        Arguments:
+            cache_folder: the folder to store cached files in; None to not store files
+            max_size_mb: the maximum size of the cache folder in megabytes
+            memory_files: the number of parsed environment logger files to keep in memory
+        Return:
+            Returns the cache, or None if caching is disabled
+        """
+        if not cache_folder and memory_files <= 0:
+            return None
+
+        cache_settings = (cache_folder, max_size_mb, memory_files)
+        if cache_settings not in ENVLOG_CACHES:
+            ENVLOG_CACHES[cache_settings] = EnvlogCache(cache_folder, max_size_mb, memory_files)
+        return ENVLOG_CACHES[cache_settings]
 
     @staticmethod
-    def irradiance_time_extractor(camera_type: str, envlog_file: str) -> tuple:
-        """Extract spectral profiles from environment logger json file
+    def load_irradiance(camera_type: str, envlog_file: str, envlog_cache: Optional[EnvlogCache] = None) -> tuple:
+        """Loads the spectral profiles of an environment logger json file, using the cache when available
         Arguments:
             camera_type: the string representing the camera type
             envlog_file: the path to the environment logger json file
+            envlog_cache: optional cache of previously parsed environment logger files
         Return:
             Returns a tuple of the loaded times and spectra
         """
-        # For the environmental logger records after 04/26/2016, there would be 24 files per day (1 file per hour, 5 seconds per record)
-        # Convert json file to dictionary format file
-        with open(envlog_file, "r") as in_file:
-            lines = in_file.readlines()
-            joined_lines = "".join(lines)
-            env_json = json.loads(joined_lines)
-            del lines
-            del joined_lines
-
-        # assume that time stamp follows in 5 second increments across records since 5 sec/record
-        sensor_reading_json = env_json["environment_sensor_readings"]
-        num_readings = len(sensor_reading_json)
-        if "spectrometers" in sensor_reading_json[0]:
-            if camera_type == "swir_new":
-                num_bands = len(sensor_reading_json[0]["spectrometers"]["NIRQuest-512"]["spectrum"])
+        if envlog_cache:
+            cached = envlog_cache.load(envlog_file, camera_type)
+            if cached is not None:
+                return cached
+
+        times, spectra = hyperspectral_envlog.read_envlog_file(camera_type, envlog_file)
+
+        if envlog_cache:
+            try:
+                envlog_cache.save(envlog_file, camera_type, times, spectra)
+            except OSError as ex:
+                logging.warning("Unable to cache environment logger file '%s': %s", envlog_file, str(ex))
+
+        return times, spectra
+
+    @staticmethod
+    def load_irradiance_files(camera_type: str, envlog_files: list, num_bands_irradiance: int,
+                              envlog_cache: Optional[EnvlogCache] = None) -> IrradianceTimeline:
+        """Loads the spectral profiles of a list of environment logger json files
+        Arguments:
+            camera_type: the string representing the camera type
+            envlog_files: the list of environment logger json files to load
+            num_bands_irradiance: the number of bands in each irradiance spectrum
+            envlog_cache: optional cache of previously parsed environment logger files
+        Return:
+            Returns the timeline of the readings of all the files
+        """
+        readings = []
+        for one_file in envlog_files:
+            logging.debug("Loading environmentlogger file: '%s'", one_file)
+            readings.append(__internal__.load_irradiance(camera_type, one_file, envlog_cache))
+        logging.info("Read in %s environment logger files", str(len(envlog_files)))
+
+        return IrradianceTimeline.from_readings(readings, num_bands_irradiance)
+
+    @staticmethod
+    def reflectance_blocks(img_dn: np.ndarray, irrad2dn: Optional[np.ndarray], block_lines: int,
+                           bins: Optional[hyperspectral_bands.BandBins] = None):
+        """Generator that computes reflectance for one block of scan lines at a time
+        Arguments:
+            img_dn: the memory mapped raw image with a shape of (lines, samples, bands)
+            irrad2dn: the irradiance to DN conversion to divide the raw values by; if None the raw values are
+                      returned unchanged
+            block_lines: the maximum number of scan lines in a block
+            bins: optional bins of bands to resample the blocks to; img_dn and irrad2dn then start at the first band
+                  of the bins
+        Return:
+            Yields tuples of the index of the first scan line in the block and the block itself, with the block
+            having a shape of (bands, lines, samples)
+        """
+        num_lines = img_dn.shape[0]
+        for first_line in range(0, num_lines, block_lines):
+            block = img_dn[first_line:first_line + block_lines]
+            if irrad2dn is not None:
+                block = block / irrad2dn
+            if bins is not None:
+                block = bins.apply(block, 2, bins.first)
+            yield first_line, np.rollaxis(block, 2, 0)
+
+    @staticmethod
+    def write_rfl_img(variable, rfl_data, num_bands: Optional[int] = None,
+                      packer: Optional[hyperspectral_packing.ReflectancePacker] = None, overviews: int = 0,
+                      cube_writer: Optional[hyperspectral_zarr.CubeWriter] = None) -> None:
+        """Writes the reflectance data to the rfl_img variable
+        Arguments:
+            variable: the netCDF variable to write to
+            rfl_data: either an array with a shape of (bands, lines, samples), or an iterable returning tuples of the
+                      first scan line and the block of data (as returned by reflectance_blocks())
+            num_bands: the number of bands the data covers with any remaining bands set to NaN; None indicates the
+                       data covers all bands
+            packer: optional packer of the reflectance values; the variable needs to have the packer's data type and
+                    its packing attributes are set
+            overviews: the number of spatially averaged overview levels of the unpacked values to write alongside
+                       the variable (see hyperspectral_overviews)
+            cube_writer: optional writer of the Zarr store chunks of the values as they're stored in the variable
+        """
+        if isinstance(rfl_data, np.ndarray):
+            rfl_data = ((0, rfl_data),)
+        missing_value = np.nan
+        if packer is not None:
+            # The values are packed here so that the clipped values and the error are known
+            variable.set_auto_maskandscale(False)
+            if packer.fill_value is not None:
+                missing_value = packer.fill_value
+        builder = None
+        if overviews > 0:
+            builder = hyperspectral_overviews.OverviewBuilder(variable, overviews, num_bands)
+        if cube_writer is not None:
+            cube_writer.start(variable)
+
+        for first_line, block in rfl_data:
+            last_line = first_line + block.shape[1]
+            values = block
+            if packer is not None:
+                block = packer.pack(block)
+            elif cube_writer is not None:
+                # Converted once for both the variable and the store
+                block = np.asarray(block, dtype=variable.dtype)
+            if num_bands is None:
+                variable[:, first_line:last_line, :] = block
             else:
-                num_bands = len(sensor_reading_json[0]["spectrometers"]["FLAME-T"]["spectrum"])
-        else:
-            num_bands = len(sensor_reading_json[0]["spectrometer"]["spectrum"])
-
-        spectra = np.zeros((num_readings, num_bands))
-        times = []
-        for idx in range(num_readings):
-            # read time stamp
-            time_current = sensor_reading_json[idx]["timestamp"]
-            array_time = time_current.replace(".", " ").replace("-", " ").replace(":", "").split(" ")
-            time_current_r = int(array_time[3])
-            times.append(time_current_r)
-
-            # read spectrum from irridiance sensors
-            if "spectrometers" in sensor_reading_json[idx]:
-                if camera_type == "swir_new":
-                    spectrum = sensor_reading_json[0]["spectrometers"]["NIRQuest-512"]["spectrum"]
-                else:
-                    spectrum = sensor_reading_json[idx]["spectrometers"]["FLAME-T"]["spectrum"]
+                variable[:num_bands, first_line:last_line, :] = block
+                variable[num_bands:, first_line:last_line, :] = missing_value
+            if builder is not None:
+                # The overviews reuse the block in memory instead of reading the variable back
+                builder.add(values)
+            if cube_writer is not None:
+                # As is the store, which gets the values as they're stored
+                if num_bands is not None:
+                    stored = np.full((variable.shape[0],) + block.shape[1:], missing_value, dtype=variable.dtype)
+                    stored[:num_bands] = block
+                    block = stored
+                cube_writer.write(first_line, block)
+        if builder is not None:
+            builder.close()
+        if cube_writer is not None:
+            cube_writer.close()
+
+        if packer is not None:
+            variable.setncatts(packer.get_attributes())
+            variable.setncatts(packer.get_result_attributes())
+            logging.info("Packed rfl_img as %s: error bound %g, largest error %g, %s values clipped", packer.mode,
+                         packer.error_bound, packer.max_error, str(packer.clipped))
+
+    @staticmethod
+    def get_hyperslab_shape(shape: tuple, chunks: Optional[list], itemsize: int, memory_budget: int) -> list:
+        """Determines the shape of the hyperslabs to use when walking a variable
+        Arguments:
+            shape: the shape of the variable
+            chunks: the chunk sizes of the variable; None if the variable isn't chunked
+            itemsize: the size of one value of the variable in bytes
+            memory_budget: the maximum number of bytes to have in a hyperslab
+        Return:
+            Returns the shape of the hyperslab to use. Outer dimensions are reduced first and, where possible, kept as
+            multiples of the chunk sizes so that each chunk is only read once
+        Notes:
+            If a single chunk is larger than the budget the chunking is ignored
+        """
+        for slab_chunks in (chunks, None):
+            if not slab_chunks:
+                slab_chunks = [1] * len(shape)
+            slab = list(shape)
+            for dim, dim_size in enumerate(shape):
+                slab_bytes = itemsize * int(np.prod(slab, dtype=np.int64))
+                if slab_bytes <= memory_budget:
+                    return slab
+                # The number of entries along this dimension that fit without reducing the inner dimensions
+                fit = memory_budget // (slab_bytes // dim_size)
+                if fit >= slab_chunks[dim]:
+                    slab[dim] = fit // slab_chunks[dim] * slab_chunks[dim]
+                    return slab
+                slab[dim] = min(slab_chunks[dim], dim_size)
+            if itemsize * int(np.prod(slab, dtype=np.int64)) <= memory_budget:
+                return slab
+
+        return [1] * len(shape)
+
+    @staticmethod
+    def copy_variable_data(src_variable, dst_variable, memory_budget: int) -> None:
+        """Copies the data of a variable, one hyperslab at a time for large variables
+        Arguments:
+            src_variable: the netCDF variable to copy from
+            dst_variable: the netCDF variable to copy to
+            memory_budget: the maximum number of bytes to read at one time
+        """
+        shape = src_variable.shape
+        itemsize = src_variable.dtype.itemsize if isinstance(src_variable.dtype, np.dtype) else 0
+        if not shape or not itemsize or itemsize * int(np.prod(shape, dtype=np.int64)) <= memory_budget:
+            dst_variable[:] = src_variable[:]
+            return
+
+        chunks = src_variable.chunking()
+        slab = __internal__.get_hyperslab_shape(shape, chunks if isinstance(chunks, list) else None, itemsize,
+                                                memory_budget)
+        logging.debug('   copying in hyperslabs of %s', str(slab))
+        for starts in itertools.product(*[range(0, dim_size, step) for dim_size, step in zip(shape, slab)]):
+            index = tuple(slice(start, start + step) for start, step in zip(starts, slab))
+            dst_variable[index] = src_variable[index]
+
+    @staticmethod
+    def resample_variable_data(src_variable, dst_variable, bins: hyperspectral_bands.BandBins,
+                               memory_budget: int) -> None:
+        """Copies the data of a variable with a wavelength dimension, resampling its bands
+        Arguments:
+            src_variable: the netCDF variable to copy from
+            dst_variable: the netCDF variable to copy to, with the resampled wavelength dimension
+            bins: the bins of bands to resample to
+            memory_budget: the maximum number of bytes to read at one time
+        Notes:
+            Each hyperslab holds the bands used by the bins and as much of the other dimensions as fits the budget,
+            along with the float64 copy of the values that binned bands are averaged in
+        """
+        axis = src_variable.dimensions.index('wavelength')
+        shape = list(src_variable.shape)
+        del shape[axis]
+        itemsize = src_variable.dtype.itemsize + (np.dtype(np.float64).itemsize if bins.binned else 0)
+        itemsize *= bins.stop - bins.first
+        slab = __internal__.get_hyperslab_shape(tuple(shape), None, itemsize, memory_budget)
+        logging.debug('   resampling in hyperslabs of %s', str(slab))
+        for starts in itertools.product(*[range(0, dim_size, step) for dim_size, step in zip(shape, slab)]):
+            index = [slice(start, start + step) for start, step in zip(starts, slab)]
+            index.insert(axis, slice(bins.first, bins.stop))
+            values = np.asarray(src_variable[tuple(index)])
+            index[axis] = slice(None)
+            dst_variable[tuple(index)] = bins.apply(values, axis, bins.first)
+
+    @staticmethod
+    def copy_group(src_group, dst_group, memory_budget: int,
+                   bins: Optional[hyperspectral_bands.BandBins] = None) -> None:
+        """Copies a netCDF group, its variables and its subgroups
+        Arguments:
+            src_group: the netCDF group to copy
+            dst_group: the empty netCDF group to copy to
+            memory_budget: the maximum number of bytes to read at one time
+            bins: optional bins of bands that the root wavelength dimension has been resampled to; variables along it
+                  are resampled in the same way
+        """
+        dst_group.setncatts(src_group.__dict__)
+        for name, dimension in src_group.dimensions.items():
+            dst_group.createDimension(name, (len(dimension) if not dimension.isunlimited() else None))
+
+        for name, variable in src_group.variables.items():
+            var_dict = variable.__dict__
+            dst_variable = dst_group.createVariable(name, variable.datatype, variable.dimensions,
+                                                    fill_value=var_dict.pop('_FillValue', None))
+            resampled = bins is not None and 'wavelength' in variable.dimensions and \
+                variable.get_dims()[variable.dimensions.index('wavelength')].group().path == '/'
+            if resampled:
+                logging.debug('...%s/%s (resampled)', src_group.path, name)
+                __internal__.resample_variable_data(variable, dst_variable, bins, memory_budget)
+            elif variable.shape:
+                logging.debug('...%s/%s', src_group.path, name)
+                __internal__.copy_variable_data(variable, dst_variable, memory_budget)
             else:
-                spectrum = sensor_reading_json[idx]["spectrometer"]["spectrum"]
+                dst_variable[...] = variable[...]
+            dst_variable.setncatts(var_dict)
 
-            spectra[idx, :] = spectrum
+        for name, subgroup in src_group.groups.items():
+            __internal__.copy_group(subgroup, dst_group.createGroup(name), memory_budget, bins)
 
-        return times, spectra
+    @staticmethod
+    def can_update_in_place(dataset: Dataset, rfl_shape: Optional[tuple],
+                            packer: Optional[hyperspectral_packing.ReflectancePacker] = None,
+                            rfl_chunks: Optional[tuple] = None) -> bool:
+        """Checks if the rfl_img variable of an open netCDF file can be overwritten in place
+        Arguments:
+            dataset: the netCDF file opened for appending
+            rfl_shape: the expected (bands, lines, samples) shape of rfl_img; None if it's not known
+            packer: optional packer of the reflectance values to be written
+            rfl_chunks: optional (bands, lines, samples) chunk sizes that rfl_img needs to have
+        Return:
+            Returns True if rfl_img can be written in place and False if the file needs to be rewritten
+        """
+        if 'rfl_img' in dataset.variables:
+            variable = dataset['rfl_img']
+            if not isinstance(variable.dtype, np.dtype) or variable.dtype.kind != 'f':
+                logging.debug('rfl_img data type %s is not floating point', str(variable.dtype))
+                return False
+            if packer is not None and packer.datatype != variable.dtype:
+                logging.debug('rfl_img data type %s is not the packed type %s', str(variable.dtype),
+                              str(packer.datatype))
+                return False
+            chunks = __internal__.fit_chunks(dataset, rfl_chunks)
+            if chunks is not None and variable.chunking() != list(chunks):
+                logging.debug('rfl_img chunking %s is not the chunking %s', str(variable.chunking()), str(chunks))
+                return False
+            shape = variable.shape
+        else:
+            if not all(name in dataset.dimensions for name in ('wavelength', 'y', 'x')):
+                logging.debug('Missing dimensions needed to add rfl_img')
+                return False
+            shape = tuple(len(dataset.dimensions[name]) for name in ('wavelength', 'y', 'x'))
+
+        if len(shape) != 3 or (rfl_shape is not None and tuple(shape) != tuple(rfl_shape)):
+            logging.debug('rfl_img shape %s does not match the calibrated shape %s', str(shape), str(rfl_shape))
+            return False
+
+        return True
+
+    @staticmethod
+    def fit_chunks(dataset: Dataset, chunk_sizes: Optional[tuple]) -> Optional[tuple]:
+        """Returns the chunk sizes of rfl_img limited to the sizes of the dimensions in a file
+        Arguments:
+            dataset: the netCDF file that rfl_img is created in
+            chunk_sizes: the (bands, lines, samples) chunk sizes; None for the default chunking
+        Return:
+            Returns the limited chunk sizes, or None if chunk_sizes is None
+        """
+        if chunk_sizes is None:
+            return None
+        return tuple(max(1, min(size, len(dataset.dimensions[name])))
+                     for size, name in zip(chunk_sizes, ('wavelength', 'y', 'x')))
 
     @staticmethod
-    def update_netcdf(input_filename: str, rfl_data, camera_type: str) -> None:
+    def create_rfl_img(dataset: Dataset, datatype='f4', fill_value=None, rfl_chunks: Optional[tuple] = None,
+                       packer: Optional[hyperspectral_packing.ReflectancePacker] = None):
+        """Creates the rfl_img variable
+        Arguments:
+            dataset: the netCDF file to create the variable in
+            datatype: the data type of the variable when it's not packed
+            fill_value: the fill value of the variable when it's not packed into integers; None for the default
+            rfl_chunks: optional (bands, lines, samples) chunk sizes
+            packer: optional packer of the reflectance values, determining the data type and fill value
+        Return:
+            Returns the new variable
+        """
+        if packer is not None:
+            datatype = packer.datatype
+            if packer.fill_value is not None:
+                fill_value = packer.fill_value
+        return dataset.createVariable('rfl_img', datatype, ('wavelength', 'y', 'x'), fill_value=fill_value,
+                                      chunksizes=__internal__.fit_chunks(dataset, rfl_chunks))
+
+    @staticmethod
+    def update_netcdf(input_filename: str, rfl_data, camera_type: str,
+                      memory_budget: int = DEFAULT_COPY_MEMORY_MB * 1024 * 1024, in_place: bool = False,
+                      rfl_shape: Optional[tuple] = None, rfl_chunks: Optional[tuple] = None,
+                      packer: Optional[hyperspectral_packing.ReflectancePacker] = None,
+                      bins: Optional[hyperspectral_bands.BandBins] = None, overviews: int = 0,
+                      cube_writer: Optional[hyperspectral_zarr.CubeWriter] = None) -> str:
         """Replace rfl_img variable in netcdf with given matrix
         Arguments:
             input_filename: the file to update
-            rfl_data: the data to update
+            rfl_data: the data to update; either the full matrix or an iterable of blocks of scan lines (see
+                      write_rfl_img())
             camera_type: the camera type the data is for
+            memory_budget: the maximum number of bytes to read at one time when copying variables
+            in_place: overwrite rfl_img in the file instead of writing a new "_newrfl.nc" file
+            rfl_shape: the (bands, lines, samples) shape of the calibrated image, used to check whether rfl_img can
+                       be written in place
+            rfl_chunks: optional (bands, lines, samples) chunk sizes of rfl_img; an existing rfl_img with other
+                        chunk sizes isn't written in place
+            packer: optional packer of the reflectance values; an existing rfl_img is recreated when the values are
+                    packed into integers
+            bins: optional bins of bands that rfl_data has been resampled to; the wavelength dimension, and the other
+                  variables along it, are resampled in the same way
+            overviews: the number of spatially averaged overview levels of rfl_img to write
+            cube_writer: optional writer of the Zarr store chunks of rfl_img (see write_rfl_img())
+        Return:
+            Returns the name of the file containing the updated data
+        Notes:
+            When writing in place is requested and the existing rfl_img has a different shape or is not floating
+            point, the file is rewritten to a temporary file that then atomically replaces the original. The rewrite
+            keeps the groups of the original. The Google_Map_View variable, and any overviews of the previous rfl_img,
+            are only dropped when the file is rewritten
         """
         logging.info('Updating %s', input_filename)
 
-        output_filename = input_filename.replace(".nc", "_newrfl.nc")
+        # The older VNIR cameras only have calibrated values for a subset of their bands, the rest are set to NaN
+        num_bands = __internal__.get_calibrated_band_count(camera_type)
+        resample = False
+        if bins is not None:
+            # The bins only hold calibrated bands
+            num_bands = None
+            with Dataset(input_filename) as src:
+                resample = 'wavelength' in src.dimensions and \
+                    (bins.binned or bins.num_bins != len(src.dimensions['wavelength']))
+
+        if in_place:
+            if rfl_shape is None and isinstance(rfl_data, np.ndarray) and num_bands is None:
+                rfl_shape = rfl_data.shape
+            with Dataset(input_filename, "a") as dst:
+                if not resample and __internal__.can_update_in_place(dst, rfl_shape, packer, rfl_chunks):
+                    if 'rfl_img' not in dst.variables:
+                        logging.debug('...adding rfl_img')
+                        __internal__.create_rfl_img(dst, rfl_chunks=rfl_chunks, packer=packer)
+                    logging.debug('...rfl_img (in place)')
+                    __internal__.write_rfl_img(dst['rfl_img'], rfl_data, num_bands, packer, overviews, cube_writer)
+                    return input_filename
+
+            out_handle, output_filename = tempfile.mkstemp(suffix='.nc', dir=os.path.dirname(input_filename) or None)
+            os.close(out_handle)
+            logging.info('Unable to update rfl_img in place, rewriting %s', input_filename)
+        else:
+            output_filename = input_filename.replace(".nc", "_newrfl.nc")
         logging.debug('Writing data to %s', output_filename)
 
-        with Dataset(input_filename) as src, Dataset(output_filename, "w") as dst:
-            # copy global attributes all at once via dictionary
-            dst.setncatts(src.__dict__)
-            # copy dimensions
-            for name, dimension in src.dimensions.items():
-                dst.createDimension(name, (len(dimension) if not dimension.isunlimited() else None))
+        try:
+            with Dataset(input_filename) as src, Dataset(output_filename, "w") as dst:
+                # copy global attributes all at once via dictionary
+                dst.setncatts(src.__dict__)
+                # copy dimensions
+                for name, dimension in src.dimensions.items():
+                    if hyperspectral_overviews.is_overview_name(name):
+                        continue
+                    if name == 'wavelength' and resample:
+                        dst.createDimension(name, bins.num_bins)
+                        continue
+                    dst.createDimension(name, (len(dimension) if not dimension.isunlimited() else None))
 
-            # copy all file data except for the excluded
-            for name, variable in src.variables.items():
-                if name == 'Google_Map_View':
-                    continue
+                # copy all file data except for the excluded
+                for name, variable in src.variables.items():
+                    if name == 'Google_Map_View' or hyperspectral_overviews.is_overview_name(name):
+                        continue
 
-                # Create variables
-                var_dict = src[name].__dict__
-                if '_FillValue' in var_dict.keys():
-                    dst.createVariable(name, variable.datatype, variable.dimensions, fill_value=var_dict['_FillValue'])
-                    del var_dict['_FillValue']
-                else:
-                    dst.createVariable(name, variable.datatype, variable.dimensions)
-
-                # Set variables to values
-                if name != "rfl_img":
-                    logging.debug('...%s', name)
-                    dst[name][:] = src[name][:]
-                else:
-                    if camera_type == 'vnir_old':
-                        logging.debug('...%s (subset)', name)
-                        dst[name][:679, :, :] = rfl_data
-                        # 679-955 set to NaN
-                        logging.debug('...NaNs')
-                        dst[name][679:, :, :] = np.nan
-
-                    elif camera_type == 'vnir_middle':
-                        logging.debug('...%s (subset)', name)
-                        dst[name][:662, :, :] = rfl_data
-                        # 679-955 set to NaN
-                        logging.debug('...NaNs')
-                        dst[name][662:, :, :] = np.nan
+                    # Create variables
+                    var_dict = src[name].__dict__
+                    datatype = variable.datatype
+                    if name == 'rfl_img':
+                        if not isinstance(datatype, np.dtype) or datatype.kind != 'f':
+                            # Reflectance values are fractional and need a floating point variable
+                            datatype = 'f4'
+                            var_dict.pop('_FillValue', None)
+                        if packer is not None:
+                            # Any packing of the existing values doesn't apply to the new values
+                            for key in hyperspectral_packing.PACKING_ATTRIBUTES:
+                                var_dict.pop(key, None)
+                        __internal__.create_rfl_img(dst, datatype, var_dict.pop('_FillValue', None), rfl_chunks,
+                                                    packer)
+                    elif '_FillValue' in var_dict.keys():
+                        dst.createVariable(name, datatype, variable.dimensions,
+                                           fill_value=var_dict['_FillValue'])
+                        del var_dict['_FillValue']
                     else:
+                        dst.createVariable(name, datatype, variable.dimensions)
+
+                    # Set variables to values
+                    if name == "rfl_img":
                         logging.debug('...%s', name)
-                        dst[name][:] = rfl_data
+                        __internal__.write_rfl_img(dst[name], rfl_data, num_bands, packer, overviews, cube_writer)
+                    elif resample and 'wavelength' in variable.dimensions:
+                        logging.debug('...%s (resampled)', name)
+                        __internal__.resample_variable_data(src[name], dst[name], bins, memory_budget)
+                    else:
+                        logging.debug('...%s', name)
+                        __internal__.copy_variable_data(src[name], dst[name], memory_budget)
+
+                    # copy variable attributes all at once via dictionary
+                    dst[name].setncatts(var_dict)
+
+                if 'rfl_img' not in src.variables:
+                    logging.debug('...adding rfl_img')
+                    __internal__.create_rfl_img(dst, rfl_chunks=rfl_chunks, packer=packer)
+                    __internal__.write_rfl_img(dst['rfl_img'], rfl_data, num_bands, packer, overviews, cube_writer)
+
+                if in_place:
+                    # The rewritten file replaces the original, so its groups of metadata need to be kept
+                    for name, group in src.groups.items():
+                        __internal__.copy_group(group, dst.createGroup(name), memory_budget,
+                                                bins if resample else None)
+
+                if resample:
+                    __internal__.set_band_attributes(dst, bins)
+        except Exception:
+            if in_place and os.path.exists(output_filename):
+                os.remove(output_filename)
+            raise
 
-                # copy variable attributes all at once via dictionary
-                dst[name].setncatts(var_dict)
+        if in_place:
+            os.replace(output_filename, input_filename)
+            return input_filename
 
-            if 'rfl_img' not in src.variables:
-                logging.debug('...adding rfl_img')
-                dst.createVariable('rfl_img', 'f4')
-                dst.variables['rfl_img'] = rfl_data
+        return output_filename
+
+    @staticmethod
+    def set_band_attributes(dataset: Dataset, bins: hyperspectral_bands.BandBins) -> None:
+        """Records the band profile that the wavelength dimension of a file was resampled with
+        Arguments:
+            dataset: the netCDF file open for writing
+            bins: the bins of bands the file was resampled to
+        """
+        if 'wavelength' in dataset.variables:
+            dataset['wavelength'].setncattr(hyperspectral_bands.PROFILE_ATTRIBUTE, str(bins.profile))
+        if bins.binned:
+            for variable in dataset.variables.values():
+                if 'wavelength' in variable.dimensions and variable.name != 'wavelength':
+                    # CF notation for values averaged over the bins of the wavelength coordinate
+                    variable.setncattr('cell_methods', 'wavelength: mean')
+
+    @staticmethod
+    def get_calibrated_band_count(camera_type: str) -> Optional[int]:
+        """Returns the number of bands that have calibration values for a camera
+        Arguments:
+            camera_type: the string representing the camera type
+        Return:
+            Returns the number of bands, or None if all the bands are calibrated
+        Notes:
+            The older VNIR cameras only have calibrated values for a subset of their bands, the rest are set to NaN
+        """
+        if camera_type == 'vnir_old':
+            return 679
+        if camera_type == 'vnir_middle':
+            return 662
+        return None
 
     @staticmethod
     def get_camera_info(sensor: str, data_date: str) -> tuple:
@@ -244,7 +983,15 @@ class __internal__():
 
     @staticmethod
     def apply_calibration(raw_filename: str, sensor: str, data_date: str, timestamp: str, environment_logging: str,
-                          out_filename: str) -> None:
+                          out_filename: str, block_lines: int = DEFAULT_BLOCK_LINES,
+                          memory_budget: int = DEFAULT_COPY_MEMORY_MB * 1024 * 1024, in_place: bool = False,
+                          envlog_cache: Optional[EnvlogCache] = None,
+                          irradiance_timeline: Optional[IrradianceTimeline] = None,
+                          chunk_policy: Optional[str] = None,
+                          packer: Optional[hyperspectral_packing.ReflectancePacker] = None,
+                          band_profile: Optional[hyperspectral_bands.BandProfile] = None, overviews: int = 0,
+                          raw_image: Optional[hyperspectral_convert.XpsImage] = None,
+                          cube_writer: Optional[hyperspectral_zarr.CubeWriter] = None) -> str:
         """Applies calibration to the RAW file
         Arguments:
             raw_filename: the path to the raw file
@@ -253,103 +1000,167 @@ class __internal__():
             timestamp: the timestamp to use for this request
             environment_logging: the environment logging folder to use
             out_filename: the name of the resulting file
+            block_lines: the number of scan lines to calibrate and write at one time; if zero the entire image is
+                         calibrated in memory before being written
+            memory_budget: the maximum number of bytes to read at one time when copying variables to the resulting file
+            in_place: overwrite rfl_img in out_filename instead of writing a new "_newrfl.nc" file
+            envlog_cache: optional cache of previously parsed environment logger files
+            irradiance_timeline: optional previously loaded irradiance readings to use instead of reading the files in
+                                 environment_logging; allows captures to share the same readings
+            chunk_policy: optional chunking policy of rfl_img, one of hyperspectral_storage.CHUNK_POLICIES; the
+                          number of scan lines written at one time is lowered to a multiple of the chunk lines
+            packer: optional packer of the reflectance values written to rfl_img
+            band_profile: optional profile of the bands to write, found from the wavelengths in out_filename; only the
+                          reflectance of the bands in the profile is computed
+            overviews: the number of spatially averaged overview levels of rfl_img to write, built from the blocks of
+                       scan lines as they're written
+            raw_image: optional values of the RAW file already converted to netCDF, read instead of the RAW file
+            cube_writer: optional writer of the Zarr store chunks of rfl_img as the blocks of scan lines are written;
+                         the number of scan lines written at one time is lowered to a multiple of its chunk lines
+        Return:
+            Returns the name of the file containing the calibrated data
         """
         # Disabling warnings to keep algorithm readable
         # pylint: disable=too-many-locals, too-many-statements
         logging.info('Calibrating %s to %s', raw_filename, out_filename)
 
         # determine type of sensor and age of camera
-        camera_type, num_irradiance_bands, image_scanning_time, num_spectral_bands = __internal__.get_camera_info(sensor, data_date)
+        camera_type, num_spectral_bands, num_irradiance_bands, image_scanning_time = __internal__.get_camera_info(sensor, data_date)
         logging.info('MODE: ---------- %s ----------', camera_type)
         logging.debug('MODE: irradiance bands: %s', str(num_irradiance_bands))
         logging.debug('MODE: scanning time: %s', str(image_scanning_time))
         logging.debug('MODE: spectral bands: %s', str(num_spectral_bands))
 
         # load the raw data set
-        hdr_filename = raw_filename + '.hdr'
-        logging.debug('Loading %s', hdr_filename)
-        if not os.path.exists(hdr_filename):
-            raise RuntimeError("Missing RAW associated file: '%s'" % hdr_filename)
+        if raw_image is not None:
+            logging.debug('Reading the converted values of %s', raw_filename)
+            img_dn = raw_image
+        else:
+            hdr_filename = raw_filename + '.hdr'
+            logging.debug('Loading %s', hdr_filename)
+            if not os.path.exists(hdr_filename):
+                raise RuntimeError("Missing RAW associated file: '%s'" % hdr_filename)
 
-        raw = envi.open(hdr_filename)
-        img_dn = raw.open_memmap()
+            raw = envi.open(hdr_filename)
+            img_dn = raw.open_memmap()
+        rfl_shape = (img_dn.shape[2], img_dn.shape[0], img_dn.shape[1])
+        bins = None
+        if band_profile is not None:
+            with Dataset(out_filename) as src:
+                if 'wavelength' not in src.variables:
+                    raise RuntimeError("Missing the wavelength variable needed for the band profile: '%s'" %
+                                       out_filename)
+                wavelengths = np.asarray(src['wavelength'][:], dtype=np.float64)
+            bins = band_profile.get_bins(wavelengths, __internal__.get_calibrated_band_count(camera_type))
+            logging.info("Writing %s bands for band profile %s", str(bins.num_bins), str(band_profile))
+            rfl_shape = (bins.num_bins, img_dn.shape[0], img_dn.shape[1])
+            # Only the bands in the profile are read
+            img_dn = img_dn[:, :, bins.first:bins.stop]
+        rfl_chunks = None
+        if chunk_policy:
+            rfl_chunks = hyperspectral_storage.get_chunk_sizes(chunk_policy, rfl_shape, np.dtype(np.float32).itemsize,
+                                                               block_lines)
+            if block_lines > 0:
+                block_lines = hyperspectral_storage.get_aligned_lines(block_lines, rfl_chunks)
+        if cube_writer is not None:
+            # The store is written from the blocks, so they start on its chunk boundaries
+            cube_writer.chunks = rfl_chunks or \
+                hyperspectral_storage.get_chunk_sizes(hyperspectral_zarr.DEFAULT_CUBE_POLICY, rfl_shape,
+                                                      np.dtype(np.float32).itemsize, block_lines)
+            if block_lines > 0:
+                block_lines = hyperspectral_storage.get_aligned_lines(block_lines, cube_writer.chunks)
 
         # Apply calibration procedure if camera_type == vnir_old, vnir_middle, vnir_new or swir_new.
         # Since no calibration models are available for swir_old and swir_middle, so directly convert old & middle
         # SWIR raw data to netcdf format
         if camera_type == "swir_old_middle":
             # Convert the raw swir_old and swir_middle data to netCDF
-            img_dn = np.rollaxis(img_dn, 2, 0)
-            __internal__.update_netcdf(out_filename, img_dn, camera_type)
+            if packer is not None:
+                # The raw values aren't reflectance and don't fit the packing range
+                logging.info("Not packing the uncalibrated %s values", camera_type)
+                packer = None
+            if block_lines > 0:
+                logging.debug("Streaming %s scan lines at a time", str(block_lines))
+                rfl_filename = __internal__.update_netcdf(out_filename,
+                                                          __internal__.reflectance_blocks(img_dn, None, block_lines,
+                                                                                          bins),
+                                                          camera_type, memory_budget, in_place, rfl_shape, rfl_chunks,
+                                                          packer, bins, overviews, cube_writer)
+            else:
+                img_dn = np.rollaxis(img_dn, 2, 0)
+                if bins is not None:
+                    img_dn = bins.apply(img_dn, 0, bins.first)
+                rfl_filename = __internal__.update_netcdf(out_filename, img_dn, camera_type, memory_budget, in_place,
+                                                          rfl_shape, rfl_chunks, packer, bins, overviews, cube_writer)
 
             # free up memory
             del img_dn
-            return
+            return rfl_filename
 
         # when camera_type == vnir_old, vnir_middle, vnir_new or swir_new, apply pre-computed calibration models
         # Load the previously created calibration models based on the camera_type
-        best_matched = os.path.join(CALIB_ROOT, "calibration_new", camera_type, 'best_matched_index.npy')
-        bias_filename = os.path.join(CALIB_ROOT, "calibration_new", camera_type, 'bias_coeff.npy')
-        gain_filename = os.path.join(CALIB_ROOT, "calibration_new", camera_type, 'gain_coeff.npy')
-        # read EnvLog data
-        logging.debug("Reading EnvLog files: %s", environment_logging)
-        envlog_tot_time = []
-        envlog_spectra = np.array([], dtype=np.int64).reshape(0, image_scanning_time)
-        num_file_read = 0
-        for one_file in os.listdir(environment_logging):
-            if one_file.endswith('environmentlogger.json'):
-                logging.debug("Loading environmentlogger file: '%s'", one_file)
-                time, spectrum = __internal__.irradiance_time_extractor(camera_type, os.path.join(environment_logging, one_file))
-                envlog_tot_time += time
-                # print("concatenating %s onto %s" % (spectrum.shape, envlog_spectra.shape))
-                envlog_spectra = np.vstack([envlog_spectra, spectrum])
-                num_file_read += 1
-        logging.info("Read in %s environment logger files", str(num_file_read))
+        model_folder = os.path.join(CALIB_ROOT, "calibration_new", camera_type)
 
         # Find the best match time range between image time stamp and EnvLog time stamp
         num_irridiance_record = int(image_scanning_time/5)   # 210/5=4.2  ---->  5 seconds per record
 
-        # concatenation of hour, minutes, and seconds of the image time stamp (eg., 12-38-49 to 123849)
+        # the image time stamp and the EnvLog readings are both in local time
         logging.debug("Using timestamp: %s", timestamp)
-        image_time = int(__internal__.get_local_time(timestamp).replace(":", ""))
+        image_time = hyperspectral_envlog.get_seconds(datetime.datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S'))
         logging.debug("Image time: %s", str(image_time))
 
-        # compute the absolute difference between
+        if irradiance_timeline is None:
+            # read EnvLog data, starting with the files that may hold readings from the time of the scan
+            logging.debug("Reading EnvLog files: %s", environment_logging)
+            envlog_files = sorted([os.path.join(environment_logging, one_file)
+                                   for one_file in os.listdir(environment_logging)
+                                   if one_file.endswith(hyperspectral_envlog.ENVLOG_FILE_SUFFIX)])
+            window_files = hyperspectral_envlog.select_files(envlog_files, image_time - ENVLOG_WINDOW_MARGIN,
+                                                             image_time + image_scanning_time + ENVLOG_WINDOW_MARGIN)
+            logging.debug("Selected %s of %s EnvLog files", str(len(window_files)), str(len(envlog_files)))
+            irradiance_timeline = __internal__.load_irradiance_files(camera_type, window_files, num_irradiance_bands,
+                                                                     envlog_cache)
+
+            # When a selected reading is within the margin, the closest reading of all the files is a selected reading
+            if len(window_files) < len(envlog_files) and \
+                    irradiance_timeline.closest_distance(image_time) > ENVLOG_WINDOW_MARGIN:
+                logging.info("No EnvLog readings found near the image time, reading all EnvLog files")
+                irradiance_timeline = __internal__.load_irradiance_files(camera_type, envlog_files,
+                                                                         num_irradiance_bands, envlog_cache)
+
+        # average the readings starting with the one closest to the image time
         logging.info('Computing mean spectrum')
-        abs_diff_time = np.zeros((len(envlog_tot_time)))
-        for time_key, time_value in enumerate(envlog_tot_time):
-            abs_diff_time[time_key] = abs(image_time - time_value)
-        ind_closet_time = np.argmin(abs_diff_time)  # closest time index
-        mean_spectrum = np.mean(envlog_spectra[ind_closet_time: ind_closet_time + num_irridiance_record-1, :], axis=0)
-        del envlog_spectra
-        del abs_diff_time
-
-        # load pre-computed the best matched index between image and irradiance sensor spectral bands
-        best_matched_index = np.load(best_matched)
-        test_irridance = mean_spectrum[best_matched_index.astype(int).tolist()]
-        test_irridance_re = np.resize(test_irridance, (1, num_irradiance_bands))
+        mean_spectrum = irradiance_timeline.mean_spectrum(image_time, num_irridiance_record)
+
+        # apply the pre-computed best matched index between image and irradiance sensor spectral bands, and the
+        # precomputed coefficients, to convert irradiance to DN
+        num_bands = __internal__.get_calibrated_band_count(camera_type)
+        if num_bands is not None and bins is None:
+            img_dn = img_dn[:, :, 0:num_bands]
+
+        irrad2dn = CALIBRATION_MODELS.get_irrad2dn(model_folder, mean_spectrum, num_spectral_bands, num_bands)
         del mean_spectrum
-        del test_irridance
-
-        # load and apply precomputed coefficient to convert irradiance to DN
-        loaded_bias = np.load(bias_filename)
-        loaded_gain = np.load(gain_filename)
-        if camera_type == "vnir_old":
-            test_irridance_re = test_irridance_re[:, 0:679]
-            img_dn = img_dn[:, :, 0:679]
-        elif camera_type == "vnir_middle":
-            test_irridance_re = test_irridance_re[:, 0:662]
-            img_dn = img_dn[:, :, 0:662]
-
-        irrad2dn = (loaded_gain * test_irridance_re) + loaded_bias
-        del loaded_gain
-        del test_irridance_re
-        del loaded_bias
+        if bins is not None:
+            irrad2dn = irrad2dn[:, bins.first:bins.stop]
+
+        if block_lines > 0:
+            # reflectance computation and writing, one block of scan lines at a time
+            logging.info("Computing reflectance %s scan lines at a time", str(block_lines))
+            rfl_filename = __internal__.update_netcdf(out_filename,
+                                                      __internal__.reflectance_blocks(img_dn, irrad2dn, block_lines,
+                                                                                      bins),
+                                                      camera_type, memory_budget, in_place, rfl_shape, rfl_chunks,
+                                                      packer, bins, overviews, cube_writer)
+            del img_dn
+            del irrad2dn
+            return rfl_filename
 
         # reflectance computation
         logging.info("Computing reflectance")
         rfl_data = img_dn/irrad2dn
         rfl_data = np.rollaxis(rfl_data, 2, 0)
+        if bins is not None:
+            rfl_data = bins.apply(rfl_data, 0, bins.first)
 
         # free up memory
         del img_dn
@@ -365,11 +1176,38 @@ class __internal__():
 
         # Write to nc file
         logging.debug("About to save netcdf file: %s", out_filename)
-        __internal__.update_netcdf(out_filename, rfl_data, camera_type)
+        rfl_filename = __internal__.update_netcdf(out_filename, rfl_data, camera_type, memory_budget, in_place,
+                                                  rfl_shape, rfl_chunks, packer, bins, overviews, cube_writer)
 
         # free up memory
         del rfl_data
 
+        return rfl_filename
+
+
+class RangeAction(argparse.Action):
+    """Stores the LOW and HIGH values of a range, rejecting empty ranges when the arguments are parsed
+    """
+
+    @staticmethod
+    def check_range(values: list) -> None:
+        """Checks that a range isn't empty
+        Arguments:
+            values: the LOW and HIGH values of the range
+        Exceptions:
+            Raises ValueError if LOW isn't less than HIGH
+        """
+        if not values[0] < values[1]:
+            raise ValueError("the range is empty: LOW %s needs to be less than HIGH %s" %
+                             (str(values[0]), str(values[1])))
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        try:
+            RangeAction.check_range(values)
+        except ValueError as ex:
+            raise argparse.ArgumentError(self, str(ex)) from ex
+        setattr(namespace, self.dest, values)
+
 
 def add_parameters(parser: argparse.ArgumentParser) -> None:
     """Adds parameters
@@ -378,7 +1216,88 @@ def add_parameters(parser: argparse.ArgumentParser) -> None:
     """
     parser.add_argument("--date_override", help="override default date by specifying a new one in ISO 8601 format")
     parser.add_argument('--skip_memory_check', action="store_true", help='do not perform memory check when processing RAW file')
+    parser.add_argument('--block_lines', type=int, default=DEFAULT_BLOCK_LINES,
+                        help='number of scan lines to calibrate at one time; 0 calibrates the entire image in memory '
+                             '(default %s)' % str(DEFAULT_BLOCK_LINES))
+    parser.add_argument('--copy_memory_mb', type=int, default=DEFAULT_COPY_MEMORY_MB,
+                        help='maximum megabytes of a variable to read at one time when copying netCDF data '
+                             '(default %s)' % str(DEFAULT_COPY_MEMORY_MB))
+    parser.add_argument('--in_place', action="store_true",
+                        help='overwrite rfl_img in the workflow output instead of writing a separate _newrfl.nc file')
+    parser.add_argument('--convert', action="store_true",
+                        help='convert the RAW file to netCDF in one sequential pass instead of with the workflow\'s '
+                             'ncks translation')
+    parser.add_argument('--compression_level', type=int, default=0, choices=range(0, 10),
+                        help='zlib compression level of the converted xps_img variable; 0 for no compression (default 0)')
+    parser.add_argument('--deflate_level', type=int, default=0, choices=range(0, 10),
+                        help='deflate level of the resulting netCDF files, the same as the workflow\'s -c dfl_lvl; '
+                             '0 for no compression (default 0)')
+    parser.add_argument('--compression_workers', type=int, default=hyperspectral_compress.DEFAULT_WORKERS,
+                        help='number of threads compressing netCDF chunks '
+                             '(default %s)' % str(hyperspectral_compress.DEFAULT_WORKERS))
+    parser.add_argument('--convert_buffer_mb', type=int, default=hyperspectral_convert.DEFAULT_BUFFER_MB,
+                        help='megabytes of scan lines to buffer when converting the RAW file '
+                             '(default %s)' % str(hyperspectral_convert.DEFAULT_BUFFER_MB))
+    parser.add_argument('--chunk_policy', choices=hyperspectral_storage.CHUNK_POLICIES,
+                        help='chunking of the (wavelength, y, x) image variables: "spectral" for reading the spectrum '
+                             'of pixels, "spatial" for reading the image of bands, or "balanced" for both; the default '
+                             'leaves the chunking to the netCDF libraries')
+    parser.add_argument('--rfl_packing', choices=hyperspectral_packing.PACKING_MODES,
+                        help='store rfl_img as 16 bit integers with scale_factor and add_offset, or rounded to half '
+                             'precision (stored as 32 bit floats, which only saves space when compressed)')
+    parser.add_argument('--rfl_packing_range', type=float, nargs=2, action=RangeAction,
+                        default=list(hyperspectral_packing.DEFAULT_PACKING_RANGE), metavar=('LOW', 'HIGH'),
+                        help='the range of reflectance packed into integers; values outside the range are clipped '
+                             '(default %s %s)' % hyperspectral_packing.DEFAULT_PACKING_RANGE)
+    parser.add_argument('--band_profile', type=hyperspectral_bands.BandProfile.parse, metavar='START:END[:WIDTH]',
+                        help='only write the bands from START up to END nanometers to rfl_img, averaged into bins of '
+                             'WIDTH nanometers when given; START and END can be left out (e.g. "400:900", "::10"), '
+                             'and the bands without calibration are always dropped. Other variables along the '
+                             'wavelength dimension are resampled in the same way')
+    parser.add_argument('--overviews', type=int, default=0,
+                        help='number of overview levels of rfl_img to write, each averaging 2x2 pixels of the level '
+                             'below (e.g. 3 writes 2x, 4x and 8x overviews as rfl_img_ovr2, rfl_img_ovr4 and '
+                             'rfl_img_ovr8); 0 for no overviews (default 0)')
+    parser.add_argument('--skip_nco_calibration', action="store_true",
+                        help='skip the workflow\'s NCO calibration since rfl_img is replaced by the calibration done '
+                             'here; the white and dark references are still merged into the _xps.nc file')
+    parser.add_argument('--indices', nargs='*', choices=list(hyperspectral_indices.INDEX_GROUPS.keys()),
+                        help='calculate the hyperspectral indices of the listed groups to an "_ind.nc" file; with no '
+                             'groups listed, the default groups are calculated')
+    parser.add_argument('--soil_mask', help='netCDF file with the SoilRemovalMask variable to apply to the indices')
+    parser.add_argument('--indices_aggregate', action="store_true",
+                        help='add the min, max and avg attributes to each hyperspectral index')
+    parser.add_argument('--indices_stats_only', action="store_true",
+                        help='only keep the min, max and avg of each hyperspectral index instead of the value of each '
+                             'pixel')
+    parser.add_argument('--indices_histogram_bins', type=int, default=0,
+                        help='number of bins of a histogram of each hyperspectral index; 0 for no histograms '
+                             '(default 0)')
+    parser.add_argument('--indices_histogram_range', type=float, nargs=2, default=[-1.0, 1.0], metavar=('LOW', 'HIGH'),
+                        help='the range of the hyperspectral index histograms (default -1.0 1.0)')
+    parser.add_argument('--output_format', choices=hyperspectral_zarr.OUTPUT_FORMATS, default='netcdf',
+                        help='format of the calibrated file: "netcdf", a chunked Zarr directory store ("zarr") '
+                             'ending in %s, or both (default netcdf)' % hyperspectral_zarr.STORE_EXTENSION)
+    parser.add_argument('--quicklook', choices=hyperspectral_quicklook.QUICKLOOK_SOURCES,
+                        help='write an RGB preview PNG from the header\'s default bands of the raw values or of the '
+                             'calibrated reflectance')
+    parser.add_argument('--quicklook_size', type=int, default=hyperspectral_quicklook.DEFAULT_QUICKLOOK_SIZE,
+                        help='number of pixels of the longer side of the quicklook '
+                             '(default %s)' % str(hyperspectral_quicklook.DEFAULT_QUICKLOOK_SIZE))
     parser.add_argument('--environment_logger', help='the path to the EnvironmentLogger folder')
+    parser.add_argument('--envlog_cache', help='folder for caching parsed EnvironmentLogger files between runs')
+    parser.add_argument('--envlog_cache_mb', type=int, default=DEFAULT_CACHE_SIZE_MB,
+                        help='maximum size of the EnvironmentLogger cache folder in megabytes '
+                             '(default %s)' % str(DEFAULT_CACHE_SIZE_MB))
+    parser.add_argument('--envlog_memory_files', type=int, default=0,
+                        help='number of parsed EnvironmentLogger files to keep in memory for later captures processed '
+                             'by the same process (default 0)')
+    parser.add_argument('--batch', action="store_true",
+                        help='process all the RAW files in the list at the same time as memory allows, instead of only '
+                             'the last one')
+    parser.add_argument('--batch_workers', type=int, default=0,
+                        help='maximum number of RAW files to process at the same time in batch mode; 0 uses the number '
+                             'of CPUs (default 0)')
     parser.add_argument('sensor', choices=['VNIR', 'SWIR'], help='the name of the sensor associated with the source files')
 
 
@@ -395,82 +1314,47 @@ def perform_process(transformer: transformer_class.Transformer, check_md: dict,
     # pylint: disable=unused-argument
     start_timestamp = datetime.datetime.now()
 
-    (raw_filename) = __internal__.get_needed_files(check_md['list_files']())
-    if not raw_filename:
+    if transformer.args.batch:
+        raw_filenames = __internal__.get_raw_files(check_md['list_files']())
+    else:
+        raw_filenames = [__internal__.get_needed_files(check_md['list_files']())]
+    if not raw_filenames or not raw_filenames[0]:
         return {'code': -1000, 'error': "A RAW file was not found in the provided list"}
     if not os.path.isdir(transformer.args.environment_logger):
         return {'code': -1001, 'error': "The environmental logger folder was not found: '%s'" % transformer.args.environment_logger}
-    if not transformer.args.skip_memory_check:
-        error_msg = __internal__.check_raw_file_size(raw_filename)
-        if error_msg:
-            return {'code': -1002, 'error': "Try using the --skip_memory_check switch. " + error_msg}
-
-    # Get the destination file names
-    out_base_filename = os.path.join(check_md['working_folder'], os.path.splitext(os.path.basename(raw_filename))[0])
-    out_filename = out_base_filename + '.nc'
-    xps_filename = out_base_filename + '_xps.nc'
-    calibration_filename = out_base_filename + '_newrfl.nc'
-    logging.debug("Output filename: %s", out_filename)
-    logging.debug("XPS filename: %s", xps_filename)
-    logging.debug("Calibration filename: %s", calibration_filename)
-    del out_base_filename
-
-    # Run the commands to create the files
-    logging.info('Running the hyperspectral workflow')
-    logging.debug("Calling hyperspectal_workflow.sh")
-    subprocess_code = subprocess.call(["bash", "hyperspectral_workflow.sh", "-d", "1",
-                                       "--output_xps_img", xps_filename, "-i", raw_filename, "-o", out_filename])
-    logging.debug("Subprocess return code: %s", str(subprocess_code))
-
-    logging.info("Running calibration")
-    data_date = transformer.args.date_override if transformer.args.date_override else check_md['timestamp'][:10]
-    data_date = data_date.replace('/', '-').replace('_', '-')
-    logging.debug("Sensor: %s  Data date: %s", transformer.args.sensor, data_date)
-    try:
-        __internal__.apply_calibration(raw_filename, transformer.args.sensor, data_date, check_md['timestamp'],
-                                       transformer.args.environment_logger, out_filename)
-    except Exception as ex:
-        msg = "Exception caught while applying calibration: " + str(ex)
-        logging.exception(msg)
-        return {'code': -1004, 'error': msg}
-
-    file_md = [
-        {
-            'path': out_filename,
-            'key': transformer.args.sensor,
-            'metadata': {
-                'source': raw_filename,
-                'transformer': configuration.TRANSFORMER_NAME,
-                'version': configuration.TRANSFORMER_VERSION,
-                'timestamp': datetime.datetime.utcnow().isoformat()
-            }
-        }, {
-            'path': xps_filename,
-            'key': transformer.args.sensor,
-            'metadata': {
-                'source': raw_filename,
-                'transformer': configuration.TRANSFORMER_NAME,
-                'version': configuration.TRANSFORMER_VERSION,
-                'timestamp': datetime.datetime.utcnow().isoformat()
-            }
-        }, {
-            'path': calibration_filename,
-            'key': transformer.args.sensor,
-            'metadata': {
-                'source': raw_filename,
-                'transformer': configuration.TRANSFORMER_NAME,
-                'version': configuration.TRANSFORMER_VERSION,
-                'timestamp': datetime.datetime.utcnow().isoformat()
-            }
-        }
-    ]
+
+    capture_md = None
+    if transformer.args.batch:
+        logging.info("Processing %s RAW files", str(len(raw_filenames)))
+        batch_results = __internal__.process_batch(transformer.args, raw_filenames, check_md)
+        file_md = []
+        capture_md = []
+        for raw_filename, one_result in batch_results:
+            file_md.extend(one_result.get('file', []))
+            capture_md.append({'source': raw_filename, 'code': one_result['code']})
+            if 'error' in one_result:
+                capture_md[-1]['error'] = one_result['error']
+        if not file_md:
+            return batch_results[0][1]
+    else:
+        memory_budget = None
+        if not transformer.args.skip_memory_check:
+            memory_budget = psutil.virtual_memory().available - MEMORY_RESERVE
+        result = __internal__.process_raw_file(transformer.args, raw_filenames[0], check_md['timestamp'],
+                                               check_md['working_folder'], memory_budget)
+        if result['code'] != 0:
+            return result
+        file_md = result['file']
+
+    transformer_info = {
+        'utc_timestamp': datetime.datetime.utcnow().isoformat(),
+        'processing_time': str(datetime.datetime.now() - start_timestamp),
+        'sensor': transformer.args.sensor
+    }
+    if capture_md is not None:
+        transformer_info['captures'] = capture_md
 
     return {'code': 0,
             'file': file_md,
-            configuration.TRANSFORMER_NAME:
-            {
-                'utc_timestamp': datetime.datetime.utcnow().isoformat(),
-                'processing_time': str(datetime.datetime.now() - start_timestamp),
-                'sensor': transformer.args.sensor
-            }
+            configuration.TRANSFORMER_NAME: transformer_info
             }